@@ -19,6 +19,7 @@
 
 import collections
 import logging
+import time
 
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.runtime import apiproxy
@@ -49,23 +50,84 @@ else:
   AsyncRPC = DevAppServerRPC
 
 
+def _is_finished(rpc):
+  """Checks whether the given RPC's result is ready without blocking.
+
+  The public RPC interface can only block on a single call, so this relies on
+  the private attribute in which the runtime's RPC class keeps its state; it
+  is RUNNING until the call's completion callback has fired.
+
+  Returns:
+    True if the RPC has finished, False if it is still running, or None if
+    the runtime does not expose the state of its RPCs.
+  """
+  running = getattr(apiproxy.RPC, 'RUNNING', None)
+  state = getattr(rpc, '_RPC__state', None)
+  if running is None or state is None:
+    return None
+  return state != running
+
+
 class AsyncAPIProxy(object):
   """Proxy for asynchronous API calls."""
   
-  def __init__(self):
+  def __init__(self, max_in_flight=None, now=time.time):
+    """Initializer.
+
+    Args:
+      max_in_flight: Maximum number of RPCs that may be outstanding at once.
+        When this many RPCs are outstanding, start_call() will wait for one of
+        them to finish before starting another. None means no limit.
+      now: Returns the current time in seconds since the epoch; used for
+        dependency injection.
+    """
     # TODO: Randomize this queue in the dev_appserver to simulate a real
     # asynchronous queue and better catch any funny race-conditions or
     # unclear event ordering dependencies.
     self.enqueued = collections.deque()
+    self.max_in_flight = max_in_flight
+    self.now = now
+
+  def start_call(self, package, call, pbrequest, pbresponse, user_callback,
+                 deadline=None):
+    """Starts an asynchronous API call.
 
-  def start_call(self, package, call, pbrequest, pbresponse, user_callback):
-    """user_callback is a callback that takes (response, exception)"""
+    Args:
+      package: Name of the API package (e.g., 'urlfetch').
+      call: Name of the call within the package (e.g., 'Fetch').
+      pbrequest: Request protocol buffer.
+      pbresponse: Response protocol buffer to fill in.
+      user_callback: Callback that takes (response, exception). If the call
+        does not finish within its deadline, it is abandoned and the callback
+        receives an apiproxy_errors.DeadlineExceededError.
+      deadline: Seconds to wait for the call to finish, or None to wait as
+        long as it takes. The proxy only checks deadlines when an outstanding
+        call finishes, since the runtime cannot be told to stop waiting at a
+        given time; callers should also give the service the same deadline
+        in the request, so a call never blocks for much longer than this.
+    """
     if not callable(user_callback):
       raise TypeError('%r not callable' % user_callback)
 
+    while (self.max_in_flight is not None and
+           len(self.enqueued) >= self.max_in_flight):
+      self.wait_any()
+
+    def run_callback(response, exception):
+      # An RPC that was abandoned may still complete later and call back into
+      # the runtime callback, so make sure the user callback only runs once.
+      if rpc.done:
+        return
+      rpc.done = True
+      user_callback(response, exception)
+
     rpc = AsyncRPC(package, call, pbrequest, pbresponse,
-                   lambda: user_callback(pbresponse, None))
-    setattr(rpc, 'user_callback', user_callback) # TODO make this pretty
+                   lambda: run_callback(pbresponse, None))
+    rpc.user_callback = run_callback
+    rpc.done = False
+    rpc.expires = None
+    if deadline is not None:
+      rpc.expires = self.now() + deadline
     self.enqueued.append(rpc)
     show_request = '...'
     if rpc.package == 'urlfetch':
@@ -78,24 +140,85 @@ class AsyncAPIProxy(object):
     """Returns the number of asynchronous RPCs pending in this proxy."""
     return len(self.enqueued)
 
-  def wait_one(self):
-    """Wait for a single RPC to finish. Returns True if one was processed."""
-    if not self.enqueued:
-      return False
-    
-    rpc = self.enqueued.popleft()
+  def cancel_all(self):
+    """Abandons all outstanding RPCs without running their callbacks.
+
+    Returns:
+      The number of RPCs that were abandoned.
+    """
+    count = len(self.enqueued)
+    for rpc in self.enqueued:
+      rpc.done = True
+    self.enqueued.clear()
+    return count
+
+  def _expire(self, rpc):
+    """Abandons an RPC that has run past its deadline."""
+    self.enqueued.remove(rpc)
+    logging.debug('RPC(%s, %s, .., ..) exceeded its deadline',
+                  rpc.package, rpc.call)
+    rpc.user_callback(None, apiproxy_errors.DeadlineExceededError(
+        'RPC(%s, %s) exceeded its deadline' % (rpc.package, rpc.call)))
+
+  def _finish(self, rpc):
+    """Waits for the given RPC and runs its user callback."""
     logging.debug('Waiting for RPC(%s, %s, .., ..)', rpc.package, rpc.call)
     rpc.Wait()
     try:
       rpc.CheckSuccess()
     except (apiproxy_errors.Error, apiproxy_errors.ApplicationError), e:
       rpc.user_callback(None, e)
+
+  def wait_one(self):
+    """Wait for the oldest RPC to finish. Returns True if one was processed."""
+    if not self.enqueued:
+      return False
+    
+    self._finish(self.enqueued.popleft())
     return True
 
+  def wait_any(self):
+    """Wait for whichever RPC finishes first. Returns True if one was processed.
+
+    Unlike wait_one(), a slow RPC at the front of the queue will not hold up
+    processing of RPCs that were started after it but finished sooner. RPCs
+    that are still running past their deadline are abandoned and count as
+    processed. If the runtime does not let us tell which RPCs have finished
+    (see _is_finished()), this falls back to wait_one().
+
+    Deadlines are only as precise as the calls themselves: they are checked
+    each time the runtime returns from waiting for some call to finish, which
+    may be after the earliest deadline has passed.
+    """
+    if not self.enqueued:
+      return False
+
+    while True:
+      can_poll = True
+      for rpc in self.enqueued:
+        finished = _is_finished(rpc)
+        if finished:
+          self.enqueued.remove(rpc)
+          self._finish(rpc)
+          return True
+        elif finished is None:
+          can_poll = False
+      now = self.now()
+      for rpc in self.enqueued:
+        if rpc.expires is not None and rpc.expires <= now:
+          self._expire(rpc)
+          return True
+      runtime_wait = getattr(_apphosting_runtime___python__apiproxy, 'Wait',
+                             None)
+      if not can_poll or runtime_wait is None:
+        return self.wait_one()
+      # Blocks until at least one outstanding call has completed.
+      runtime_wait()
+
   def wait(self):
     """Wait for RPCs to finish.  Returns True if any were processed."""
     while self.enqueued:
-      self.wait_one()
+      self.wait_any()
     else:
       return False
     return True
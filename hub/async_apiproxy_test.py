@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the async_apiproxy module."""
+
+import logging
+logging.basicConfig(format='%(levelname)-8s %(filename)s] %(message)s')
+import unittest
+
+import testutil
+testutil.fix_path()
+
+from google.appengine.runtime import apiproxy
+from google.appengine.runtime import apiproxy_errors
+
+import async_apiproxy
+
+################################################################################
+
+class FakeRPC(object):
+  """RPC-like object that finishes only when the test says so."""
+
+  def __init__(self, package, call, request, response, callback):
+    self.package = package
+    self.call = call
+    self.request = request
+    self.response = response
+    self.callback = callback
+    self.error = None
+    self._RPC__state = apiproxy.RPC.RUNNING
+
+  def MakeCall(self):
+    pass
+
+  def Wait(self):
+    self.finish()
+
+  def CheckSuccess(self):
+    if self.error is not None:
+      raise self.error
+    self.callback()
+
+  def finish(self):
+    self._RPC__state = apiproxy.RPC.FINISHING
+
+
+class FakeRuntime(object):
+  """Stands in for the runtime module; each Wait() finishes one RPC."""
+
+  def __init__(self):
+    self.to_finish = []
+
+  def Wait(self):
+    self.to_finish.pop(0).finish()
+
+
+class AsyncAPIProxyTest(unittest.TestCase):
+  """Tests for the AsyncAPIProxy class."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    self.rpcs = []
+    def create_rpc(*args):
+      rpc = FakeRPC(*args)
+      self.rpcs.append(rpc)
+      return rpc
+    self.old_rpc_class = async_apiproxy.AsyncRPC
+    async_apiproxy.AsyncRPC = create_rpc
+
+    self.runtime = FakeRuntime()
+    self.old_runtime = async_apiproxy._apphosting_runtime___python__apiproxy
+    async_apiproxy._apphosting_runtime___python__apiproxy = self.runtime
+
+    self.now = [1000.0]
+    self.proxy = async_apiproxy.AsyncAPIProxy(now=lambda: self.now[0])
+    self.results = []
+
+  def tearDown(self):
+    """Resets any external modules modified for testing."""
+    async_apiproxy.AsyncRPC = self.old_rpc_class
+    async_apiproxy._apphosting_runtime___python__apiproxy = self.old_runtime
+
+  def start_calls(self, count, deadline=None):
+    """Starts the given number of calls, each with its own index."""
+    for i in xrange(count):
+      def callback(response, exception, i=i):
+        self.results.append((i, response, exception))
+      self.proxy.start_call('test', 'Call', 'request', 'response%d' % i,
+                            callback, deadline=deadline)
+
+  def testWaitAny_noCalls(self):
+    """Tests wait_any when nothing is outstanding."""
+    self.assertFalse(self.proxy.wait_any())
+
+  def testWaitAny_completionOrder(self):
+    """Tests that the first RPC to finish is processed first."""
+    self.start_calls(3)
+    self.rpcs[2].finish()
+    self.assertTrue(self.proxy.wait_any())
+    self.assertEquals([(2, 'response2', None)], self.results)
+    self.assertEquals(2, self.proxy.rpcs_outstanding())
+
+  def testWaitAny_blocks(self):
+    """Tests that wait_any blocks on the runtime until an RPC finishes."""
+    self.start_calls(3)
+    self.runtime.to_finish.append(self.rpcs[1])
+    self.assertTrue(self.proxy.wait_any())
+    self.assertEquals([(1, 'response1', None)], self.results)
+    self.assertEquals([], self.runtime.to_finish)
+
+  def testWaitAny_error(self):
+    """Tests that RPC errors are passed to the user callback."""
+    self.start_calls(2)
+    error = apiproxy_errors.ApplicationError(1, 'bad')
+    self.rpcs[1].error = error
+    self.rpcs[1].finish()
+    self.assertTrue(self.proxy.wait_any())
+    self.assertEquals([(1, None, error)], self.results)
+
+  def testWaitAny_noRpcState(self):
+    """Tests waiting in order when the state of RPCs cannot be checked."""
+    self.start_calls(2)
+    for rpc in self.rpcs:
+      del rpc._RPC__state
+    self.assertTrue(self.proxy.wait_any())
+    self.assertEquals([(0, 'response0', None)], self.results)
+    self.assertEquals(1, self.proxy.rpcs_outstanding())
+
+  def testWait(self):
+    """Tests that wait processes RPCs in the order they finish."""
+    self.start_calls(3)
+    self.runtime.to_finish.extend([self.rpcs[2], self.rpcs[0], self.rpcs[1]])
+    self.proxy.wait()
+    self.assertEquals([2, 0, 1], [i for i, _, _ in self.results])
+    self.assertEquals(0, self.proxy.rpcs_outstanding())
+
+  def testMaxInFlight(self):
+    """Tests that starting a call waits for a free slot in the window."""
+    self.proxy.max_in_flight = 2
+    self.start_calls(2)
+    self.assertEquals([], self.results)
+    self.runtime.to_finish.append(self.rpcs[1])
+    self.start_calls(1)
+    self.assertEquals([(1, 'response1', None)], self.results)
+    self.assertEquals(2, self.proxy.rpcs_outstanding())
+    self.assertEquals(3, len(self.rpcs))
+
+  def testDeadline(self):
+    """Tests that RPCs running past their deadline are abandoned."""
+    self.start_calls(2, deadline=5)
+    self.rpcs[0].expires += 10
+    self.now[0] += 6
+    self.assertTrue(self.proxy.wait_any())
+    self.assertEquals(1, len(self.results))
+    index, response, exception = self.results[0]
+    self.assertEquals(1, index)
+    self.assertTrue(response is None)
+    self.assertTrue(
+        isinstance(exception, apiproxy_errors.DeadlineExceededError))
+    self.assertEquals(1, self.proxy.rpcs_outstanding())
+
+  def testDeadline_finishedFirst(self):
+    """Tests that finished RPCs are handled even if past their deadline."""
+    self.start_calls(1, deadline=5)
+    self.rpcs[0].finish()
+    self.now[0] += 6
+    self.assertTrue(self.proxy.wait_any())
+    self.assertEquals([(0, 'response0', None)], self.results)
+
+  def testDeadline_finishedLater(self):
+    """Tests that abandoned RPCs finishing later do not call back again."""
+    self.start_calls(1, deadline=5)
+    self.now[0] += 6
+    self.assertTrue(self.proxy.wait_any())
+    self.rpcs[0].finish()
+    self.rpcs[0].CheckSuccess()
+    self.assertEquals(1, len(self.results))
+    self.assertTrue(
+        isinstance(self.results[0][2], apiproxy_errors.DeadlineExceededError))
+
+  def testCancelAll(self):
+    """Tests abandoning all outstanding RPCs."""
+    self.start_calls(3)
+    self.assertEquals(3, self.proxy.cancel_all())
+    self.assertEquals(0, self.proxy.rpcs_outstanding())
+    self.assertFalse(self.proxy.wait())
+    self.assertEquals([], self.results)
+    self.rpcs[0].CheckSuccess()
+    self.assertEquals([], self.results)
+
+################################################################################
+
+if __name__ == '__main__':
+  unittest.main()
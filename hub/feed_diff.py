@@ -19,142 +19,280 @@ __author__ = 'bslatkin@gmail.com (Brett Slatkin)'
 
 """Atom/RSS feed parser that quickly extracts entry/item elements."""
 
-import cStringIO
 import logging
+import re
 import xml.sax
-import xml.sax.handler
 import xml.sax.saxutils
+from xml.parsers import expat
 
 
 # Set to true to see stack level messages and other debugging information.
 DEBUG = False
 
+# How much of the start of a document to look at when detecting its format.
+SNIFF_SIZE = 1024
+
+# Matches the markup that may appear before the root element of a document.
+PROLOG_RE = re.compile(
+    r'\s+|<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^\[>]*(\[.*?\])?\s*>|\xef\xbb\xbf',
+    re.DOTALL)
+
+# Matches the start of the root element, capturing its name.
+ROOT_RE = re.compile(r'<([^\s/>]+)[\s/>]')
+
+# Byte order marks and the encodings they identify.
+BOMS = [
+  ('\xef\xbb\xbf', 'utf-8'),
+  ('\xff\xfe', 'utf-16-le'),
+  ('\xfe\xff', 'utf-16-be'),
+]
+
+
+def get_bom(data):
+  """Returns (bom, encoding) for the byte order mark data starts with.
+
+  Returns:
+    ('', None) if the data does not start with a byte order mark.
+  """
+  for bom, encoding in BOMS:
+    if data.startswith(bom):
+      return bom, encoding
+  return '', None
+
 
 class Error(Exception):
   """Exception for errors in this module."""
 
 
-class FeedContentHandler(xml.sax.handler.ContentHandler):
-  """Sax content handler for quickly parsing Atom and RSS feeds."""
+class FeedParser(object):
+  """Finds the entries in a feed by recording where they are in the document.
+
+  Rather than re-serializing the parsed XML, the byte offsets of each entry
+  are recorded while parsing and then used to slice the entries and the
+  header/footer out of the original document. This reproduces the original
+  content exactly and avoids building up copies of the whole feed.
 
-  def __init__(self, parser):
+  Sub-classes should set the class attributes below for their feed format.
+  """
+
+  # Name of the document's root element.
+  root_name = None
+  # Name of the elements that are entries, and their depth in the document.
+  entry_name = None
+  entry_depth = None
+  # Names of the entry's child elements that can serve as its ID, in order
+  # of preference. May include the name of id_attribute.
+  id_names = ()
+  # Name of an attribute of the entry element that can serve as its ID.
+  id_attribute = None
+
+  def __init__(self, data, encoding=None):
     """Initializer.
 
     Args:
-      parser: Instance of the xml.sax parser being used with this handler.
+      data: String containing the encoded XML document to parse.
+      encoding: Encoding of the data, overriding any XML declaration in the
+        document. If None, the document's declared encoding is used.
     """
-    self.parser = parser
-    self.header_footer = ""
-    self.entries_map = {}
+    self.data = data
+    # A byte order mark takes precedence over the XML declaration, as it
+    # does for expat.
+    bom_encoding = get_bom(data)[1]
+    self.encoding = encoding or bom_encoding or 'utf-8'
+    self.encoding_override = encoding or bom_encoding
+    # The encoded '>', whose length is the code unit size used to find the
+    # ends of tags in UTF-16 documents.
+    self.gt = u'>'.encode(self.encoding)
+    self.parser = expat.ParserCreate(encoding)
+    self.parser.buffer_text = True
+    self.parser.XmlDeclHandler = self.xml_decl
+    self.parser.StartElementHandler = self.start_element
+    self.parser.EndElementHandler = self.end_element
+    self.parser.CharacterDataHandler = self.characters
 
     # Internal state
-    self.stack_level = 0
-    self.output_stack = []
-    self.current_level = None
-    self.last_id = ''
-    self.last_link = ''
-    self.last_title = ''
-    self.last_description = ''
-
-  # Helper methods
-  def emit(self, data):
-    if type(data) is list:
-      self.current_level.extend(data)
-    else:
-      self.current_level.append(data)
-
-  def push(self):
-    self.current_level = []
-    self.output_stack.append(self.current_level)
-
-  def pop(self):
-    old_level = self.output_stack.pop()
-    if len(self.output_stack) > 0:
-      self.current_level = self.output_stack[-1]
-    else:
-      self.current_level = None
-    return old_level
-
-  # SAX methods
-  def startElement(self, name, attrs):
-    self.stack_level += 1
-    event = (self.stack_level, name)
-    if DEBUG: logging.debug('Start stack level %r', event)
-
-    self.push()
-    self.emit(['<', name])
-    for key, value in attrs.items():
-      self.emit([' ', key, '=', xml.sax.saxutils.quoteattr(value)])
-    self.emit('>')
-
-    self.push()
-
-  def endElement(self, name):
-    event = (self.stack_level, name)
-    if DEBUG: logging.debug('End stack level %r', event)
-
-    content = self.pop()
-    self.emit(content)
-    self.emit(['</', name, '>'])
-    self.handleEvent(event, content)
-    self.stack_level -= 1
+    self.depth = 0
+    self.root_start = None
+    self.root_end = None
+    self.entry_start = None
+    self.entry_spans = []
+    self.fields = {}
+    self.field_name = None
+    self.field_text = []
+
+  def end_of_tag(self):
+    """Returns the offset just past the tag the parser is currently at."""
+    start = self.parser.CurrentByteIndex
+    end = self.data.find(self.gt, start)
+    while end != -1 and (end - start) % len(self.gt):
+      end = self.data.find(self.gt, end + 1)
+    return end + len(self.gt)
+
+  def decode(self, start, end):
+    """Returns the given slice of the original document as unicode.
+
+    Raises:
+      Error if the slice cannot be decoded with the document's encoding.
+    """
+    try:
+      return self.data[start:end].decode(self.encoding)
+    except (UnicodeError, LookupError), e:
+      raise Error('Could not decode feed as %s: %s' % (self.encoding, e))
+
+  # Expat handlers
+  def xml_decl(self, version, encoding, standalone):
+    if encoding and not self.encoding_override:
+      self.encoding = encoding
+      try:
+        self.gt = u'>'.encode(encoding)
+      except (UnicodeError, LookupError), e:
+        raise Error('Unsupported feed encoding %s: %s' % (encoding, e))
+
+  def start_element(self, name, attrs):
+    self.depth += 1
+    if DEBUG: logging.debug('Start stack level %r', (self.depth, name))
+
+    if self.depth == 1:
+      if name != self.root_name:
+        raise Error('Enclosing tag is not <%s></%s>' %
+                    (self.root_name, self.root_name))
+      self.root_start = self.parser.CurrentByteIndex
+    elif self.depth == self.entry_depth and name == self.entry_name:
+      self.entry_start = self.parser.CurrentByteIndex
+      self.fields = {}
+      if self.id_attribute in attrs:
+        self.fields[self.id_attribute] = xml.sax.saxutils.escape(
+            attrs[self.id_attribute]).strip()
+    elif (self.entry_start is not None and
+          self.depth == self.entry_depth + 1 and
+          name in self.id_names):
+      self.field_name = name
+      self.field_text = []
+
+  def end_element(self, name):
+    if DEBUG: logging.debug('End stack level %r', (self.depth, name))
+
+    if self.field_name is not None and self.depth == self.entry_depth + 1:
+      # IDs are kept escaped, as they appear in the document, so they match
+      # those of entries that have been seen before.
+      self.fields[self.field_name] = xml.sax.saxutils.escape(
+          ''.join(self.field_text)).strip()
+      self.field_name = None
+    elif self.entry_start is not None and self.depth == self.entry_depth:
+      entry_id = ''
+      for id_name in self.id_names:
+        entry_id = self.fields.get(id_name)
+        if entry_id:
+          break
+      self.entry_spans.append((self.entry_start, self.end_of_tag(), entry_id))
+      self.entry_start = None
+    elif self.depth == 1:
+      self.root_end = self.end_of_tag()
+
+    self.depth -= 1
 
   def characters(self, content):
-    # The SAX parser will try to escape XML entities (like &amp;) and other
-    # fun stuff. But this is not what we actually want. We want the original
-    # content to be reproduced exactly as we received it, so we can pass it
-    # along to others. The reason is simple: reformatting the XML by unescaping
-    # certain data may cause the resulting XML to no longer validate.
-    self.emit(xml.sax.saxutils.escape(content))
-
-
-class AtomFeedHandler(FeedContentHandler):
-  """Sax content handler for Atom feeds."""
-
-  def handleEvent(self, event, content):
-    if event[0] == 1:
-      if event[1] != 'feed':
-        raise Error('Enclosing tag is not <feed></feed>')
-      else:
-        self.header_footer = ''.join(self.pop())
-    elif event == (2, 'entry'):
-      self.entries_map[self.last_id] = ''.join(self.pop())
-    elif event == (3, 'id'):
-      self.last_id = ''.join(content).strip()
-      self.emit(self.pop())
-    else:
-      self.emit(self.pop())
-
-
-class RssFeedHandler(FeedContentHandler):
-  """Sax content handler for RSS feeds."""
-
-  def handleEvent(self, event, content):
-    if event[0] == 1:
-      if event[1] != 'rss':
-        raise Error('Enclosing tag is not <rss></rss>')
-      else:
-        self.header_footer = ''.join(self.pop())
-    elif event == (3, 'item'):
-      item_id = (self.last_id or self.last_link or
-                 self.last_title or self.last_description)
-      self.entries_map[item_id] = ''.join(self.pop())
-      self.last_id, self.last_link, self.last_title, self.last_description = (
-          '', '', '', '')
-    elif event == (4, 'guid'):
-      self.last_id = ''.join(content).strip()
-      self.emit(self.pop())
-    elif event == (4, 'link'):
-      self.last_link = ''.join(content).strip()
-      self.emit(self.pop())
-    elif event == (4, 'title'):
-      self.last_title = ''.join(content).strip()
-      self.emit(self.pop())
-    elif event == (4, 'description'):
-      self.last_description = ''.join(content).strip()
-      self.emit(self.pop())
-    else:
-      self.emit(self.pop())
+    if self.field_name is not None:
+      self.field_text.append(content)
+
+  def parse(self):
+    """Parses the document.
+
+    Returns:
+      Tuple (header_footer, entries_map) as described in filter().
+
+    Raises:
+      xml.sax.SAXException on parse errors. Error if the document is not in
+      the expected format or cannot be decoded.
+    """
+    try:
+      self.parser.Parse(self.data, True)
+    except expat.ExpatError, e:
+      raise xml.sax.SAXException(str(e))
+    except (UnicodeError, LookupError), e:
+      raise Error('Could not decode feed: %s' % e)
+
+    entries_map = {}
+    header_footer = []
+    last_end = self.root_start
+    for start, end, entry_id in self.entry_spans:
+      header_footer.append(self.decode(last_end, start))
+      entries_map[entry_id or ''] = self.decode(start, end)
+      last_end = end
+    header_footer.append(self.decode(last_end, self.root_end))
+    return ''.join(header_footer), entries_map
+
+
+class AtomFeedParser(FeedParser):
+  """Parser for Atom feeds."""
+
+  root_name = 'feed'
+  entry_name = 'entry'
+  entry_depth = 2
+  id_names = ('id',)
+
+
+class RssFeedParser(FeedParser):
+  """Parser for RSS feeds."""
+
+  root_name = 'rss'
+  entry_name = 'item'
+  entry_depth = 3
+  id_names = ('guid', 'link', 'title', 'description')
+
+
+class RdfFeedParser(FeedParser):
+  """Parser for RDF (RSS 1.0) feeds."""
+
+  root_name = 'rdf:RDF'
+  entry_name = 'item'
+  entry_depth = 2
+  id_names = ('rdf:about', 'link', 'title', 'description')
+  id_attribute = 'rdf:about'
+
+
+PARSERS = {
+  'atom': AtomFeedParser,
+  'rss': RssFeedParser,
+  'rdf': RdfFeedParser,
+}
+
+
+def detect_format(data):
+  """Detects the format of a feed from its root element.
+
+  Only the first SNIFF_SIZE bytes of the document are examined, so this is
+  cheap even for very large feeds.
+
+  Args:
+    data: String containing the data of the XML feed.
+
+  Returns:
+    'atom', 'rss', or 'rdf' if the format was detected; None otherwise.
+  """
+  head = data[:SNIFF_SIZE]
+  bom, encoding = get_bom(head)
+  if encoding:
+    head = head[len(bom):].decode(encoding, 'ignore').encode('utf-8')
+  position = 0
+  while True:
+    match = PROLOG_RE.match(head, position)
+    if not match or match.end() == position:
+      break
+    position = match.end()
+
+  match = ROOT_RE.match(head, position)
+  if not match:
+    return None
+  # Ignore any namespace prefix on the root element.
+  name = match.group(1).split(':')[-1]
+  if name == 'feed':
+    return 'atom'
+  elif name == 'rss':
+    return 'rss'
+  elif name == 'RDF':
+    return 'rdf'
+  return None
 
 
 def filter(data, format):
@@ -162,7 +300,8 @@ def filter(data, format):
 
   Args:
     data: String containing the data of the XML feed to parse.
-    format: String naming the format of the data. Should be 'rss' or 'atom'.
+    format: String naming the format of the data. Should be 'atom', 'rss', or
+      'rdf'.
 
   Returns:
     Tuple (header_footer, entries_map) where:
@@ -175,26 +314,26 @@ def filter(data, format):
     be derived due to bad content (e.g., a good XML doc that is not Atom or RSS)
     or any of the feed entries are missing required fields.
   """
-  data_stream = cStringIO.StringIO(data)
-  parser = xml.sax.make_parser()
-
-  if format == 'atom':
-    handler = AtomFeedHandler(parser)
-  elif format == 'rss':
-    handler = RssFeedHandler(parser)
-  else:
+  encoding = None
+  if isinstance(data, unicode):
+    data = data.encode('utf-8')
+    encoding = 'utf-8'
+
+  if format not in PARSERS:
     raise Error('Invalid feed format "%s"' % format)
+  parser = PARSERS[format](data, encoding=encoding)
 
-  parser.setContentHandler(handler)
-  parser.parse(data_stream)
+  header_footer, entries_map = parser.parse()
 
-  for entry_id, content in handler.entries_map.iteritems():
+  for entry_id, content in entries_map.iteritems():
     if format == 'atom' and not entry_id:
       raise Error('<entry> element missing <id>: %s' % content)
     elif format == 'rss' and not entry_id:
       raise Error('<item> element missing <guid> or <link>: %s' % content)
+    elif format == 'rdf' and not entry_id:
+      raise Error('<item> element missing rdf:about or <link>: %s' % content)
 
-  return handler.header_footer, handler.entries_map
+  return header_footer, entries_map
 
 
-__all__ = ['filter', 'DEBUG', 'Error']
+__all__ = ['detect_format', 'filter', 'DEBUG', 'Error']
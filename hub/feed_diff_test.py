@@ -22,6 +22,7 @@ __author__ = 'bslatkin@gmail.com (Brett Slatkin)'
 import logging
 import os
 import unittest
+import xml.sax
 
 import feed_diff
 
@@ -88,14 +89,69 @@ class AtomFeedDiffTest(TestBase):
   def testEntityEscaping(self):
     """Tests when certain external entities show up in the feed.
 
-    Example: '&amp;nbsp' will be converted to '&nbsp;' by the parser, but then
-    the new output entity won't be resolved.
+    Example: '&amp;nbsp' must not be converted to '&nbsp;', since the new
+    output entity won't be resolved. Entities are left exactly as they were.
     """
     header_footer, entries = self.load_feed('entity_escaping.xml')
-    self.assertTrue('&#x27;' not in header_footer)
+    self.assertTrue('&#x27;' in header_footer)
     entity_id, content = entries.items()[0]
     self.assertTrue('&amp;nbsp;' in content)
 
+  def testPreservesOriginal(self):
+    """Tests that entries and the header/footer are sliced out verbatim."""
+    data = open(os.path.join(self.testdata, 'parsing.xml')).read()
+    header_footer, entries = feed_diff.filter(data, 'atom')
+    document = data.decode('utf-8')
+    remaining = document[document.index('<feed'):]
+    for content in entries.itervalues():
+      self.assertTrue(content in document)
+      remaining = remaining.replace(content, '')
+    self.assertEquals(remaining.strip(), header_footer)
+
+  def testUnicodeInput(self):
+    """Tests parsing a feed that has already been decoded."""
+    data = (u'<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+            u'<feed><title>caf\xe9</title>'
+            u'<entry><id>\xfcber</id><title>\u2603</title></entry></feed>')
+    header_footer, entries = feed_diff.filter(data, 'atom')
+    self.assertEquals(u'<feed><title>caf\xe9</title></feed>', header_footer)
+    self.assertEquals(
+        {u'\xfcber': u'<entry><id>\xfcber</id><title>\u2603</title></entry>'},
+        entries)
+
+  def testUtf16(self):
+    """Tests parsing a UTF-16 feed that starts with a byte order mark."""
+    data = (u'<?xml version="1.0" encoding="UTF-16"?>\n'
+            u'<feed><title>caf\xe9</title>'
+            u'<entry><id>1</id><title>\u2603</title></entry></feed>'
+           ).encode('utf-16')
+    header_footer, entries = feed_diff.filter(data, 'atom')
+    self.assertEquals(u'<feed><title>caf\xe9</title></feed>', header_footer)
+    self.assertEquals(
+        {u'1': u'<entry><id>1</id><title>\u2603</title></entry>'}, entries)
+
+  def testUnknownEncoding(self):
+    """Tests that feeds in encodings we cannot decode raise an Error."""
+    self.assertRaises(
+        feed_diff.Error, feed_diff.filter,
+        '<?xml version="1.0" encoding="x-bogus"?>'
+        '<feed><entry><id>1</id></entry></feed>', 'atom')
+
+  def testEmptyEntry(self):
+    """Tests that self-closing entries are sliced out completely."""
+    data = '<feed><entry/><entry><id>1</id></entry></feed>'
+    try:
+      feed_diff.filter(data, 'atom')
+    except feed_diff.Error, e:
+      self.assertTrue('<entry> element missing <id>: <entry/>' in str(e))
+    else:
+      self.fail()
+
+  def testParseError(self):
+    """Tests that malformed documents raise a SAX exception."""
+    self.assertRaises(xml.sax.SAXException, feed_diff.filter,
+                      '<feed><entry></feed>', 'atom')
+
   def testAttributeEscaping(self):
     """Tests when certain external entities show up in an XML attribute.
 
@@ -222,6 +278,81 @@ class RssFeedDiffTest(TestBase):
       self.fail()
 
 
+class RdfFeedDiffTest(TestBase):
+
+  format = 'rdf'
+  feed_open = '<rdf:RDF'
+  feed_close = '</rdf:RDF>'
+  entry_open = '<item'
+  entry_close = '</item>'
+
+  def testParsingRdf(self):
+    """Tests parsing RSS 1.0."""
+    header_footer, entries = self.load_feed('rdf_sample.xml')
+    expected_list = [
+        u'http://xml.com/pub/2000/08/09/linkonly.html',
+        u'http://xml.com/pub/2000/08/09/rdfdb/index.html',
+        u'http://xml.com/pub/2000/08/09/xslt/xslt.html',
+    ]
+    self.verify_entries(expected_list, entries)
+    self.assertTrue('<channel rdf:about=' in header_footer)
+    self.assertTrue('<item>' not in header_footer)
+    self.assertTrue('<item rdf:about' not in header_footer)
+
+  def testFailsOnRss(self):
+    """Tests that parsing an RSS 2.0 feed as RDF will fail."""
+    data = open(os.path.join(self.testdata, 'rss2sample.xml')).read()
+    try:
+      feed_diff.filter(data, 'rdf')
+    except feed_diff.Error, e:
+      self.assertTrue('Enclosing tag is not <rdf:RDF></rdf:RDF>' in str(e))
+    else:
+      self.fail()
+
+
+class DetectFormatTest(TestBase):
+
+  def detect(self, path):
+    data = open(os.path.join(self.testdata, path)).read()
+    return feed_diff.detect_format(data)
+
+  def testTestData(self):
+    """Tests detecting the format of each of the sample feeds."""
+    self.assertEquals('atom', self.detect('parsing.xml'))
+    self.assertEquals('atom', self.detect('no_xml_header.xml'))
+    self.assertEquals('rss', self.detect('rss2sample.xml'))
+    self.assertEquals('rss', self.detect('sampleRss091.xml'))
+    self.assertEquals('rss', self.detect('sampleRss092.xml'))
+    self.assertEquals('rdf', self.detect('rdf_sample.xml'))
+    self.assertEquals(None, self.detect('bad_atom_feed.xml'))
+
+  def testProlog(self):
+    """Tests skipping comments, processing instructions, and doctypes."""
+    self.assertEquals('rss', feed_diff.detect_format(
+        '\xef\xbb\xbf<?xml version="1.0"?>\n'
+        '<?xml-stylesheet href="style.xsl" type="text/xsl"?>\n'
+        '<!-- <feed> in a comment -->\n'
+        '<!DOCTYPE rss PUBLIC "-//Netscape" "http://example.com/rss.dtd">\n'
+        '<rss version="0.91"><channel/></rss>'))
+    self.assertEquals('atom', feed_diff.detect_format(
+        '<!DOCTYPE feed [<!ENTITY nbsp "&#160;">]><atom:feed/>'))
+
+  def testByteOrderMark(self):
+    """Tests detecting the format of UTF-16 documents."""
+    data = u'<?xml version="1.0"?>\n<rss version="2.0"/>'
+    self.assertEquals('rss', feed_diff.detect_format(data.encode('utf-16')))
+    self.assertEquals('rss', feed_diff.detect_format(
+        '\xfe\xff' + data.encode('utf-16-be')))
+
+  def testUnknown(self):
+    """Tests documents that are not feeds or are not XML at all."""
+    self.assertEquals(None, feed_diff.detect_format(''))
+    self.assertEquals(None, feed_diff.detect_format('this is not xml'))
+    self.assertEquals(None, feed_diff.detect_format('<html><body/></html>'))
+    self.assertEquals(None, feed_diff.detect_format(
+        '<!--' + 'x' * feed_diff.SNIFF_SIZE + '--><feed/>'))
+
+
 
 if __name__ == '__main__':
   ## feed_diff.DEBUG = True
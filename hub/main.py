@@ -21,28 +21,53 @@
 
 * Subscription: A single subscriber's lease on a topic URL. Also represents a
   work item of a subscription that is awaiting confirmation (sub. or unsub).
+  Keeps track of failed deliveries so subscribers that stay unreachable can be
+  suspended until they subscribe again.
 
 * FeedToFetch: Work item inserted when a publish event occurs. This will be
-  moved to the Task Queue API once available.
+  moved to the Task Queue API once available. Work is done in order of
+  priority, which favors publish events and feeds that are popular or change
+  often.
+
+* SubscriberCountShard: One shard of the approximate number of verified
+  subscribers to a topic. Updated as subscriptions are verified and removed,
+  and reconciled by the push worker as it pages through the subscribers and
+  by a periodic pass over all known feeds.
 
 * KnownFeed: Materialized view of all distinct topic URLs. Written blindly on
   successful subscriptions; may be out of date after unsubscription. Used for
-  doing bootstrap polling of feeds that are not Hub aware.
+  doing bootstrap polling of feeds that are not Hub aware; each one is also a
+  work item scheduled for the next time its feed should be polled.
 
 * FeedRecord: Metadata information about a feed, the last time it was polled,
   and any headers that may affect future polling. Also contains any debugging
   information about the last feed fetch and why it may have failed.
 
-* FeedEntryRecord: Record of a single entry in a single feed. May eventually
-  be garbage collected after enough time has passed since it was last seen.
+* FeedEntryRecord: Record of a single entry in a single feed. Garbage
+  collected once enough time has passed since it was last stored, as long as
+  it may no longer be in its feed and is not one of the most recent entries
+  for its feed.
 
 * EventToDeliver: Work item that contains the content to deliver for a feed
   event. Maintains current position in subscribers and number of delivery
-  failures. Used to coordinate delivery retries. Will be deleted in successful
-  cases or stick around in the event of complete failures for debugging.
+  failures. Keeps the content around until all failed deliveries have been
+  retried. Will be deleted in successful cases or stick around in the event of
+  complete failures for debugging.
+
+* FailedCallback: Work item for a subscriber an event could not be delivered
+  to. Child of the EventToDeliver, and retried on its own backoff schedule.
+
+* DeliveryBatch: Work item that schedules delivery of the entries of events
+  for a subscriber that asked for aggregated delivery, so entries from all of
+  its topics can be delivered together in a single request.
+
+* DeliveryBatchEntry: The entries of a single event waiting in the
+  DeliveryBatch of a callback.
 
 * PollingMarker: Work item that keeps track of a position in the list of
-  KnownFeed instances. Used to do bootstrap polling.
+  FeedRecords when garbage collecting entries, in the list of KnownFeeds when
+  reconciling subscriber counts, or in the entities of a kind being upgraded
+  from an older version.
 
 
 === Entity groups:
@@ -52,7 +77,8 @@ of simultaneous subscriptions for the same topic URL. FeedToFetch is also in
 its own entity group for the same reason. FeedRecord, FeedEntryRecord, and
 EventToDeliver entries are all in the same entity group, however, to ensure that
 each feed polling is either full committed and delivered to subscribers or fails
-and will be retried at a later time.
+and will be retried at a later time. The FailedCallbacks of each EventToDeliver
+are its children, so delivery progress is also updated atomically.
 
                   ------------
                  | FeedRecord |
@@ -64,7 +90,11 @@ and will be retried at a later time.
          |                           |
  --------+--------           --------+-------
 | FeedEntryRecord |         | EventToDeliver |
- -----------------           ----------------
+ -----------------           --------+-------
+                                     |
+                             --------+-------
+                            | FailedCallback |
+                             ----------------
 """
 
 # Bigger TODOs (now in priority order)
@@ -76,33 +106,24 @@ and will be retried at a later time.
 # - Add Subscription delivery diagnostics, so subscribers can understand what
 #   error the hub has been seeing when we try to deliver a feed to them.
 #
-# - Add subscription counting to PushEventHandler so we can deliver a header
-#   with the number of subscribers the feed has. This will simply just keep
-#   count of the subscribers seen so far and then when the pushing is done it
-#   will save that total back on the FeedRecord instance.
-#
 # - Add Publisher rate-limiting (by IP of the publishing host and/or the
 #   target feed URL).
 #
-# - Improve polling algorithm to keep stats on each feed.
-#
-# - Do not poll a feed if we've gotten an event from the publisher in less
-#   than the polling period.
-#
-# - Add Subscription expiration cronjob to clean up expired subscriptions.
-#
 # - Add maximum subscription count per callback domain.
 #
 
 import datetime
 import hashlib
 import logging
+import math
 import os
 import random
+import re
 import urllib
 import urlparse
 import wsgiref.handlers
 import xml.sax
+import xml.sax.saxutils
 
 from google.appengine import runtime
 from google.appengine.api import datastore_types
@@ -119,8 +140,6 @@ import async_apiproxy
 import feed_diff
 import urlfetch_async
 
-async_proxy = async_apiproxy.AsyncAPIProxy()
-
 ################################################################################
 # Config parameters
 
@@ -132,11 +151,101 @@ if DEBUG:
 # How long a subscription will last before it must be renewed by the subscriber.
 EXPIRATION_DELTA = datetime.timedelta(days=90)
 
+# Number of expired subscriptions to delete at a time.
+SUBSCRIPTION_SWEEP_CHUNK_SIZE = 100
+
+# Number of entities to check at a time when upgrading entities stored by older
+# versions.
+BACKFILL_CHUNK_SIZE = 100
+
 # How long to hold a lock after query_and_own(), in seconds.
 LEASE_PERIOD_SECONDS = 15
 
-# How many subscribers to contact at a time when delivering events.
+# Maximum number of entities the Datastore will return for a single query.
+MAX_QUERY_FETCH_SIZE = 1000
+
+# Maximum number of entities to get or put in a single Datastore call. Larger
+# batches are split up to stay within the API's size limits.
+MAX_BATCH_SIZE = 100
+
+# Number of shards for each work queue. Each worker slot configured in cron.yaml
+# (the 'num' parameter) only reads work from a single shard, so these should
+# match the number of slots configured for each type of worker. Changing these
+# leaves existing work items in their old shards until they are rewritten.
+SUBSCRIPTION_CONFIRM_SHARDS = 3
+FEED_PULL_SHARDS = 8
+EVENT_DELIVERY_SHARDS = 8
+POLL_BOOTSTRAP_SHARDS = 4
+DELIVERY_BATCH_SHARDS = 2
+DELIVERY_RETRY_SHARDS = 4
+
+# How long a background worker may keep claiming more work in a single
+# request, in seconds. Should leave plenty of headroom before the request
+# deadline to finish the last batch of work.
+WORKER_TIME_BUDGET = 20
+
+# How many feeds to claim at a time when pulling feeds.
+FEED_PULL_BATCH_SIZE = 5
+
+# How many subscribers to contact at a time when delivering events for a topic
+# that has no delivery stats yet. The chunk size for each topic then adapts to
+# how quickly its deliveries finish, up to MAX_EVENT_SUBSCRIBER_CHUNK_SIZE.
 EVENT_SUBSCRIBER_CHUNK_SIZE = 10
+MAX_EVENT_SUBSCRIBER_CHUNK_SIZE = 500
+
+# Number of shards to split each topic's subscriber count across, so many
+# subscriptions to the same topic can be counted at once. Changing this leaves
+# counts in existing shards that are no longer read until they are reconciled.
+SUBSCRIBER_COUNT_SHARDS = 10
+
+# How long to cache the subscriber count of a topic in memcache, in seconds.
+SUBSCRIBER_COUNT_CACHE_SECONDS = 60
+
+# How often to reconcile the subscriber counts of all known feeds, in seconds,
+# and how many feeds to reconcile in a single request. Topics with at least
+# SUBSCRIBER_COUNT_RECONCILE_MAX subscribers are too large to count with a
+# query, and are only reconciled by the push worker.
+SUBSCRIBER_COUNT_RECONCILE_PERIOD = 86400  # 1 day
+SUBSCRIBER_COUNT_RECONCILE_CHUNK_SIZE = 20
+SUBSCRIBER_COUNT_RECONCILE_MAX = 1000
+
+# How many independent ranges of subscribers to split an event into when its
+# topic has more subscribers than fit in this many delivery chunks. Each range
+# is delivered by its own EventToDeliver, so separate workers can deliver a
+# single event in parallel. Set to 1 to disable splitting.
+EVENT_FANOUT_RANGES = 8
+
+# How long delivering a single chunk of subscribers should take, in seconds.
+# Chunks that finish in less than half of this time will grow; chunks that
+# take longer or hit the request deadline will shrink.
+EVENT_DELIVERY_TARGET_SECONDS = 10
+
+# Maximum number of asynchronous API calls (e.g., subscriber callbacks) to have
+# outstanding at once. New calls are started as soon as earlier ones finish.
+MAX_ASYNC_CALLS_IN_FLIGHT = 10
+
+# How long to wait for a subscriber to respond to an event delivery before
+# treating it as a failure, in seconds.
+EVENT_DELIVERY_DEADLINE = 10
+
+# Maximum number of event deliveries to a single callback host to have
+# outstanding at once from one push worker.
+MAX_DELIVERIES_PER_HOST = 4
+
+# Number of consecutive failed deliveries to a callback host after which all
+# deliveries to it are deferred, and for how long, in seconds. Once that time
+# passes a single trial delivery is made to see if the host has recovered.
+HOST_FAILURE_THRESHOLD = 5
+HOST_CIRCUIT_OPEN_SECONDS = 300
+
+# How long to remember the health of a callback host in memcache.
+HOST_HEALTH_CACHE_SECONDS = 86400
+
+# How long to collect entries for subscribers that asked for aggregated
+# delivery before sending them all in one request, in seconds, and the most
+# entries to send in a single request.
+DELIVERY_BATCH_WINDOW = 60
+DELIVERY_BATCH_MAX_ENTRIES = 200
 
 # Maximum number of times to attempt a subscription retry.
 MAX_SUBSCRIPTION_CONFIRM_FAILURES = 10
@@ -144,29 +253,94 @@ MAX_SUBSCRIPTION_CONFIRM_FAILURES = 10
 # Period to use for exponential backoff on subscription confirm retries.
 SUBSCRIPTION_RETRY_PERIOD = 300 # seconds
 
+# How much sooner to fetch a feed than other feeds, in seconds. Feeds are
+# fetched in order of their FeedToFetch eta, and these are subtracted from it:
+# - For explicit publish events, so they stay ahead of bootstrap polling.
+FEED_PULL_PUBLISH_PRIORITY = 3600
+# - For every factor of ten subscribers the feed has.
+FEED_PULL_SUBSCRIBER_PRIORITY = 300
+# - For feeds that recently had new entries; this shrinks to nothing as the
+#   time since the last new entry approaches FEED_PULL_CHANGE_WINDOW.
+FEED_PULL_CHANGE_PRIORITY = 600
+FEED_PULL_CHANGE_WINDOW = datetime.timedelta(days=1)
+
 # Maximum number of times to attempt to pull a feed.
 MAX_FEED_PULL_FAILURES = 9
 
 # Period to use for exponential backoff on feed pulling.
 FEED_PULL_RETRY_PERIOD = 60 # seconds
 
+# How long to cache the content hashes of a feed's entries in memcache.
+ENTRY_HASH_CACHE_SECONDS = 86400
+
 # Maximum number of times to attempt to deliver a feed event.
 MAX_DELIVERY_FAILURES = 8
 
-# Period to use for exponential backoff on feed event delivery.
+# Period to use for exponential backoff on feed event delivery. Each failed
+# delivery is retried on its own schedule.
 DELIVERY_RETRY_PERIOD = 60 # seconds
 
+# Number of failed event deliveries to retry at a time.
+DELIVERY_RETRY_CHUNK_SIZE = 20
+
+# Number of consecutive failed deliveries to a subscriber, across all events,
+# after which its subscription is suspended until the subscriber verifies it
+# again, as long as it has also gone this long without a successful delivery.
+SUBSCRIPTION_SUSPEND_FAILURES = 20
+SUBSCRIPTION_SUSPEND_PERIOD = datetime.timedelta(days=1)
+
+# How often to record the time of a subscriber's last successful delivery when
+# it has not failed in between, so healthy subscriptions are not rewritten for
+# every event.
+SUBSCRIPTION_SUCCESS_UPDATE_PERIOD = datetime.timedelta(hours=1)
+
 # Number of polling feeds to fetch from the Datastore at a time.
 BOOSTRAP_FEED_CHUNK_SIZE = 200
 
-# How often to poll feeds.
-POLLING_BOOTSTRAP_PERIOD = 10800  # in seconds; 3 hours
+# How long to wait between polls of a feed, in seconds. Feeds start out with
+# the default interval; it is halved each time a poll finds new entries and
+# doubled each time one does not, within the minimum and maximum.
+DEFAULT_POLL_INTERVAL = 10800  # 3 hours
+MIN_POLL_INTERVAL = 900  # 15 minutes
+MAX_POLL_INTERVAL = 86400  # 1 day
+
+# Feeds whose publisher has sent a publish event within this many seconds are
+# not polled, since they will be fetched when the publisher has new content.
+PUBLISHED_FEED_POLL_DELAY = DEFAULT_POLL_INTERVAL
+
+# Weight given to the latest fetch in the moving average of new entries found
+# per fetch of a feed.
+FETCH_STATS_WEIGHT = 0.2
+
+# How many of the most recently stored FeedEntryRecords to always keep for
+# each topic. Older entries are garbage collected once they have not been
+# stored for ENTRY_RECORD_MAX_AGE and may no longer be in the feed.
+ENTRY_RECORD_MIN_KEEP = 200
+ENTRY_RECORD_MAX_AGE = datetime.timedelta(days=30)
+
+# Version of how the content hashes of FeedEntryRecords are computed; version
+# 1 hashes the entry exactly as it appears in the feed. Feeds hashed by an
+# older version have their entry hashes rewritten on their next parse, without
+# delivering the entries again.
+ENTRY_HASH_VERSION = 1
+
+# Number of FeedRecords to garbage collect entries for in a single request,
+# and the most FeedEntryRecords to delete for a single topic at a time.
+ENTRY_GC_FEED_CHUNK_SIZE = 20
+ENTRY_GC_DELETE_CHUNK_SIZE = 100
+
+# How often to garbage collect old FeedEntryRecords.
+ENTRY_GC_PERIOD = 86400  # in seconds; 1 day
 
 ################################################################################
 # Constants
 
 ATOM = 'atom'
 RSS = 'rss'
+RDF = 'rdf'
+
+async_proxy = async_apiproxy.AsyncAPIProxy(
+    max_in_flight=MAX_ASYNC_CALLS_IN_FLIGHT)
 
 ################################################################################
 # Helper functions
@@ -181,10 +355,102 @@ def get_hash_key_name(value):
   return 'hash_' + sha1_hash(value)
 
 
+def split_batches(items, batch_size=None):
+  """Splits a sequence into lists small enough for a single Datastore call.
+
+  Args:
+    items: Iterable of items (e.g., entities or keys) to split up.
+    batch_size: Maximum length of each list; defaults to MAX_BATCH_SIZE.
+
+  Returns:
+    List of lists of items, in their original order.
+  """
+  if batch_size is None:
+    batch_size = MAX_BATCH_SIZE
+  items = list(items)
+  return [items[i:i + batch_size] for i in xrange(0, len(items), batch_size)]
+
+
+def get_work_shard(value, shard_count):
+  """Returns the work queue shard for a value.
+
+  Args:
+    value: String to shard on (e.g., a topic URL).
+    shard_count: Total number of shards in the work queue.
+
+  Returns:
+    Integer shard number in the range [0, shard_count).
+  """
+  return int(sha1_hash(value)[:8], 16) % shard_count
+
+
+def get_worker_shard(request, shard_count):
+  """Returns the work queue shard a background worker should read from.
+
+  Args:
+    request: The webapp.Request for the worker. Its 'num' parameter is the
+      1-based worker slot number assigned in cron.yaml.
+    shard_count: Total number of shards in the work queue.
+
+  Returns:
+    Integer shard number, or None if the request did not specify a valid
+    worker slot, in which case the worker should read from all shards.
+  """
+  try:
+    num = int(request.get('num', ''))
+  except ValueError:
+    return None
+  if num < 1:
+    return None
+  return (num - 1) % shard_count
+
+
+def backfill_work_shards(entity_list, get_shard):
+  """Assigns work queue shards to entities stored before queues were sharded.
+
+  Workers only read from their own shard, so work items without one would
+  never be processed. Each entity is updated in its own transaction, since
+  workers may be updating it at the same time.
+
+  Args:
+    entity_list: List of db.Model instances with a 'work_shard' property.
+    get_shard: Function that takes one of the entities and returns its shard.
+
+  Returns:
+    The number of entities that were assigned a shard.
+  """
+  count = 0
+  for entity in entity_list:
+    if entity.work_shard is not None:
+      continue
+    def txn():
+      stored = db.get(entity.key())
+      if stored is None or stored.work_shard is not None:
+        return False
+      stored.work_shard = get_shard(stored)
+      stored.put()
+      return True
+    if db.run_in_transaction(txn):
+      count += 1
+  return count
+
+
+def create_lease_token():
+  """Returns a new, unique token used to identify the owner of work leases."""
+  return '%016x' % random.getrandbits(64)
+
+
 def query_and_own(model_class, gql_query, lease_period,
-                  work_count=1, sample_ratio=20, lock_ratio=4, **gql_bindings):
+                  work_count=1, sample_ratio=20, lock_ratio=4,
+                  lease_token=None, in_order=False, **gql_bindings):
   """Query for work to do and temporarily own it.
 
+  Each owned work item has a memcache lock entry keyed by the string version of
+  its Datastore key. The value of that entry is the lease token of the worker
+  that owns it, which lets the worker later release only the leases it
+  actually holds (see release_leases). The token used is also assigned to the
+  'lease_token' attribute of each returned instance.
+
   Args:
     model_class: The db.Model sub-class that contains the work to do.
     gql_query: String containing the GQL query that will retrieve the work
@@ -198,6 +464,12 @@ def query_and_own(model_class, gql_query, lease_period,
     lock_ratio: How many times work_count items to try to lock at a time.
       Increase this ratio if the lease period is low and the overall work
       throughput is high.
+    lease_token: Token identifying the worker taking ownership of the work. If
+      None, a new token will be created with create_lease_token().
+    in_order: If True, try to own the first items returned by the query
+      instead of a random sample of them, so work is done strictly in order
+      of priority. This causes more conflicts when many workers run the same
+      query, so it is best used with sharded work queues.
     **gql_bindings: Any other keyword-based GQL bindings to use in the query
       for more work;
 
@@ -211,7 +483,10 @@ def query_and_own(model_class, gql_query, lease_period,
     could be retrieved. If there is no work left to do or work could not be
     retrieved, this function will return None.
   """
-  sample_size = work_count * sample_ratio
+  if lease_token is None:
+    lease_token = create_lease_token()
+
+  sample_size = min(work_count * sample_ratio, MAX_QUERY_FETCH_SIZE)
   work_to_do = model_class.gql(gql_query, **gql_bindings).fetch(sample_size)
   if not work_to_do:
     if work_count == 1:
@@ -224,23 +499,30 @@ def query_and_own(model_class, gql_query, lease_period,
   # high. If we've acquired more than we can use, we'll just delete the memcache
   # key and unlock the work. This is much better than an iterative solution,
   # since a single locking API call per worker reduces the locking window.
-  possible_work = random.sample(work_to_do,
-      min(len(work_to_do), lock_ratio * work_count))
+  if in_order:
+    possible_work = work_to_do[:lock_ratio * work_count]
+  else:
+    possible_work = random.sample(work_to_do,
+        min(len(work_to_do), lock_ratio * work_count))
   work_map = dict((str(w.key()), w) for w in possible_work)
-  try_lock_map = dict((k, 'owned') for k in work_map)
+  try_lock_map = dict((k, lease_token) for k in work_map)
   not_set_keys = set(memcache.add_multi(try_lock_map, time=lease_period))
   if len(not_set_keys) == len(try_lock_map):
     logging.debug(
         'Conflict; failed to acquire any locks for model %s. Tried: %s',
         model_class.kind(), not_set_keys)
   
-  locked_keys = [k for k in work_map if k not in not_set_keys]
+  locked_keys = [str(w.key()) for w in possible_work
+                 if str(w.key()) not in not_set_keys]
   reset_keys = locked_keys[work_count:]
   if reset_keys and not memcache.delete_multi(reset_keys):
     logging.warning('Could not reset acquired work for model %s: %s',
                     model_class.kind(), reset_keys)
 
   work = [work_map[k] for k in locked_keys[:work_count]]
+  for w in work:
+    w.lease_token = lease_token
+
   if work_count == 1:
     if work:
       return work[0]
@@ -250,6 +532,38 @@ def query_and_own(model_class, gql_query, lease_period,
     return work
 
 
+def _get_owned_lease_keys(work_list):
+  """Returns the lock keys of the work items whose leases are still owned.
+
+  Args:
+    work_list: Iterable of db.Model instances returned by query_and_own().
+
+  Returns:
+    List of memcache lock keys for the items in work_list whose current lock
+    value matches the 'lease_token' attribute of that item.
+  """
+  token_map = dict((str(w.key()), getattr(w, 'lease_token', None))
+                   for w in work_list)
+  current = memcache.get_multi(token_map.keys())
+  return [k for k, token in token_map.iteritems()
+          if token is not None and current.get(k) == token]
+
+
+def release_leases(work_list):
+  """Releases the leases on previously owned work items.
+
+  Only leases that are still held by the owner of each work item will be
+  released, so this is safe to call even if a lease may have expired and been
+  acquired by another worker in the meantime.
+
+  Args:
+    work_list: Iterable of db.Model instances returned by query_and_own().
+  """
+  release_keys = _get_owned_lease_keys(work_list)
+  if release_keys and not memcache.delete_multi(release_keys):
+    logging.warning('Could not release leases: %s', release_keys)
+
+
 def is_dev_env():
   """Returns True if we're running in the development environment."""
   return 'Dev' in os.environ.get('SERVER_SOFTWARE', '')
@@ -305,10 +619,12 @@ class Subscription(db.Model):
   STATE_NOT_VERIFIED = 'not_verified'
   STATE_VERIFIED = 'verified'
   STATE_TO_DELETE = 'to_delete'
+  STATE_SUSPENDED = 'suspended'
   STATES = frozenset([
     STATE_NOT_VERIFIED,
     STATE_VERIFIED,
     STATE_TO_DELETE,
+    STATE_SUSPENDED,
   ])
 
   callback = db.TextProperty(required=True)
@@ -323,6 +639,24 @@ class Subscription(db.Model):
   verify_token = db.TextProperty()
   subscription_state = db.StringProperty(default=STATE_NOT_VERIFIED,
                                          choices=STATES)
+  work_shard = db.IntegerProperty()
+  aggregate = db.BooleanProperty(default=False)  # Use DeliveryBatch
+  delivery_failures = db.IntegerProperty(default=0)  # Consecutive failures
+  last_delivery_success = db.DateTimeProperty()
+
+  @staticmethod
+  def get_work_shard(callback, topic):
+    """Returns the confirmation work queue shard for a Subscription.
+
+    Args:
+      callback: URL of the callback subscriber.
+      topic: URL of the topic being subscribed to.
+
+    Returns:
+      Integer shard number.
+    """
+    return get_work_shard('%s\n%s' % (callback, topic),
+                          SUBSCRIPTION_CONFIRM_SHARDS)
 
   @staticmethod
   def create_key_name(callback, topic):
@@ -338,15 +672,21 @@ class Subscription(db.Model):
     return get_hash_key_name('%s\n%s' % (callback, topic))
 
   @classmethod
-  def insert(cls, callback, topic):
+  def insert(cls, callback, topic, aggregate=False,
+             now=datetime.datetime.utcnow):
     """Marks a callback URL as being subscribed to a topic.
 
     Creates a new subscription if None already exists. Forces any existing,
-    pending request (i.e., async) to immediately enter the verified state.
+    pending request (i.e., async) or suspended subscription to immediately
+    enter the verified state. Either way, the subscription will expire
+    EXPIRATION_DELTA from now.
 
     Args:
       callback: URL that will receive callbacks.
       topic: The topic to subscribe to.
+      aggregate: True if events should be delivered to the callback in
+        batches along with those of its other topics.
+      now: Returns the current time as a UTC datetime.
 
     Returns:
       True if the subscription was newly created, False otherwise.
@@ -362,26 +702,39 @@ class Subscription(db.Model):
                   callback_hash=sha1_hash(callback),
                   topic=topic,
                   topic_hash=sha1_hash(topic),
-                  expiration_time=datetime.datetime.now() + EXPIRATION_DELTA)
+                  work_shard=cls.get_work_shard(callback, topic),
+                  expiration_time=now() + EXPIRATION_DELTA)
+      newly_verified = sub.subscription_state != cls.STATE_VERIFIED
       sub.subscription_state = cls.STATE_VERIFIED
+      sub.aggregate = aggregate
+      # The callback was just verified, so it is reachable again.
+      sub.delivery_failures = 0
+      sub.expiration_time = now() + EXPIRATION_DELTA
       sub.put()
-      return sub_is_new
-    return db.run_in_transaction(txn)
+      return sub_is_new, newly_verified
+    sub_is_new, newly_verified = db.run_in_transaction(txn)
+    if newly_verified:
+      SubscriberCountShard.increment(topic)
+    return sub_is_new
 
   @classmethod
-  def request_insert(cls, callback, topic, verify_token):
+  def request_insert(cls, callback, topic, verify_token, aggregate=False,
+                     now=datetime.datetime.utcnow):
     """Records that a callback URL needs verification before being subscribed.
 
     Creates a new subscription request (for asynchronous verification) if None
     already exists. Any existing subscription request will not be modified;
     for instance, if a subscription has already been verified, this method
-    will do nothing.
+    will do nothing. Suspended subscriptions are verified again.
 
     Args:
       callback: URL that will receive callbacks.
       topic: The topic to subscribe to.
       verify_token: The verification token to use to confirm the
         subscription request.
+      aggregate: True if events should be delivered to the callback in
+        batches along with those of its other topics.
+      now: Returns the current time as a UTC datetime.
 
     Returns:
       True if the subscription request was newly created, False otherwise.
@@ -398,7 +751,16 @@ class Subscription(db.Model):
                   topic=topic,
                   topic_hash=sha1_hash(topic),
                   verify_token=verify_token,
-                  expiration_time=datetime.datetime.now() + EXPIRATION_DELTA)
+                  work_shard=cls.get_work_shard(callback, topic),
+                  expiration_time=now() + EXPIRATION_DELTA,
+                  aggregate=aggregate)
+        sub.put()
+      elif sub.subscription_state == cls.STATE_SUSPENDED:
+        sub.subscription_state = cls.STATE_NOT_VERIFIED
+        sub.verify_token = verify_token
+        sub.eta = now()
+        sub.confirm_failures = 0
+        sub.aggregate = aggregate
         sub.put()
       return sub_is_new
     return db.run_in_transaction(txn)
@@ -422,9 +784,12 @@ class Subscription(db.Model):
       sub = cls.get_by_key_name(key_name)
       if sub is not None:
         sub.delete()
-        return True
-      return False
-    return db.run_in_transaction(txn)
+        return sub.subscription_state
+      return None
+    old_state = db.run_in_transaction(txn)
+    if old_state == cls.STATE_VERIFIED:
+      SubscriberCountShard.increment(topic, -1)
+    return old_state is not None
 
   @classmethod
   def request_remove(cls, callback, topic, verify_token):
@@ -448,12 +813,64 @@ class Subscription(db.Model):
     def txn():
       sub = cls.get_by_key_name(key_name)
       if sub is not None and sub.subscription_state != cls.STATE_TO_DELETE:
+        old_state = sub.subscription_state
         sub.subscription_state = cls.STATE_TO_DELETE
         sub.verify_token = verify_token
+        sub.work_shard = cls.get_work_shard(callback, topic)
         sub.put()
-        return True
-      return False
-    return db.run_in_transaction(txn)
+        return old_state
+      return None
+    old_state = db.run_in_transaction(txn)
+    if old_state == cls.STATE_VERIFIED:
+      # Events are only delivered to verified subscriptions.
+      SubscriberCountShard.increment(topic, -1)
+    return old_state is not None
+
+  @classmethod
+  def remove_expired(cls, now=datetime.datetime.utcnow,
+                     count=SUBSCRIPTION_SWEEP_CHUNK_SIZE):
+    """Deletes subscriptions whose expiration time has passed.
+
+    Subscriptions are checked again inside a transaction before they are
+    deleted, so one renewed after it was found here is left alone.
+
+    Args:
+      now: Returns the current time as a UTC datetime.
+      count: Maximum number of subscriptions to delete.
+
+    Returns:
+      Tuple (found, removed_topics) where:
+        found: Number of expired subscriptions that were found.
+        removed_topics: Set of topic URLs that had a subscription deleted.
+    """
+    now_time = now()
+    query = cls.all()
+    query.filter('expiration_time <=', now_time)
+    query.order('expiration_time')
+    expired_list = query.fetch(count)
+
+    removed_topics = set()
+    for expired in expired_list:
+      def txn():
+        sub = cls.get(expired.key())
+        if sub is not None and sub.expiration_time <= now_time:
+          sub.delete()
+          return sub.subscription_state
+        return None
+      old_state = db.run_in_transaction(txn)
+      if old_state is not None:
+        removed_topics.add(expired.topic)
+      if old_state == cls.STATE_VERIFIED:
+        SubscriberCountShard.increment(expired.topic, -1)
+    return len(expired_list), removed_topics
+
+  def is_expired(self, now=datetime.datetime.utcnow):
+    """Returns True if this subscription's lease has run out.
+
+    Args:
+      now: Returns the current time as a UTC datetime.
+    """
+    return self.expiration_time <= now()
 
   @classmethod
   def has_subscribers(cls, topic):
@@ -465,6 +882,10 @@ class Subscription(db.Model):
     Returns:
       True if it has verified subscribers, False otherwise.
     """
+    if SubscriberCountShard.get_count(topic) > 0:
+      return True
+    # The count is approximate and may not have been reconciled yet after
+    # drifting, so make sure with a query before saying there are none.
     if (cls.all().filter('topic_hash =', sha1_hash(topic))
         .filter('subscription_state = ', cls.STATE_VERIFIED).get() is not None):
       return True
@@ -472,7 +893,8 @@ class Subscription(db.Model):
       return False
 
   @classmethod
-  def get_subscribers(cls, topic, count, starting_at_callback=None):
+  def get_subscribers(cls, topic, count, starting_at_callback=None,
+                      range_start=None, range_end=None):
     """Gets the list of subscribers starting at an offset.
 
     Args:
@@ -482,6 +904,11 @@ class Subscription(db.Model):
         to when retrieving more subscribers. The callback at the given offset
         *will* be included in the results. If None, then subscribers will
         be retrieved from the beginning.
+      range_start: If not None, only subscribers with a callback_hash greater
+        than or equal to this value are retrieved. Ignored when
+        starting_at_callback is supplied.
+      range_end: If not None, only subscribers with a callback_hash less than
+        this value are retrieved.
     
     Returns:
       List of Subscription objects that were found, or an empty list if none
@@ -492,10 +919,74 @@ class Subscription(db.Model):
     query.filter('subscription_state = ', cls.STATE_VERIFIED)
     if starting_at_callback:
       query.filter('callback_hash >=', sha1_hash(starting_at_callback))
+    elif range_start:
+      query.filter('callback_hash >=', range_start)
+    if range_end:
+      query.filter('callback_hash <', range_end)
     query.order('callback_hash')
 
     return query.fetch(count)
 
+  @classmethod
+  def record_deliveries(cls, delivered_list, failed_list,
+                        now=datetime.datetime.utcnow,
+                        max_failures=SUBSCRIPTION_SUSPEND_FAILURES,
+                        suspend_period=SUBSCRIPTION_SUSPEND_PERIOD):
+    """Records the results of delivering events to subscribers.
+
+    Subscriptions that keep failing are suspended; they receive no more events
+    until the subscriber subscribes again and its callback is verified.
+
+    Each subscription is updated in its own transaction, so concurrent
+    removals, renewals, and unsubscriptions are never overwritten. Only
+    verified subscriptions are updated.
+
+    Args:
+      delivered_list: List of Subscription instances that were delivered to.
+      failed_list: List of Subscription instances that could not be
+        delivered to.
+      now: Returns the current time as a UTC datetime.
+      max_failures: Number of consecutive failures after which to suspend a
+        subscription.
+      suspend_period: How long a subscription must go without a successful
+        delivery before it is suspended, as a timedelta.
+
+    Returns:
+      List of the Subscription instances that were suspended.
+    """
+    now_time = now()
+    update_list = [
+        (sub, True) for sub in delivered_list
+        if sub.delivery_failures or sub.last_delivery_success is None or
+           (now_time - sub.last_delivery_success >=
+            SUBSCRIPTION_SUCCESS_UPDATE_PERIOD)]
+    update_list.extend((sub, False) for sub in failed_list)
+
+    suspended_list = []
+    for update, success in update_list:
+      def txn():
+        sub = cls.get(update.key())
+        if sub is None or sub.subscription_state != cls.STATE_VERIFIED:
+          return False
+        if success:
+          sub.delivery_failures = 0
+          sub.last_delivery_success = now_time
+        else:
+          sub.delivery_failures += 1
+          last_success = sub.last_delivery_success or sub.created_time
+          if (sub.delivery_failures >= max_failures and
+              now_time - last_success >= suspend_period):
+            sub.subscription_state = cls.STATE_SUSPENDED
+        sub.put()
+        return sub.subscription_state == cls.STATE_SUSPENDED
+      if db.run_in_transaction(txn):
+        logging.warning('Suspending subscription after %d failed deliveries: '
+                        'callback = %s, topic = %s',
+                        max_failures, update.callback, update.topic)
+        SubscriberCountShard.increment(update.topic, -1)
+        suspended_list.append(update)
+    return suspended_list
+
   def confirm_failed(self, max_failures=MAX_SUBSCRIPTION_CONFIRM_FAILURES,
                      retry_period=SUBSCRIPTION_RETRY_PERIOD,
                      now=datetime.datetime.utcnow):
@@ -519,23 +1010,43 @@ class Subscription(db.Model):
       self.put()
 
   @classmethod
-  def get_confirm_work(cls, now=datetime.datetime.utcnow):
+  def get_confirm_work(cls, now=datetime.datetime.utcnow, shard=None):
     """Retrieves a Subscription to verify or remove asynchronously.
 
     Args:
       now: Returns the current time as a UTC datetime.
+      shard: The work queue shard to retrieve work from, or None to retrieve
+        work from any shard.
 
     Returns:
       A Subscription instance, or None if no work is available. The returned
       instance needs to have its status updated by confirming the subscription
       is still desired by the callback URL.
     """
-    return query_and_own(cls,
-        'WHERE eta <= :now AND subscription_state IN :valid_states '
-        'ORDER BY eta ASC',
-        LEASE_PERIOD_SECONDS,
-        now=now(),
-        valid_states=[cls.STATE_NOT_VERIFIED, cls.STATE_TO_DELETE])
+    query = 'WHERE eta <= :now AND subscription_state IN :valid_states '
+    bindings = dict(now=now(),
+                    valid_states=[cls.STATE_NOT_VERIFIED, cls.STATE_TO_DELETE])
+    if shard is not None:
+      query += 'AND work_shard = :shard '
+      bindings['shard'] = shard
+    return query_and_own(cls, query + 'ORDER BY eta ASC',
+                         LEASE_PERIOD_SECONDS, **bindings)
+
+  @classmethod
+  def backfill(cls, sub_list, now=datetime.datetime.utcnow):
+    """Assigns shards to pending subscriptions stored by older versions.
+
+    Args:
+      sub_list: List of Subscription instances to check.
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      The number of subscriptions that were upgraded.
+    """
+    pending = [s for s in sub_list if s.subscription_state in
+               (cls.STATE_NOT_VERIFIED, cls.STATE_TO_DELETE)]
+    return backfill_work_shards(
+        pending, lambda sub: cls.get_work_shard(sub.callback, sub.topic))
 
 
 class FeedToFetch(db.Model):
@@ -547,8 +1058,11 @@ class FeedToFetch(db.Model):
 
   topic = db.TextProperty(required=True)
   eta = db.DateTimeProperty(auto_now_add=True)
+  priority = db.IntegerProperty(default=0)  # Seconds eta was moved up by.
+  publish = db.BooleanProperty(default=False)  # From a publish event?
   fetching_failures = db.IntegerProperty(default=0)
   totally_failed = db.BooleanProperty(default=False)
+  work_shard = db.IntegerProperty()
 
   @classmethod
   def get_by_topic(cls, topic):
@@ -562,20 +1076,71 @@ class FeedToFetch(db.Model):
     """
     return cls.get_by_key_name(get_hash_key_name(topic))
 
+  @staticmethod
+  def get_priority(publish, subscriber_count, last_changed, now_time):
+    """Determines how much sooner to fetch a feed than other feeds.
+
+    Args:
+      publish: True if the feed is being fetched because of a publish event,
+        False if it is being polled.
+      subscriber_count: Number of subscribers the feed has.
+      last_changed: UTC datetime when new entries were last found in the feed,
+        or None if they never have been.
+      now_time: The current time as a UTC datetime.
+
+    Returns:
+      The priority as a number of seconds to move the feed's eta up by.
+    """
+    priority = 0
+    if publish:
+      priority += FEED_PULL_PUBLISH_PRIORITY
+    if subscriber_count > 0:
+      priority += int(FEED_PULL_SUBSCRIBER_PRIORITY *
+                      math.log10(1 + subscriber_count))
+    if last_changed is not None:
+      age = now_time - last_changed
+      window = FEED_PULL_CHANGE_WINDOW
+      remaining = (1 - float(age.days * 86400 + age.seconds) /
+                       (window.days * 86400 + window.seconds))
+      if remaining > 0:
+        priority += int(FEED_PULL_CHANGE_PRIORITY * remaining)
+    return priority
+
   @classmethod
-  def insert(cls, topic_list):
+  def insert(cls, topic_list, publish=False, now=datetime.datetime.utcnow):
     """Inserts a set of FeedToFetch entities for a set of topics.
 
-    Overwrites any existing entities that are already there.
+    Overwrites any existing entities that are already there. Each feed's eta
+    is moved up by its priority (see get_priority()), so feeds that were
+    published, have many subscribers, or change often are fetched first. The
+    inputs to the priority are taken from memcache where possible, so this
+    does not read any FeedRecords.
 
     Args:
       topic_list: List of the topic URLs of feeds that need to be fetched.
+      publish: True if these feeds are being fetched because of a publish
+        event, False if they are being polled.
+      now: Returns the current time as a UTC datetime.
     """
     if not topic_list:
       return
-    feed_list = [cls(key_name=get_hash_key_name(topic), topic=topic)
-                 for topic in set(topic_list)]
-    db.put(feed_list)
+    topic_list = list(set(topic_list))
+    subscriber_counts = SubscriberCountShard.get_counts(topic_list)
+    last_changed = FeedRecord.get_cached_last_changed(topic_list)
+    now_time = now()
+    feed_list = []
+    for topic in topic_list:
+      priority = cls.get_priority(
+          publish, subscriber_counts[topic], last_changed[topic], now_time)
+      feed_list.append(cls(
+          key_name=get_hash_key_name(topic),
+          topic=topic,
+          eta=now_time - datetime.timedelta(seconds=priority),
+          priority=priority,
+          publish=publish,
+          work_shard=get_work_shard(topic, FEED_PULL_SHARDS)))
+    for feed_batch in split_batches(feed_list):
+      db.put(feed_batch)
 
   def fetch_failed(self, max_failures=MAX_FEED_PULL_FAILURES,
                    retry_period=FEED_PULL_RETRY_PERIOD,
@@ -602,21 +1167,48 @@ class FeedToFetch(db.Model):
       self.put()
 
   @classmethod
-  def get_work(cls, now=datetime.datetime.utcnow):
+  def get_work(cls, now=datetime.datetime.utcnow, shard=None, count=None):
     """Retrieves a feed to fetch and owns it by acquiring a temporary lock.
 
     Args:
       now: Returns the current time as a UTC datetime.
+      shard: The work queue shard to retrieve work from, or None to retrieve
+        work from any shard.
+      count: If not None, retrieve a list of up to this many feeds instead of
+        a single feed.
 
     Returns:
       A FeedToFetch entity that has been owned, or None if there is currently
-      no work to do. Callers should invoke delete() on the entity once the
-      work has been completed.
+      no work to do. If count is supplied, a list of owned FeedToFetch
+      entities, which will be empty if there is no work to do. Callers should
+      invoke delete() on each entity once the work has been completed.
+    """
+    query = 'WHERE eta <= :now AND totally_failed = False '
+    bindings = dict(now=now())
+    if shard is not None:
+      query += 'AND work_shard = :shard '
+      bindings['shard'] = shard
+    work = query_and_own(cls, query + 'ORDER BY eta ASC',
+                         LEASE_PERIOD_SECONDS, work_count=count or 1,
+                         in_order=True, **bindings)
+    if count == 1:
+      # query_and_own() returns a single item when only one is requested.
+      return [w for w in [work] if w is not None]
+    return work
+
+  @classmethod
+  def backfill(cls, feed_list, now=datetime.datetime.utcnow):
+    """Assigns shards to feeds to fetch stored by older versions.
+
+    Args:
+      feed_list: List of FeedToFetch instances to check.
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      The number of feeds that were upgraded.
     """
-    return query_and_own(cls,
-        'WHERE eta <= :now AND totally_failed = False ORDER BY eta ASC',
-        LEASE_PERIOD_SECONDS,
-        now=now())
+    return backfill_work_shards(
+        feed_list, lambda feed: get_work_shard(feed.topic, FEED_PULL_SHARDS))
 
 
 class FeedRecord(db.Model):
@@ -632,6 +1224,23 @@ class FeedRecord(db.Model):
   topic = db.TextProperty(required=True)
   header_footer = db.TextProperty()  # Save this for debugging.
   last_updated = db.DateTimeProperty(auto_now=True)  # The last polling time.
+  last_changed = db.DateTimeProperty()  # When new entries were last found.
+
+  # Feed format detected the last time the feed was parsed.
+  format = db.StringProperty()
+  # Sha1 hash of the body of the feed the last time it was parsed.
+  content_hash = db.StringProperty()
+
+  # Polling statistics.
+  poll_interval = db.IntegerProperty()  # Seconds between polls.
+  fetch_count = db.IntegerProperty(default=0)
+  not_modified_count = db.IntegerProperty(default=0)  # 304s or same content.
+  entries_per_fetch = db.FloatProperty(default=0.0)  # Moving average.
+  last_publish = db.DateTimeProperty()  # Last fetch due to a publish event.
+  # Every entry in the feed as of the last parse was stored at or after this.
+  entries_seen_time = db.DateTimeProperty()
+  # ENTRY_HASH_VERSION of the feed's FeedEntryRecords; None for older ones.
+  entry_hash_version = db.IntegerProperty()
 
   # Content-related headers.
   content_type = db.TextProperty()
@@ -663,7 +1272,69 @@ class FeedRecord(db.Model):
     """
     return cls.get_or_insert(FeedRecord.create_key_name(topic), topic=topic)
 
-  def update(self, headers, header_footer=None):
+  @classmethod
+  def get_or_create_all(cls, topic_list):
+    """Retrieves the FeedRecords for multiple topics in a single batch.
+
+    Unlike get_or_create(), FeedRecords for topics that have not been seen
+    before are created but *not* inserted into the Datastore. This is left to
+    the caller so they can do it as part of a larger batch put().
+
+    Args:
+      topic_list: Iterable of topic URLs to retrieve FeedRecords for.
+
+    Returns:
+      Dictionary mapping each topic URL to its FeedRecord.
+    """
+    topic_list = list(set(topic_list))
+    records = cls.get_by_key_name(
+        [cls.create_key_name(topic) for topic in topic_list])
+    result = {}
+    for topic, record in zip(topic_list, records):
+      if record is None:
+        record = cls(key_name=cls.create_key_name(topic), topic=topic)
+      result[topic] = record
+    return result
+
+  @staticmethod
+  def get_last_changed_cache_key(topic):
+    """Returns the memcache key of when new entries were last found."""
+    return 'last_changed:' + sha1_hash(topic)
+
+  @classmethod
+  def get_cached_last_changed(cls, topic_list):
+    """Gets when new entries were last found in many feeds, from memcache.
+
+    Only feeds that changed within the last FEED_PULL_CHANGE_WINDOW are
+    cached (see cache_last_changed()), since that is all get_priority() uses.
+
+    Args:
+      topic_list: Iterable of topic URLs.
+
+    Returns:
+      Dictionary mapping each topic URL to a UTC datetime, or None if it is
+      not cached.
+    """
+    cache_keys = dict((cls.get_last_changed_cache_key(topic), topic)
+                      for topic in set(topic_list))
+    cached = memcache.get_multi(cache_keys.keys())
+    return dict((topic, cached.get(key))
+                for key, topic in cache_keys.iteritems())
+
+  def cache_last_changed(self):
+    """Caches when new entries were last found in this feed.
+
+    Should only be called once this FeedRecord has been stored.
+    """
+    if self.last_changed is None:
+      return
+    window = FEED_PULL_CHANGE_WINDOW
+    memcache.set(self.get_last_changed_cache_key(self.topic),
+                 self.last_changed,
+                 time=window.days * 86400 + window.seconds)
+
+  def update(self, headers, header_footer=None, format=None,
+             content_hash=None):
     """Updates the polling record of this feed.
 
     This method will *not* insert this instance into the Datastore.
@@ -673,12 +1344,99 @@ class FeedRecord(db.Model):
         to determine how to poll the feed in the future.
       header_footer: Contents of the feed's XML document minus the entry data;
         if not supplied, the old value will remain.
+      format: Format the feed was successfully parsed as; if not supplied, the
+        old value will remain.
+      content_hash: Sha1 hash of the feed body that was parsed; if not
+        supplied, the old value will remain.
     """
     self.content_type = headers.get('Content-Type', '').lower()
     self.last_modified = headers.get('Last-Modified')
     self.etag = headers.get('ETag')
     if header_footer is not None:
       self.header_footer = header_footer
+    if format is not None:
+      self.format = format
+    if content_hash is not None:
+      self.content_hash = content_hash
+
+  def record_fetch(self, new_entries, not_modified=False, publish=False,
+                   now=datetime.datetime.utcnow):
+    """Updates the polling statistics of this feed after fetching it.
+
+    This method will *not* insert this instance into the Datastore.
+
+    Args:
+      new_entries: Number of new or updated entries that were found.
+      not_modified: True if the feed had not changed at all since the last
+        fetch (e.g., a 304 response or an identical body).
+      publish: True if the feed was fetched because of a publish event.
+      now: Returns the current time as a UTC datetime.
+    """
+    now_time = now()
+    self.fetch_count += 1
+    if not_modified:
+      self.not_modified_count += 1
+    self.entries_per_fetch += (
+        FETCH_STATS_WEIGHT * (new_entries - self.entries_per_fetch))
+    if publish:
+      self.last_publish = now_time
+
+    interval = self.poll_interval or DEFAULT_POLL_INTERVAL
+    if new_entries:
+      self.last_changed = now_time
+      interval //= 2
+    else:
+      interval *= 2
+    self.poll_interval = max(MIN_POLL_INTERVAL,
+                             min(interval, MAX_POLL_INTERVAL))
+
+  def get_next_poll_time(self, now=datetime.datetime.utcnow):
+    """Returns when this feed should be polled next.
+
+    Args:
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      UTC datetime of the next poll, which may be in the past.
+    """
+    now_time = now()
+    if self.fetch_count:
+      interval = self.poll_interval or DEFAULT_POLL_INTERVAL
+      next_poll = self.last_updated + datetime.timedelta(seconds=interval)
+    else:
+      next_poll = now_time
+    if self.last_publish is not None:
+      next_poll = max(next_poll, self.last_publish +
+                      datetime.timedelta(seconds=PUBLISHED_FEED_POLL_DELAY))
+    return next_poll
+
+  def is_poll_due(self, now=datetime.datetime.utcnow):
+    """Returns True if this feed should be polled again.
+
+    Args:
+      now: Returns the current time as a UTC datetime.
+    """
+    return self.get_next_poll_time(now=now) <= now()
+
+  def guess_format(self, content):
+    """Determines which format to parse a newly fetched copy of the feed as.
+
+    Args:
+      content: The body of the feed that was fetched.
+
+    Returns:
+      ATOM, RSS, or RDF. The format is detected from the root element of the
+      document if possible; otherwise the format the feed was last parsed as
+      is used, falling back to a guess from its content-type.
+    """
+    format = feed_diff.detect_format(content)
+    if format:
+      return format
+    if self.format:
+      return self.format
+    if 'rss' in (self.content_type or ''):
+      return RSS
+    return ATOM
 
   def get_request_headers(self):
     """Returns the request headers that should be used to pull this feed.
@@ -704,7 +1462,7 @@ class FeedEntryRecord(db.Model):
   entry_id = db.TextProperty(required=True)  # To allow 500+ length entry IDs.
   entry_id_hash = db.StringProperty(required=True)
   entry_content_hash = db.StringProperty()
-  update_time = db.DateTimeProperty(auto_now=True)
+  update_time = db.DateTimeProperty(auto_now=True)  # When last stored.
 
   @classmethod
   def create_key(cls, topic, entry_id):
@@ -739,6 +1497,69 @@ class FeedEntryRecord(db.Model):
     # Filter out those pesky Nones.
     return [r for r in results if r]
 
+  @staticmethod
+  def get_cache_key(topic):
+    """Returns the memcache key of the entry content hash cache for a topic."""
+    return 'entry_hashes:' + sha1_hash(topic)
+
+  @classmethod
+  def get_content_hashes(cls, topic, entry_id_list):
+    """Gets the content hashes of a topic's entries that have been seen before.
+
+    Hashes are read from a per-topic memcache entry that maps entry_id_hash to
+    content hash; only entries missing from the cache are retrieved from the
+    Datastore. The cache is then rewritten to contain just the given entries,
+    so entries that have dropped out of the feed do not accumulate in it.
+
+    Args:
+      topic: The topic URL to retrieve content hashes for.
+      entry_id_list: Sequence of entry_ids to retrieve content hashes for.
+
+    Returns:
+      Dictionary mapping entry_id to the content hash of the entry when it was
+      last stored, for each entry that has been stored before.
+    """
+    cache_key = cls.get_cache_key(topic)
+    cached = memcache.get(cache_key) or {}
+
+    result = {}
+    missing = []
+    for entry_id in entry_id_list:
+      content_hash = cached.get(sha1_hash(entry_id))
+      if content_hash is None:
+        missing.append(entry_id)
+      else:
+        result[entry_id] = content_hash
+
+    if missing:
+      for entry in cls.get_entries_for_topic(topic, missing):
+        result[entry.entry_id] = entry.entry_content_hash
+
+    new_cached = dict((sha1_hash(entry_id), content_hash)
+                      for entry_id, content_hash in result.iteritems())
+    if new_cached != cached:
+      memcache.set(cache_key, new_cached, time=ENTRY_HASH_CACHE_SECONDS)
+    return result
+
+  @classmethod
+  def cache_content_hashes(cls, topic, entry_list):
+    """Adds newly stored entries to the content hash cache for a topic.
+
+    Should only be called once the entries have been committed, so the cache
+    never claims an entry has been seen when it has not.
+
+    Args:
+      topic: The topic URL the entries belong to.
+      entry_list: List of FeedEntryRecords that were stored.
+    """
+    if not entry_list:
+      return
+    cache_key = cls.get_cache_key(topic)
+    cached = memcache.get(cache_key) or {}
+    for entry in entry_list:
+      cached[entry.entry_id_hash] = entry.entry_content_hash
+    memcache.set(cache_key, cached, time=ENTRY_HASH_CACHE_SECONDS)
+
   @classmethod
   def create_entry_for_topic(cls, topic, entry_id, content_hash):
     """Creates multiple FeedEntryRecords entities for a topic.
@@ -765,6 +1586,52 @@ class FeedEntryRecord(db.Model):
                entry_content_hash=content_hash)
 
 
+class EventPayload(db.Model):
+  """Represents the body of an event that is delivered to subscribers.
+
+  Payloads are content-addressed: the key name of this entity is a
+  get_hash_key_name() hash of the payload, and its parent is the FeedRecord
+  for the topic. Every EventToDeliver for the same content refers to a single
+  EventPayload instead of storing its own copy.
+  """
+
+  payload = db.TextProperty(required=True)
+
+  @classmethod
+  def create_key(cls, topic, payload_hash):
+    """Creates a new Key for an EventPayload entity.
+
+    Args:
+      topic: The topic URL the payload was published to.
+      payload_hash: Sha1 hash of the payload.
+
+    Returns:
+      Key instance for this EventPayload.
+    """
+    return db.Key.from_path(
+        FeedRecord.kind(),
+        FeedRecord.create_key_name(topic),
+        cls.kind(),
+        'hash_' + payload_hash)
+
+  @classmethod
+  def create_payload_for_topic(cls, topic, payload):
+    """Creates an EventPayload for a topic.
+
+    Does not actually insert the entity into the Datastore. This is left to
+    the caller so they can do it as part of a larger batch put().
+
+    Args:
+      topic: The topic URL the payload was published to.
+      payload: The payload to deliver to subscribers.
+
+    Returns:
+      A new EventPayload that should be inserted into the Datastore.
+    """
+    key = cls.create_key(topic, sha1_hash(payload))
+    return cls(key_name=key.name(), parent=key.parent(), payload=payload)
+
+
 class EventToDeliver(db.Model):
   """Represents a publishing event to deliver to subscribers.
   
@@ -781,6 +1648,12 @@ class EventToDeliver(db.Model):
   Later, when the feed puller comes through to grab feed diffs, it should insert
   a single event to deliver, collapsing any overlapping publish events during
   the delay from publish time to feed pulling time.
+
+  Subscribers that could not be reached are recorded as FailedCallback child
+  entities, each of which is retried on its own schedule by a separate
+  worker. Once every subscriber has been contacted the event enters retry
+  mode, where it only holds on to the payload until all of its failed
+  callbacks have been delivered.
   """
   
   DELIVERY_MODES = ('normal', 'retry')
@@ -789,13 +1662,20 @@ class EventToDeliver(db.Model):
 
   topic = db.TextProperty(required=True)
   topic_hash = db.StringProperty(required=True)
-  payload = db.TextProperty(required=True)
+  payload = db.TextProperty()  # Only set for events stored inline.
+  payload_hash = db.StringProperty()  # Refers to an EventPayload.
   last_callback = db.TextProperty(default='')  # For paging Subscriptions
-  failed_callbacks = db.ListProperty(db.Key)  # Refs to Subscription entities
+  failed_count = db.IntegerProperty(default=0)  # Number of FailedCallbacks
+  # Subscription keys that failed, as stored by older versions.
+  failed_callbacks = db.ListProperty(db.Key)
   delivery_mode = db.StringProperty(default=NORMAL, choices=DELIVERY_MODES)
-  retry_attempts = db.IntegerProperty(default=0)
   last_modified = db.DateTimeProperty(required=True)
-  totally_failed = db.BooleanProperty(default=False)
+  work_shard = db.IntegerProperty()
+  # Range of callback hashes this event delivers to; empty means unbounded.
+  range_start = db.StringProperty(default='')
+  range_end = db.StringProperty(default='')
+  # Number of verified subscribers seen so far during normal delivery.
+  subscriber_count = db.IntegerProperty(default=0)
 
   @classmethod
   def create_event_for_topic(cls, topic, format, header_footer, entry_payloads,
@@ -804,7 +1684,7 @@ class EventToDeliver(db.Model):
     
     Args:
       topic: The topic that had the event.
-      format: Format of the feed, either 'atom' or 'rss'.
+      format: Format of the feed, either 'atom', 'rss', or 'rdf'.
       header_footer: The header and footer of the published feed into which
         the entry list will be spliced.
       entry_payloads: List of strings containing entry payloads (i.e., all
@@ -813,12 +1693,17 @@ class EventToDeliver(db.Model):
       now: Returns the current time as a UTC datetime.
     
     Returns:
-      A new EventToDeliver instance that has not been stored.
+      Tuple (event, event_payload) of a new EventToDeliver instance and the
+      EventPayload it refers to, neither of which have been stored.
     """
     if format == ATOM:
       close_tag = '</feed>'
     elif format == RSS:
       close_tag = '</channel>'
+    elif format == RDF:
+      # Items are direct children of the root element, which may use any
+      # namespace prefix.
+      close_tag = '</'
     else:
       assert False, 'Invalid format "%s"' % format
     
@@ -830,20 +1715,103 @@ class EventToDeliver(db.Model):
     payload_list.append(header_footer[close_index:])
     payload = '\n'.join(payload_list)
 
-    return cls(
-        parent=db.Key.from_path(
-            FeedRecord.kind(), FeedRecord.create_key_name(topic)),
+    event_payload = EventPayload.create_payload_for_topic(topic, payload)
+    event = cls(
+        parent=event_payload.parent_key(),
         topic=topic,
         topic_hash=sha1_hash(topic),
-        payload=payload,
-        last_modified=now())
+        payload_hash=sha1_hash(payload),
+        last_modified=now(),
+        work_shard=get_work_shard(topic, EVENT_DELIVERY_SHARDS))
+    return event, event_payload
 
-  def get_next_subscribers(self, chunk_size=None):
-    """Retrieve the next set of subscribers to attempt delivery for this event.
+  def get_payload(self):
+    """Retrieves the payload to deliver for this event.
 
-    Args:
-      chunk_size: How many subscribers to retrieve at a time while delivering
-        the event. Defaults to EVENT_SUBSCRIBER_CHUNK_SIZE.
+    Returns:
+      The payload string, or None if this event's EventPayload is missing.
+    """
+    if self.payload is not None:
+      return self.payload
+    event_payload = EventPayload.get(
+        EventPayload.create_key(self.topic, self.payload_hash))
+    if event_payload is None:
+      return None
+    return event_payload.payload
+
+  def convert_failed_callbacks(self, now=datetime.datetime.utcnow):
+    """Moves failed callbacks stored by older versions into FailedCallbacks.
+
+    Events written before FailedCallback existed kept the keys of the
+    Subscriptions they could not deliver to in a list. Those subscribers are
+    given FailedCallbacks that are due to be retried right away; ones whose
+    subscription has since been removed are dropped.
+
+    Args:
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      True if this event had failed callbacks to convert, False otherwise.
+    """
+    if not self.failed_callbacks:
+      return False
+    subscription_list = [s for s in db.get(self.failed_callbacks)
+                         if s is not None]
+    failed_list = [FailedCallback.create(self, sub, now=now, retry_period=0)
+                   for sub in subscription_list]
+
+    def txn():
+      event = db.get(self.key())
+      if event is None or not event.failed_callbacks:
+        return None
+      if failed_list:
+        existing = db.get([f.key() for f in failed_list])
+        event.failed_count += len([e for e in existing if e is None])
+      event.failed_callbacks = []
+      db.put([event] + failed_list)
+      return event
+    event = db.run_in_transaction(txn)
+    if event is not None:
+      logging.info('Converted %d failed callbacks for topic = %s',
+                   len(failed_list), self.topic)
+      self.failed_count = event.failed_count
+    self.failed_callbacks = []
+    return True
+
+  @classmethod
+  def backfill(cls, event_list, now=datetime.datetime.utcnow):
+    """Upgrades events stored by older versions.
+
+    Events that are already in retry mode are never leased by the push worker,
+    so their failed callbacks would otherwise never be converted. Events
+    without a work shard are given one.
+
+    Args:
+      event_list: List of EventToDeliver instances to check.
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      The number of events that were upgraded.
+    """
+    converted = len([e for e in event_list
+                     if e.convert_failed_callbacks(now=now)])
+    return converted + backfill_work_shards(
+        event_list,
+        lambda event: get_work_shard(event.topic, EVENT_DELIVERY_SHARDS))
+
+  def get_next_subscribers(self, chunk_size=None,
+                           now=datetime.datetime.utcnow):
+    """Retrieve the next set of subscribers to attempt delivery for this event.
+
+    Only used in normal delivery mode; failed deliveries are retried through
+    FailedCallback instead. Subscriptions that have expired but have not yet
+    been swept away are skipped; they still count towards the chunk size so
+    paging through the subscribers is not affected.
+
+    Args:
+      chunk_size: How many subscribers to retrieve at a time while delivering
+        the event. Defaults to EVENT_SUBSCRIBER_CHUNK_SIZE.
+      now: Returns the current time as a UTC datetime.
     
     Returns:
       Tuple (more_subscribers, subscription_list) where:
@@ -856,56 +1824,98 @@ class EventToDeliver(db.Model):
     if chunk_size is None:
       chunk_size = EVENT_SUBSCRIBER_CHUNK_SIZE
 
-    if self.delivery_mode == EventToDeliver.NORMAL:
-      all_subscribers = Subscription.get_subscribers(
-          self.topic, chunk_size + 1, starting_at_callback=self.last_callback)
-      if all_subscribers:
-        self.last_callback = all_subscribers[-1].callback
-      else:
-        self.last_callback = ''
-
-      more_subscribers = len(all_subscribers) > chunk_size
-      subscription_list = all_subscribers[:chunk_size]
-    elif self.delivery_mode == EventToDeliver.RETRY:
-      next_chunk = self.failed_callbacks[:chunk_size]
-      more_subscribers = len(self.failed_callbacks) > len(next_chunk)
-
-      if self.last_callback:
-        # If the final index is present in the next chunk, that means we've
-        # wrapped back around to the beginning and will need to do more
-        # exponential backoff. This also requires updating the last_callback
-        # in the update() method, since we do not know which callbacks from
-        # the next chunk will end up failing.
-        final_subscription_key = datastore_types.Key.from_path(
-            Subscription.__name__,
-            Subscription.create_key_name(self.last_callback, self.topic))
-        try:
-          final_index = next_chunk.index(final_subscription_key)
-        except ValueError:
-          pass
-        else:
-          more_subscribers = False
-          next_chunk = next_chunk[:final_index]
-
-      subscription_list = [x for x in db.get(next_chunk) if x is not None]
-      if subscription_list and not self.last_callback:
-        # This must be the first time through the current iteration where we do
-        # not yet know a sentinal value in the list that represents the starting
-        # point.
-        self.last_callback = subscription_list[0].callback
+    all_subscribers = Subscription.get_subscribers(
+        self.topic, chunk_size + 1, starting_at_callback=self.last_callback,
+        range_start=self.range_start, range_end=self.range_end)
+    if all_subscribers:
+      self.last_callback = all_subscribers[-1].callback
+    else:
+      self.last_callback = ''
 
-      # If the failed callbacks fail again, they will be added back to the
-      # end of the list.
-      self.failed_callbacks = self.failed_callbacks[len(next_chunk):]
+    more_subscribers = len(all_subscribers) > chunk_size
+    subscription_list = all_subscribers[:chunk_size]
+    self.subscriber_count += len(subscription_list)
 
+    subscription_list = [s for s in subscription_list if not s.is_expired(now)]
     return more_subscribers, subscription_list
 
+  def get_total_subscribers(self, more_subscribers):
+    """Returns the total number of subscribers to this event's topic, if known.
+
+    The total is only known once normal delivery of an event that covers all
+    of the topic's subscribers (i.e., one that was never split into ranges)
+    has paged through the last of them.
+
+    Args:
+      more_subscribers: The value returned by the last call to
+        get_next_subscribers().
+
+    Returns:
+      The number of verified subscribers seen, or None if it is not known.
+    """
+    if (self.delivery_mode != EventToDeliver.NORMAL or more_subscribers or
+        self.range_start or self.range_end):
+      return None
+    return self.subscriber_count
+
+  def split_fanout(self, range_count, now=datetime.datetime.utcnow):
+    """Splits the undelivered subscribers of this event into separate ranges.
+
+    The remaining callback hash space, starting at the current cursor, is
+    divided into 'range_count' ranges of equal width. This event keeps the
+    first range; a new EventToDeliver is created for each of the others so
+    they can be leased and delivered independently by other workers.
+
+    Only events in normal delivery mode that have not already been split are
+    split; for any others this does nothing. This event must be updated and
+    the new events stored at the same time, which update() can do atomically.
+
+    Args:
+      range_count: How many ranges to split the remaining subscribers into.
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      List of new EventToDeliver instances that have not been stored.
+    """
+    if (range_count < 2 or self.delivery_mode != EventToDeliver.NORMAL or
+        self.range_start or self.range_end or not self.last_callback):
+      return []
+
+    # Boundaries only use the first 32 bits of the hash; any hash starting
+    # with a boundary's prefix sorts after that boundary.
+    cursor_hash = sha1_hash(self.last_callback)
+    low = int(cursor_hash[:8], 16)
+    high = 16 ** 8
+    boundaries = []
+    for i in xrange(1, range_count):
+      boundary = '%08x' % (low + (high - low) * i // range_count)
+      if boundary > (boundaries and boundaries[-1] or cursor_hash):
+        boundaries.append(boundary)
+    if not boundaries:
+      return []
+
+    self.range_end = boundaries[0]
+    new_events = []
+    for start, end in zip(boundaries, boundaries[1:] + ['']):
+      new_events.append(EventToDeliver(
+          parent=self.parent_key(),
+          topic=self.topic,
+          topic_hash=self.topic_hash,
+          payload=self.payload,
+          payload_hash=self.payload_hash,
+          last_modified=now(),
+          range_start=start,
+          range_end=end,
+          work_shard=get_work_shard('%s\n%s' % (self.topic, start),
+                                    EVENT_DELIVERY_SHARDS)))
+    return new_events
+
   def update(self,
              more_callbacks,
              more_failed_callbacks,
              now=datetime.datetime.utcnow,
-             max_failures=MAX_DELIVERY_FAILURES,
-             retry_period=DELIVERY_RETRY_PERIOD):
+             retry_period=DELIVERY_RETRY_PERIOD,
+             new_events=None):
     """Updates an event with work progress or deletes it if it's done.
     
     Also deletes the ownership memcache entry for this work item so it will
@@ -915,61 +1925,749 @@ class EventToDeliver(db.Model):
       more_callbacks: True if there are more callbacks to deliver, False if
         there are no more subscribers to deliver for this feed.
       more_failed_callbacks: Iterable of Subscription entities for this event
-        that failed to deliver.
-      max_failures: Maximum failures to allow before giving up.
-      retry_period: Initial period for doing exponential (base-2) backoff.
+        that failed to deliver. A FailedCallback is stored for each one.
       now: Returns the current time as a UTC datetime.
+      retry_period: How long to wait before the first retry of each failed
+        delivery, in seconds.
+      new_events: Optional list of new EventToDeliver instances for the same
+        topic (e.g., from split_fanout()) to store in the same transaction
+        that updates or deletes this event.
     """
     self.last_modified = now()
-
-    # Ensure the list of failed callbacks is in sorted order so we keep track
-    # of the last callback seen in alphabetical order of callback URL hashes.
-    more_failed_callbacks = sorted(more_failed_callbacks,
-                                   key=lambda x: x.callback_hash)
-
-    self.failed_callbacks.extend(e.key() for e in more_failed_callbacks)
-    if not more_callbacks and not self.failed_callbacks:
-      logging.info('EventToDeliver complete: topic = %s, delivery_mode = %s',
-                   self.topic, self.delivery_mode)
-      self.delete()
-      return
-    elif not more_callbacks:
+    if not more_callbacks:
       self.last_callback = ''
-      retry_delay = retry_period * (2 ** self.retry_attempts)
-      self.last_modified += datetime.timedelta(seconds=retry_delay)
-      self.retry_attempts += 1
-      if self.retry_attempts > max_failures:
-        self.totally_failed = True
+      self.delivery_mode = EventToDeliver.RETRY
+    failed_list = [FailedCallback.create(self, sub, now=now,
+                                         retry_period=retry_period)
+                   for sub in more_failed_callbacks]
+
+    def txn():
+      # Failed callbacks may have been retried since this event was
+      # retrieved, so the stored count is the one to add to.
+      stored = db.get(self.key())
+      if stored is not None:
+        self.failed_count = stored.failed_count
+      self.failed_count += len(failed_list)
+      if not more_callbacks and not self.failed_count:
+        self.delete()
+        if new_events:
+          db.put(new_events)
+        return True
+      db.put([self] + (new_events or []) + failed_list)
+      return False
+    complete = db.run_in_transaction(txn)
 
-      if self.delivery_mode == EventToDeliver.NORMAL:
+    if complete:
+      logging.info('EventToDeliver complete: topic = %s', self.topic)
+      if not new_events:
+        self._delete_unused_payload()
+    else:
+      if not more_callbacks:
         logging.info('Normal delivery done; %d broken callbacks remain',
-                     len(self.failed_callbacks))
-        self.delivery_mode = EventToDeliver.RETRY
-      else:        
-        logging.info('End of attempt %d; topic = %s, subscribers = %d, '
-                     'waiting until %s or totally_failed = %s',
-                     self.retry_attempts, self.topic,
-                     len(self.failed_callbacks), self.last_modified,
-                     self.totally_failed)
-
-    self.put()
-    memcache.delete(str(self.key()))
+                     self.failed_count)
+      release_leases([self])
+
+  @classmethod
+  def record_retries(cls, event_key, delivered_list, failed_list,
+                     now=datetime.datetime.utcnow,
+                     max_failures=MAX_DELIVERY_FAILURES,
+                     retry_period=DELIVERY_RETRY_PERIOD):
+    """Records the results of retrying some of an event's failed callbacks.
+
+    Delivered callbacks are deleted, and the event along with them once it
+    has no more failed callbacks and normal delivery is done. The others are
+    scheduled for their next retry with exponential backoff, or given up on
+    after too many failures.
+
+    Args:
+      event_key: Key of the EventToDeliver the failed callbacks belong to.
+      delivered_list: List of FailedCallback instances for this event that
+        were delivered or no longer need to be.
+      failed_list: List of FailedCallback instances for this event that
+        failed again.
+      now: Returns the current time as a UTC datetime.
+      max_failures: Maximum failures to allow before giving up on a callback.
+      retry_period: Initial period for doing exponential (base-2) backoff.
+
+    Returns:
+      True if the event was deleted, False otherwise.
+    """
+    for failed in failed_list:
+      retry_delay = retry_period * (2 ** failed.retry_attempts)
+      failed.eta = now() + datetime.timedelta(seconds=retry_delay)
+      failed.retry_attempts += 1
+      if failed.retry_attempts > max_failures:
+        logging.warning('Giving up on delivery to callback = %s',
+                        failed.callback)
+        failed.totally_failed = True
+
+    def txn():
+      event = db.get(event_key)
+      if delivered_list:
+        db.delete([f.key() for f in delivered_list])
+      if event is None:
+        if failed_list:
+          db.put(failed_list)
+        return None
+      event.failed_count = max(0, event.failed_count - len(delivered_list))
+      if (event.delivery_mode == cls.RETRY and not event.failed_count and
+          not event.failed_callbacks):
+        event.delete()
+        return event
+      db.put([event] + failed_list)
+      return None
+    deleted_event = db.run_in_transaction(txn)
+    if deleted_event is not None:
+      logging.info('EventToDeliver complete: topic = %s', deleted_event.topic)
+      deleted_event._delete_unused_payload()
+      return True
+    return False
+
+  def _delete_unused_payload(self):
+    """Deletes this event's EventPayload if no other events still refer to it.
+
+    Should be called after this event has been deleted. The check and delete
+    are done in a transaction on the FeedRecord's entity group, which all
+    events and payloads for the topic share, so a new event referring to the
+    same payload cannot be written in between.
+    """
+    if not self.payload_hash:
+      return
+    def txn():
+      query = EventToDeliver.all(keys_only=True)
+      query.ancestor(self.parent_key())
+      query.filter('payload_hash =', self.payload_hash)
+      if query.get() is None:
+        db.delete(EventPayload.create_key(self.topic, self.payload_hash))
+    db.run_in_transaction(txn)
 
   @classmethod
-  def get_work(cls, now=datetime.datetime.utcnow):
+  def get_work(cls, now=datetime.datetime.utcnow, shard=None):
     """Retrieves a pending event to deliver.
 
     Args:
       now: Returns the current time as a UTC datetime.
+      shard: The work queue shard to retrieve work from, or None to retrieve
+        work from any shard.
 
     Returns:
       An EventToDeliver instance, or None if no work is available.
     """
-    return query_and_own(cls,
-        'WHERE last_modified <= :now AND totally_failed = False '
-        'ORDER BY last_modified ASC',
-        LEASE_PERIOD_SECONDS,
-        now=now())
+    query = 'WHERE delivery_mode = :mode AND last_modified <= :now '
+    bindings = dict(mode=cls.NORMAL, now=now())
+    if shard is not None:
+      query += 'AND work_shard = :shard '
+      bindings['shard'] = shard
+    return query_and_own(cls, query + 'ORDER BY last_modified ASC',
+                         LEASE_PERIOD_SECONDS, **bindings)
+
+
+class FailedCallback(db.Model):
+  """A subscriber that an event could not be delivered to.
+
+  Each one is retried on its own schedule, backing off exponentially, so a
+  subscriber that was only briefly unavailable gets the event soon while one
+  that is down for good does not hold up the others. These are child entities
+  of their EventToDeliver, which keeps the payload until they have all been
+  delivered. The key_name is the hash of the callback URL, which is unique
+  among the subscribers to the event's topic.
+  """
+
+  callback = db.TextProperty(required=True)
+  callback_hash = db.StringProperty(required=True)
+  eta = db.DateTimeProperty(required=True)
+  retry_attempts = db.IntegerProperty(default=0)
+  totally_failed = db.BooleanProperty(default=False)
+  work_shard = db.IntegerProperty()
+
+  @classmethod
+  def create_key(cls, event, callback):
+    """Creates a key for a FailedCallback.
+
+    Args:
+      event: The EventToDeliver that could not be delivered.
+      callback: URL of the subscriber's callback.
+
+    Returns:
+      Key instance for this FailedCallback.
+    """
+    return datastore_types.Key.from_path(
+        cls.kind(), get_hash_key_name(callback), parent=event.key())
+
+  @classmethod
+  def create(cls, event, subscription, now=datetime.datetime.utcnow,
+             retry_period=DELIVERY_RETRY_PERIOD):
+    """Creates a FailedCallback for a subscriber that was not delivered to.
+
+    Does not actually insert the entity into the Datastore. This is left to
+    the caller so they can do it as part of a larger batch put().
+
+    Args:
+      event: The EventToDeliver that could not be delivered.
+      subscription: The Subscription that could not be delivered to.
+      now: Returns the current time as a UTC datetime.
+      retry_period: How long to wait before the first retry, in seconds.
+
+    Returns:
+      A new FailedCallback instance.
+    """
+    return cls(key_name=get_hash_key_name(subscription.callback),
+               parent=event,
+               callback=subscription.callback,
+               callback_hash=subscription.callback_hash,
+               eta=now() + datetime.timedelta(seconds=retry_period),
+               work_shard=get_work_shard(subscription.callback,
+                                         DELIVERY_RETRY_SHARDS))
+
+  @classmethod
+  def get_work(cls, now=datetime.datetime.utcnow, shard=None, count=1):
+    """Retrieves failed callbacks that are due to be retried and owns them.
+
+    Args:
+      now: Returns the current time as a UTC datetime.
+      shard: The work queue shard to retrieve work from, or None to retrieve
+        work from any shard.
+      count: Maximum number of failed callbacks to retrieve.
+
+    Returns:
+      List of owned FailedCallback entities, which will be empty if none are
+      due. Callers should pass them to EventToDeliver.record_retries().
+    """
+    query = 'WHERE eta <= :now AND totally_failed = False '
+    bindings = dict(now=now())
+    if shard is not None:
+      query += 'AND work_shard = :shard '
+      bindings['shard'] = shard
+    work = query_and_own(cls, query + 'ORDER BY eta ASC',
+                         LEASE_PERIOD_SECONDS, work_count=count, **bindings)
+    if count == 1:
+      # query_and_own() returns a single item when only one is requested.
+      return [w for w in [work] if w is not None]
+    return work
+
+  def get_subscription_key(self, topic):
+    """Returns the key of the Subscription that could not be delivered to.
+
+    Args:
+      topic: The topic URL of the event.
+    """
+    return datastore_types.Key.from_path(
+        Subscription.kind(), Subscription.create_key_name(self.callback, topic))
+
+
+class DeliveryStats(db.Model):
+  """Tracks how quickly events for a topic are delivered to subscribers.
+
+  The push worker uses these stats to decide how many subscribers to contact
+  in a single request, so topics with many fast subscribers need far fewer
+  requests to deliver each event. The key_name is the hash of the topic URL.
+  """
+
+  topic = db.TextProperty(required=True)
+  chunk_size = db.IntegerProperty(required=True)
+  last_elapsed = db.FloatProperty()
+  deadline_errors = db.IntegerProperty(default=0)
+  last_modified = db.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def get_or_create(cls, topic):
+    """Retrieves the DeliveryStats for a topic or creates them if non-existent.
+
+    Args:
+      topic: The topic URL to retrieve stats for.
+
+    Returns:
+      The DeliveryStats instance for this topic. New instances start with a
+      chunk size of EVENT_SUBSCRIBER_CHUNK_SIZE and have not been stored.
+    """
+    key_name = get_hash_key_name(topic)
+    stats = cls.get_by_key_name(key_name)
+    if stats is None:
+      stats = cls(key_name=key_name, topic=topic,
+                  chunk_size=EVENT_SUBSCRIBER_CHUNK_SIZE)
+    return stats
+
+  def get_chunk_size(self):
+    """Returns how many subscribers to contact in the next delivery request."""
+    return max(1, min(self.chunk_size, MAX_EVENT_SUBSCRIBER_CHUNK_SIZE))
+
+  def record_delivery(self, chunk_size, full_chunk, elapsed,
+                      deadline_exceeded=False):
+    """Adjusts the chunk size based on how a delivery attempt went.
+
+    Does not store the updated stats; the caller should put() them.
+
+    Args:
+      chunk_size: The chunk size that was used for the delivery.
+      full_chunk: True if the whole chunk was used, meaning there were more
+        subscribers to contact afterwards. Only full chunks may grow the chunk
+        size, since smaller ones say nothing about larger deliveries.
+      elapsed: How long the delivery took, in seconds.
+      deadline_exceeded: True if the request deadline was hit before all
+        deliveries in the chunk completed.
+    """
+    self.last_elapsed = float(elapsed)
+    if deadline_exceeded:
+      self.deadline_errors += 1
+      new_size = chunk_size // 2
+    elif elapsed > EVENT_DELIVERY_TARGET_SECONDS:
+      new_size = chunk_size // 2
+    elif full_chunk and elapsed < EVENT_DELIVERY_TARGET_SECONDS / 2.0:
+      new_size = chunk_size * 2
+    else:
+      new_size = chunk_size
+    self.chunk_size = max(1, min(new_size, MAX_EVENT_SUBSCRIBER_CHUNK_SIZE))
+
+
+class CallbackHostHealth(object):
+  """Tracks whether a subscriber callback host is accepting event deliveries.
+
+  This is a circuit breaker. Once HOST_FAILURE_THRESHOLD deliveries in a row
+  to a host have failed its circuit opens, and for HOST_CIRCUIT_OPEN_SECONDS
+  deliveries to it are put straight into the retry list without making any
+  requests. After that the circuit is half-open: one trial delivery is made,
+  which closes the circuit if it succeeds and opens it again if it fails.
+
+  Health is only advisory and changes with nearly every delivery, so it is
+  kept in memcache instead of the Datastore. Many workers deliver to the same
+  host at once, so the failure count is only ever changed with memcache's
+  atomic increment; the time the circuit opens until is derived from it.
+  """
+
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half_open'
+
+  def __init__(self, host, failures=0, open_until=None):
+    """Initializer.
+
+    Args:
+      host: The callback host, as returned by get_host().
+      failures: Number of consecutive failed deliveries to the host.
+      open_until: When the circuit becomes half-open, or None if it is closed.
+    """
+    self.host = host
+    self.failures = failures
+    self.open_until = open_until
+    # Changes to store with put_all(): whether the failure count was reset by
+    # a success, how many failures followed, and when the last one was.
+    self.reset = False
+    self.new_failures = 0
+    self.last_failure = None
+
+  @staticmethod
+  def get_host(url):
+    """Returns the host (and port, if any) of a callback URL."""
+    return urlparse.urlparse(url)[1].lower()
+
+  @staticmethod
+  def get_cache_key(host):
+    """Returns the memcache key of the failure count of a callback host."""
+    return 'host_failures:' + sha1_hash(host)
+
+  @staticmethod
+  def get_open_cache_key(host):
+    """Returns the memcache key of when a callback host's circuit closes."""
+    return 'host_open_until:' + sha1_hash(host)
+
+  @classmethod
+  def get_all(cls, host_list):
+    """Retrieves the health of many callback hosts.
+
+    Args:
+      host_list: Iterable of callback hosts.
+
+    Returns:
+      Dictionary mapping each host to its CallbackHostHealth. Hosts we know
+      nothing about are healthy.
+    """
+    host_list = set(host_list)
+    cache_keys = [cls.get_cache_key(host) for host in host_list]
+    cache_keys.extend(cls.get_open_cache_key(host) for host in host_list)
+    cached = memcache.get_multi(cache_keys)
+    result = {}
+    for host in host_list:
+      result[host] = cls(
+          host,
+          failures=cached.get(cls.get_cache_key(host), 0),
+          open_until=cached.get(cls.get_open_cache_key(host)))
+    return result
+
+  @classmethod
+  def put_all(cls, health_list):
+    """Stores the changes to the health of many callback hosts.
+
+    Failures are added to the stored count, so failures recorded by other
+    workers since the health was retrieved are not lost. A success resets the
+    count and closes the circuit, regardless of what other workers saw.
+
+    Args:
+      health_list: Iterable of CallbackHostHealth instances.
+    """
+    to_set = {}
+    for health in health_list:
+      cache_key = cls.get_cache_key(health.host)
+      open_key = cls.get_open_cache_key(health.host)
+      if health.reset:
+        to_set[cache_key] = health.new_failures
+        to_set[open_key] = health.open_until
+        continue
+      if not health.new_failures:
+        continue
+      failures = memcache.incr(cache_key, health.new_failures)
+      if failures is None:
+        if memcache.add(cache_key, health.new_failures,
+                        time=HOST_HEALTH_CACHE_SECONDS):
+          failures = health.new_failures
+        else:
+          # Another worker stored the first failure in the meantime.
+          failures = (memcache.incr(cache_key, health.new_failures) or
+                      health.new_failures)
+      if failures >= HOST_FAILURE_THRESHOLD:
+        to_set[open_key] = health.last_failure + datetime.timedelta(
+            seconds=HOST_CIRCUIT_OPEN_SECONDS)
+    if to_set:
+      memcache.set_multi(to_set, time=HOST_HEALTH_CACHE_SECONDS)
+
+  def get_state(self, now):
+    """Returns the circuit state of this host: CLOSED, OPEN, or HALF_OPEN.
+
+    Args:
+      now: datetime.datetime of the current time.
+    """
+    if self.open_until is None:
+      return self.CLOSED
+    elif now < self.open_until:
+      return self.OPEN
+    else:
+      return self.HALF_OPEN
+
+  def record_success(self):
+    """Records a delivery that reached the host, closing its circuit."""
+    self.failures = 0
+    self.open_until = None
+    self.reset = True
+    self.new_failures = 0
+
+  def record_failure(self, now):
+    """Records a failed delivery, opening the circuit if there are too many.
+
+    Args:
+      now: datetime.datetime of the current time.
+    """
+    self.failures += 1
+    self.new_failures += 1
+    self.last_failure = now
+    if self.failures >= HOST_FAILURE_THRESHOLD:
+      self.open_until = now + datetime.timedelta(
+          seconds=HOST_CIRCUIT_OPEN_SECONDS)
+
+
+class DeliveryBatchEntry(db.Model):
+  """The entries of one event waiting to be delivered in a DeliveryBatch.
+
+  Each event's entries for a callback are stored in their own entity, so
+  events for callbacks that follow many topics can be added to their batch
+  at the same time without contending on a single entity. The key_name is the
+  hash of the callback URL and the entries, so adding the same entries twice
+  stores them once.
+  """
+
+  callback_hash = db.StringProperty(required=True)
+  entries = db.ListProperty(db.Text)
+  created_time = db.DateTimeProperty(required=True)
+
+  @classmethod
+  def get_for_callback(cls, callback, count):
+    """Gets the oldest entries waiting for a callback.
+
+    Args:
+      callback: URL of the subscriber's callback.
+      count: Most DeliveryBatchEntry instances to retrieve.
+
+    Returns:
+      List of DeliveryBatchEntry instances, oldest first.
+    """
+    query = cls.all()
+    query.filter('callback_hash =', sha1_hash(callback))
+    query.order('created_time')
+    return query.fetch(count)
+
+
+class DeliveryBatch(db.Model):
+  """Schedules entries to be delivered together to an aggregating subscriber.
+
+  Subscriptions made with hub.aggregate=true do not get a request for every
+  event. Instead, the push worker stores each event's entries in a
+  DeliveryBatchEntry for the subscription's callback URL, and all of the
+  waiting entries are delivered in one Atom document once the oldest of them
+  has waited DELIVERY_BATCH_WINDOW. Entries from all of a callback's topics
+  share the same batch; each one carries a <source> element so the subscriber
+  can tell which feed it came from. A batch only exists while it has entries
+  waiting. The key_name is the hash of the callback URL.
+  """
+
+  callback = db.TextProperty(required=True)
+  eta = db.DateTimeProperty(required=True)
+  retry_attempts = db.IntegerProperty(default=0)
+  work_shard = db.IntegerProperty()
+
+  @classmethod
+  def add(cls, callback, entry_list, now=datetime.datetime.utcnow):
+    """Adds entries to the batch for a callback, creating it if needed.
+
+    Args:
+      callback: URL of the subscriber's callback.
+      entry_list: List of strings containing entry XML data, as returned by
+        prepare_aggregate_entries().
+      now: Returns the current time as a UTC datetime.
+    """
+    now_time = now()
+    DeliveryBatchEntry(
+        key_name=get_hash_key_name(
+            '%s\n%s' % (callback, sha1_hash('\n'.join(entry_list)))),
+        callback_hash=sha1_hash(callback),
+        entries=[db.Text(entry) for entry in entry_list],
+        created_time=now_time).put()
+
+    # The entries are stored first, so a batch that is deleted concurrently
+    # by update() either finds them, or is created again here.
+    key_name = get_hash_key_name(callback)
+    if cls.get_by_key_name(key_name) is None:
+      cls.get_or_insert(
+          key_name,
+          callback=callback,
+          eta=now_time + datetime.timedelta(seconds=DELIVERY_BATCH_WINDOW),
+          work_shard=get_work_shard(callback, DELIVERY_BATCH_SHARDS))
+
+  @classmethod
+  def get_work(cls, now=datetime.datetime.utcnow, shard=None):
+    """Retrieves a batch that is ready for delivery and owns it.
+
+    Args:
+      now: Returns the current time as a UTC datetime.
+      shard: The work queue shard to retrieve work from, or None to retrieve
+        work from any shard.
+
+    Returns:
+      A DeliveryBatch instance, or None if no work is available.
+    """
+    query = 'WHERE eta <= :now '
+    bindings = dict(now=now())
+    if shard is not None:
+      query += 'AND work_shard = :shard '
+      bindings['shard'] = shard
+    return query_and_own(cls, query + 'ORDER BY eta ASC',
+                         LEASE_PERIOD_SECONDS, **bindings)
+
+  def get_next_entries(self):
+    """Gets the entries to deliver in the next request.
+
+    Returns:
+      Tuple (batch_entries, entry_list) where:
+        batch_entries: List of the DeliveryBatchEntry instances the entries
+          came from, to pass to update().
+        entry_list: List of strings containing the entries' XML data; at most
+          DELIVERY_BATCH_MAX_ENTRIES, unless the oldest event has more.
+    """
+    batch_entries = []
+    entry_list = []
+    for batch_entry in DeliveryBatchEntry.get_for_callback(
+        self.callback, DELIVERY_BATCH_MAX_ENTRIES):
+      if (entry_list and
+          len(entry_list) + len(batch_entry.entries) >
+          DELIVERY_BATCH_MAX_ENTRIES):
+        break
+      batch_entries.append(batch_entry)
+      entry_list.extend(batch_entry.entries)
+    return batch_entries, entry_list
+
+  def get_payload(self, entry_list, now=datetime.datetime.utcnow):
+    """Creates the Atom document to deliver for a list of entries.
+
+    Args:
+      entry_list: The entries to deliver, as returned by get_next_entries().
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      The payload string.
+    """
+    payload_list = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<feed xmlns="http://www.w3.org/2005/Atom">',
+        '<title>Aggregated updates</title>',
+        '<id>%s</id>' % xml.sax.saxutils.escape(self.callback),
+        '<updated>%s</updated>' % now().strftime('%Y-%m-%dT%H:%M:%SZ'),
+    ]
+    payload_list.extend(entry_list)
+    payload_list.append('</feed>')
+    return '\n'.join(payload_list)
+
+  def update(self, batch_entries, success, now=datetime.datetime.utcnow,
+             max_failures=MAX_DELIVERY_FAILURES,
+             retry_period=DELIVERY_RETRY_PERIOD):
+    """Records a delivery attempt for this batch and releases its lease.
+
+    Args:
+      batch_entries: The DeliveryBatchEntry instances whose entries the
+        delivery attempt contained, as returned by get_next_entries().
+      success: True if the subscriber accepted the delivery.
+      now: Returns the current time as a UTC datetime.
+      max_failures: Maximum failures to allow before giving up on the
+        attempted entries.
+      retry_period: Initial period for doing exponential (base-2) backoff.
+    """
+    if not success and self.retry_attempts < max_failures:
+      retry_delay = retry_period * (2 ** self.retry_attempts)
+      self.eta = now() + datetime.timedelta(seconds=retry_delay)
+      self.retry_attempts += 1
+      self.put()
+      release_leases([self])
+      return
+
+    if not success:
+      logging.error('Giving up on delivering %d entries to callback = %s',
+                    sum(len(e.entries) for e in batch_entries), self.callback)
+    db.delete(batch_entries)
+    # Deleting the batch before looking for more entries means entries added
+    # in the meantime are either found here, or recreate the batch in add().
+    self.delete()
+    remaining = DeliveryBatchEntry.get_for_callback(self.callback, 1)
+    if remaining:
+      self.retry_attempts = 0
+      self.eta = max(now(), remaining[0].created_time +
+                     datetime.timedelta(seconds=DELIVERY_BATCH_WINDOW))
+      self.put()
+    release_leases([self])
+
+
+class SubscriberCountShard(db.Model):
+  """One shard of the number of verified subscribers to a topic.
+
+  Each shard is in its own entity group so subscriptions to the same topic
+  can be counted without contention. The count is approximate: it is updated
+  after the transactions that verify and remove Subscriptions, so it drifts
+  if a request fails in between. It is reconciled whenever the push worker
+  pages through all of a topic's subscribers, and for every known feed by
+  SubscriberCountReconcileHandler. The key_name is the hash of the topic URL
+  and the shard number.
+  """
+
+  topic_hash = db.StringProperty(required=True)
+  count = db.IntegerProperty(default=0)
+
+  @classmethod
+  def create_key(cls, topic, shard):
+    """Creates a key for a SubscriberCountShard.
+
+    Args:
+      topic: The topic URL being counted.
+      shard: The shard number.
+
+    Returns:
+      Key instance for this shard.
+    """
+    return datastore_types.Key.from_path(
+        cls.kind(), get_hash_key_name('%s\n%d' % (topic, shard)))
+
+  @staticmethod
+  def get_cache_key(topic):
+    """Returns the memcache key of the subscriber count for a topic."""
+    return 'subscriber_count:' + sha1_hash(topic)
+
+  @classmethod
+  def increment(cls, topic, delta=1):
+    """Adds to the subscriber count of a topic.
+
+    Args:
+      topic: The topic URL being counted.
+      delta: How much to add to the count; may be negative.
+    """
+    key = cls.create_key(topic, random.randrange(SUBSCRIBER_COUNT_SHARDS))
+    def txn():
+      shard = cls.get(key)
+      if shard is None:
+        shard = cls(key_name=key.name(), topic_hash=sha1_hash(topic))
+      shard.count += delta
+      shard.put()
+    db.run_in_transaction(txn)
+    memcache.delete(cls.get_cache_key(topic))
+
+  @classmethod
+  def _get_stored_counts(cls, topic_list):
+    """Returns a dictionary mapping each topic to the sum of its shards."""
+    shard_keys = []
+    for topic in topic_list:
+      shard_keys.extend(cls.create_key(topic, i)
+                        for i in xrange(SUBSCRIBER_COUNT_SHARDS))
+    shards = []
+    for key_batch in split_batches(shard_keys):
+      shards.extend(cls.get(key_batch))
+    result = {}
+    for index, topic in enumerate(topic_list):
+      start = index * SUBSCRIBER_COUNT_SHARDS
+      result[topic] = sum(s.count for s in
+                          shards[start:start + SUBSCRIBER_COUNT_SHARDS]
+                          if s is not None)
+    return result
+
+  @classmethod
+  def _get_stored_count(cls, topic):
+    """Returns the sum of all of the shards of a topic's subscriber count."""
+    return cls._get_stored_counts([topic])[topic]
+
+  @classmethod
+  def get_counts(cls, topic_list):
+    """Gets the approximate number of verified subscribers to many topics.
+
+    Args:
+      topic_list: Iterable of topic URLs being counted.
+
+    Returns:
+      Dictionary mapping each topic URL to its number of subscribers; zero if
+      none have been counted.
+    """
+    cache_keys = dict((cls.get_cache_key(topic), topic)
+                      for topic in set(topic_list))
+    cached = memcache.get_multi(cache_keys.keys())
+    result = dict((cache_keys[key], count)
+                  for key, count in cached.iteritems())
+    missing = [topic for topic in cache_keys.itervalues()
+               if topic not in result]
+    if missing:
+      stored = cls._get_stored_counts(missing)
+      for topic in missing:
+        result[topic] = max(0, stored[topic])
+      memcache.set_multi(
+          dict((cls.get_cache_key(topic), result[topic]) for topic in missing),
+          time=SUBSCRIBER_COUNT_CACHE_SECONDS)
+    return result
+
+  @classmethod
+  def get_count(cls, topic):
+    """Gets the approximate number of verified subscribers to a topic.
+
+    Args:
+      topic: The topic URL being counted.
+
+    Returns:
+      The number of subscribers; zero if none have been counted.
+    """
+    return cls.get_counts([topic])[topic]
+
+  @classmethod
+  def reconcile(cls, topic, actual_count):
+    """Corrects the subscriber count of a topic if it has drifted.
+
+    Args:
+      topic: The topic URL being counted.
+      actual_count: The number of verified subscribers that were found.
+    """
+    count = cls._get_stored_count(topic)
+    if count != actual_count:
+      logging.info('Subscriber count for topic = %s was %d, actually %d',
+                   topic, count, actual_count)
+      cls.increment(topic, actual_count - count)
 
 
 class KnownFeed(db.Model):
@@ -982,18 +2680,23 @@ class KnownFeed(db.Model):
   """
 
   topic = db.TextProperty(required=True)
+  next_poll_time = db.DateTimeProperty(auto_now_add=True)
+  work_shard = db.IntegerProperty()
 
   @classmethod
   def create(cls, topic):
     """Creates a new KnownFeed.
 
+    New KnownFeeds are due to be polled immediately.
+
     Args:
       topic: The feed's topic URL.
 
     Returns:
       The KnownFeed instance that hasn't been added to the Datastore.
     """
-    return cls(key_name=get_hash_key_name(topic), topic=topic)
+    return cls(key_name=get_hash_key_name(topic), topic=topic,
+               work_shard=get_work_shard(topic, POLL_BOOTSTRAP_SHARDS))
 
   @classmethod
   def create_key(cls, topic):
@@ -1024,21 +2727,73 @@ class KnownFeed(db.Model):
         result.append(known_feed.topic)
     return result
 
+  @classmethod
+  def get_work(cls, now=datetime.datetime.utcnow, shard=None, count=1):
+    """Retrieves known feeds that are scheduled to be polled and owns them.
+
+    Args:
+      now: Returns the current time as a UTC datetime.
+      shard: The work queue shard to retrieve work from, or None to retrieve
+        work from any shard.
+      count: Maximum number of feeds to retrieve.
+
+    Returns:
+      List of owned KnownFeed entities, which will be empty if no feeds are
+      due. Callers should set each one's next_poll_time, put() them, and then
+      release their leases.
+    """
+    query = 'WHERE next_poll_time <= :now '
+    bindings = dict(now=now())
+    if shard is not None:
+      query += 'AND work_shard = :shard '
+      bindings['shard'] = shard
+    work = query_and_own(cls, query + 'ORDER BY next_poll_time ASC',
+                         LEASE_PERIOD_SECONDS, work_count=count,
+                         in_order=True, **bindings)
+    if count == 1:
+      # query_and_own() returns a single item when only one is requested.
+      return [w for w in [work] if w is not None]
+    return work
+
+  @classmethod
+  def backfill(cls, known_feed_list, now=datetime.datetime.utcnow):
+    """Schedules known feeds stored by older versions to be polled.
+
+    Feeds stored before they had a polling schedule have no next_poll_time
+    or work_shard, so get_work() would never find them.
+
+    Args:
+      known_feed_list: List of KnownFeed instances to check.
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      The number of known feeds that were upgraded.
+    """
+    legacy_list = [k for k in known_feed_list if k.work_shard is None]
+    for known_feed in legacy_list:
+      known_feed.next_poll_time = now()
+      known_feed.work_shard = get_work_shard(known_feed.topic,
+                                             POLL_BOOTSTRAP_SHARDS)
+    if legacy_list:
+      db.put(legacy_list)
+    return len(legacy_list)
+
 
 class PollingMarker(db.Model):
-  """Keeps track of the current position in the bootstrap polling process."""
+  """Keeps track of the current position in a periodic pass over entities."""
 
   next_start = db.DateTimeProperty(required=True)
   current_key = db.TextProperty()
 
   @classmethod
-  def get(cls, now=datetime.datetime.utcnow):
+  def get(cls, now=datetime.datetime.utcnow, key_name='The Mark'):
     """Returns the current PollingMarker, creating it if it doesn't exist.
 
     Args:
       now: Returns the current time as a UTC datetime.
+      key_name: Key name of the marker to get, so independent iterations
+        can each keep their own position.
     """
-    key_name = 'The Mark'
     the_mark = db.get(datastore_types.Key.from_path(cls.kind(), key_name))
     if the_mark is None:
       next_start = now() - datetime.timedelta(seconds=60)
@@ -1047,20 +2802,18 @@ class PollingMarker(db.Model):
                                current_key=None)
     return the_mark
 
-  def should_progress(self,
-                     period=POLLING_BOOTSTRAP_PERIOD,
-                     now=datetime.datetime.utcnow):
-    """Returns True if the bootstrap polling should progress.
+  def should_progress(self, period, now=datetime.datetime.utcnow):
+    """Returns True if the pass should progress.
 
-    May modify this PollingMarker to when the next polling should start.
+    May modify this PollingMarker to when the next pass should start.
 
     Args:
-      period: The poll period for bootstrapping.
+      period: How often to start a new pass, in seconds.
       now: Returns the current time as a UTC datetime.
     """
     now_time = now()
     if self.next_start < now_time:
-      logging.info('Polling starting afresh!')
+      logging.info('Pass starting afresh!')
       self.next_start = now_time + datetime.timedelta(seconds=period)
       return True
     elif self.current_key:
@@ -1071,7 +2824,7 @@ class PollingMarker(db.Model):
 ################################################################################
 # Subscription handlers and workers
 
-def ConfirmSubscription(mode, topic, callback, verify_token):
+def ConfirmSubscription(mode, topic, callback, verify_token, aggregate=False):
   """Confirms a subscription request and updates a Subscription instance.
   
   Args:
@@ -1079,6 +2832,7 @@ def ConfirmSubscription(mode, topic, callback, verify_token):
     topic: URL of the topic being subscribed to.
     callback: URL of the callback handler to confirm the subscription with.
     verify_token: Opaque token passed to the callback.
+    aggregate: True if the subscriber asked for aggregated delivery.
   
   Returns:
     True if the subscription was confirmed properly, False if the subscription
@@ -1107,7 +2861,7 @@ def ConfirmSubscription(mode, topic, callback, verify_token):
 
   if response.status_code == 204:
     if mode == 'subscribe':
-      Subscription.insert(callback, topic)
+      Subscription.insert(callback, topic, aggregate=aggregate)
       # Blindly put the feed's record so we have a record of all feeds.
       db.put(KnownFeed.create(topic))
     else:
@@ -1135,6 +2889,7 @@ class SubscribeHandler(webapp.RequestHandler):
     verify_type = self.request.get('hub.verify', 'sync').lower()
     verify_token = self.request.get('hub.verify_token', '')
     mode = self.request.get('hub.mode', '').lower()
+    aggregate = self.request.get('hub.aggregate', '').lower()
 
     error_message = None
     if not callback or not is_valid_url(callback):
@@ -1149,6 +2904,9 @@ class SubscribeHandler(webapp.RequestHandler):
       error_message = 'Invalid parameter: hub.verify_token'
     if mode not in ('subscribe', 'unsubscribe'):
       error_message = 'Invalid value for hub.mode: %s' % mode
+    if aggregate not in ('', 'true', 'false'):
+      error_message = 'Invalid value for hub.aggregate: %s' % aggregate
+    aggregate = aggregate == 'true'
 
     if error_message:
       logging.info('Bad request for mode = %s, topic = %s, '
@@ -1169,14 +2927,16 @@ class SubscribeHandler(webapp.RequestHandler):
       # Enqueue a background verification task, or immediately confirm.
       # We prefer synchronous confirmation.
       if verify_type.startswith('sync'):
-        if ConfirmSubscription(mode, topic, callback, verify_token):
+        if ConfirmSubscription(mode, topic, callback, verify_token,
+                               aggregate=aggregate):
           return self.response.set_status(204)
         else:
           self.response.out.write('Error trying to confirm subscription')
           return self.response.set_status(409)
       else:
         if mode == 'subscribe':
-          Subscription.request_insert(callback, topic, verify_token)
+          Subscription.request_insert(callback, topic, verify_token,
+                                      aggregate=aggregate)
         else:
           Subscription.request_remove(callback, topic, verify_token)
         logging.info('Queued %s request for callback %s on '
@@ -1195,7 +2955,8 @@ class SubscriptionConfirmHandler(webapp.RequestHandler):
 
   @work_queue_only
   def get(self):
-    sub = Subscription.get_confirm_work()
+    sub = Subscription.get_confirm_work(
+        shard=get_worker_shard(self.request, SUBSCRIPTION_CONFIRM_SHARDS))
     if not sub:
       logging.debug('No subscriptions to confirm')
       return
@@ -1205,9 +2966,10 @@ class SubscriptionConfirmHandler(webapp.RequestHandler):
     else:
       mode = 'unsubscribe'
 
-    if ConfirmSubscription(mode, sub.topic, sub.callback, sub.verify_token):
+    if ConfirmSubscription(mode, sub.topic, sub.callback, sub.verify_token,
+                           aggregate=sub.aggregate):
       if mode == 'subscribe':
-        Subscription.insert(sub.callback, sub.topic)
+        Subscription.insert(sub.callback, sub.topic, aggregate=sub.aggregate)
       else:
         Subscription.remove(sub.callback, sub.topic)
     else:
@@ -1255,7 +3017,7 @@ class PublishHandler(webapp.RequestHandler):
     # double-check if there are any subscribers that need event delivery and
     # will skip any unused feeds.
     try:
-      FeedToFetch.insert(urls)
+      FeedToFetch.insert(urls, publish=True)
     except (apiproxy_errors.Error, db.Error, runtime.DeadlineExceededError):
       logging.exception('Failed to insert FeedToFetch records')
       self.response.headers['Retry-After'] = '120'
@@ -1272,18 +3034,20 @@ def find_feed_updates(topic, format, feed_content,
 
   Args:
     topic: The topic URL of the feed.
-    format: The string 'atom' or 'rss'.
+    format: The string 'atom', 'rss', or 'rdf'.
     feed_content: The content of the feed, which may include unicode characters.
     filter_feed: Used for dependency injection.
 
   Returns:
-    Tuple (header_footer, entry_list, entry_payloads) where:
+    Tuple (header_footer, entry_list, entry_payloads, unchanged_list) where:
       header_footer: The header/footer data of the feed.
       entry_list: List of FeedEntryRecord instances, if any, that represent
         the changes that have occurred on the feed. These records do *not*
         include the payload data for the entry.
       entry_payloads: List of strings containing entry payloads (i.e., the XML
         data for the Atom <entry> or <item>).
+      unchanged_list: List of the entry_ids of entries that have been stored
+        before and have not changed.
 
   Raises:
     xml.sax.SAXException if there is a parse error.
@@ -1293,22 +3057,22 @@ def find_feed_updates(topic, format, feed_content,
 
   # Find the new entries we've never seen before, and any entries that we
   # knew about that have been updated.
-  existing_entries = FeedEntryRecord.get_entries_for_topic(
+  existing_dict = FeedEntryRecord.get_content_hashes(
       topic, entries_map.keys())
-  existing_dict = dict((e.entry_id, e.entry_content_hash)
-                       for e in existing_entries if e)
 
   logging.info('Retrieved %d feed entries, %d of which have been seen before',
                len(entries_map), len(existing_dict))
 
   entities_to_save = []
   entry_payloads = []
+  unchanged_list = []
   for entry_id, new_content in entries_map.iteritems():
     new_content_hash = sha1_hash(new_content)
     # Mark the entry as new if the sha1 hash is different.
     try:
       old_content_hash = existing_dict[entry_id]
       if old_content_hash == new_content_hash:
+        unchanged_list.append(entry_id)
         continue
     except KeyError:
       pass
@@ -1317,49 +3081,161 @@ def find_feed_updates(topic, format, feed_content,
     entities_to_save.append(FeedEntryRecord.create_entry_for_topic(
         topic, entry_id, new_content_hash))
 
-  return header_footer, entities_to_save, entry_payloads
+  return header_footer, entities_to_save, entry_payloads, unchanged_list
+
+
+# Namespace declarations on a feed's root element.
+XMLNS_RE = re.compile(r"""\sxmlns(?::[^\s=]+)?\s*=\s*(?:"[^"]*"|'[^']*')""")
+
+
+def prepare_aggregate_entries(payload, filter_feed=feed_diff.filter):
+  """Prepares the entries of an event payload for aggregated delivery.
+
+  Each entry gets a <source> element containing the metadata of the feed it
+  came from, along with the namespace declarations of the feed's root
+  element, so it can be moved into a document with entries from other feeds.
+
+  Args:
+    payload: The payload of the event, which must be an Atom feed.
+    filter_feed: Used for dependency injection.
+
+  Returns:
+    List of strings containing the entries' XML data.
+
+  Raises:
+    xml.sax.SAXException if there is a parse error.
+    feed_diff.Error if the payload is not an Atom feed or could not be parsed
+    for any other reason.
+  """
+  header_footer, entries_map = filter_feed(payload, ATOM)
+
+  root_start = header_footer.find('<feed')
+  root_end = header_footer.find('>', root_start) + 1
+  namespaces = XMLNS_RE.findall(header_footer[root_start:root_end])
+  source = '<source>%s</source>' % (
+      header_footer[root_end:header_footer.rfind('</feed>')].strip())
+
+  entry_list = []
+  for content in entries_map.itervalues():
+    tag_end = content.find('>') + 1
+    start_tag = content[:tag_end]
+    name_end = len(start_tag.split(None, 1)[0].rstrip('/>'))
+    declared = set(ns.split('=', 1)[0].strip()
+                   for ns in XMLNS_RE.findall(start_tag))
+    declarations = ''.join(ns for ns in namespaces
+                           if ns.split('=', 1)[0].strip() not in declared)
+    start_tag = start_tag[:name_end] + declarations + start_tag[name_end:]
+    if '<source' in content:
+      # Entries that were already syndicated from elsewhere keep the
+      # original source.
+      entry_list.append(start_tag + content[tag_end:])
+    else:
+      entry_list.append(start_tag + source + content[tag_end:])
+  return entry_list
 
 
 class PullFeedHandler(webapp.RequestHandler):
   """Background worker for pulling feeds."""
   
-  def __init__(self, find_feed_updates=find_feed_updates):
+  def __init__(self, find_feed_updates=find_feed_updates,
+               now=datetime.datetime.utcnow):
     """Initializer.
 
     Args:
       find_feed_updates: Used for dependency injection.
+      now: Returns the current time as a UTC datetime.
     """
     webapp.RequestHandler.__init__(self)
     self.find_feed_updates = find_feed_updates
+    self.now = now
 
   @work_queue_only
   def get(self):
-    work = FeedToFetch.get_work()
-    if not work:
-      logging.debug('No feeds to fetch.')
-      return
-
-    if not Subscription.has_subscribers(work.topic):
-      logging.info('Ignore event because there are no subscribers for topic %s',
-                   work.topic)
-      # If there are no subscribers then we should also delete the record of
-      # this being a known feed. This will clean up after the periodic polling.
-      # TODO(bslatkin): Remove possibility of race-conditions here, where a
-      # user starts subscribing to a feed immediately at the same time we do
-      # this kind of pruning.
-      db.delete([work, KnownFeed.create_key(work.topic)])
-      return
+    shard = get_worker_shard(self.request, FEED_PULL_SHARDS)
+    end_time = self.now() + datetime.timedelta(seconds=WORKER_TIME_BUDGET)
 
-    logging.info('Fetching topic %s', work.topic)
-    feed_record = FeedRecord.get_or_create(work.topic)
+    # Keep claiming batches of feeds until we run out of work or time. Any
+    # feeds still owned by this worker when the deadline hits are released
+    # so other workers can pick them up immediately.
+    pending = []
     try:
+      while True:
+        pending = FeedToFetch.get_work(shard=shard, count=FEED_PULL_BATCH_SIZE)
+        if not pending:
+          logging.debug('No feeds to fetch.')
+          return
+        self.pull_feeds(pending)
+        if self.now() >= end_time:
+          logging.info('Time budget exhausted; more feeds may remain.')
+          return
+    except runtime.DeadlineExceededError:
+      logging.error('Could not pull all feeds due to deadline. '
+                    'Remaining are: %r', [w.topic for w in pending])
+      async_proxy.cancel_all()
+      release_leases(pending)
+
+  def pull_feeds(self, work_list):
+    """Fetches a batch of feeds concurrently and records any new entries.
+
+    Each feed's response is parsed and diffed as soon as its fetch completes.
+
+    Args:
+      work_list: List of FeedToFetch instances to process. Each one is removed
+        from this list once it has been processed, so any that remain if this
+        method is interrupted were not finished.
+    """
+    feed_records = FeedRecord.get_or_create_all([w.topic for w in work_list])
+
+    def create_callback(work):
+      def callback(response, exception):
+        try:
+          self.handle_response(work, feed_records[work.topic],
+                               response, exception)
+        except (apiproxy_errors.Error, db.Error):
+          logging.exception('Could not save results for topic %s; will retry '
+                            'when its lease expires', work.topic)
+        work_list.remove(work)
+      return callback
+
+    for work in list(work_list):
+      if not Subscription.has_subscribers(work.topic):
+        logging.info('Ignore event because there are no subscribers for '
+                     'topic %s', work.topic)
+        # If there are no subscribers then we should also delete the record of
+        # this being a known feed. This will clean up after the periodic
+        # polling.
+        # TODO(bslatkin): Remove possibility of race-conditions here, where a
+        # user starts subscribing to a feed immediately at the same time we do
+        # this kind of pruning.
+        db.delete([work, KnownFeed.create_key(work.topic)])
+        work_list.remove(work)
+        continue
+
+      logging.info('Fetching topic %s', work.topic)
       # Specifically follow redirects here. Many feeds are often just redirects
       # to the actual feed contents or a distribution server.
-      response = urlfetch.fetch(work.topic,
-                                headers=feed_record.get_request_headers(),
-                                follow_redirects=True)
-    except (apiproxy_errors.Error, urlfetch.Error):
-      logging.exception('Failed to fetch feed')
+      feed_record = feed_records[work.topic]
+      urlfetch_async.fetch(work.topic,
+                           headers=feed_record.get_request_headers(),
+                           follow_redirects=True,
+                           async_proxy=async_proxy,
+                           callback=create_callback(work))
+
+    async_proxy.wait()
+
+  def handle_response(self, work, feed_record, response, exception):
+    """Parses a fetched feed and records any new entries as an event.
+
+    Args:
+      work: The FeedToFetch instance that was fetched; it will be deleted if
+        the feed was pulled successfully.
+      feed_record: The FeedRecord for the feed's topic.
+      response: The urlfetch response for the feed, or None if the fetch
+        raised an exception.
+      exception: The exception raised by the fetch, or None if successful.
+    """
+    if exception:
+      logging.error('Failed to fetch feed %s: %r', work.topic, exception)
       work.fetch_failed()
       return
 
@@ -1370,45 +3246,77 @@ class PullFeedHandler(webapp.RequestHandler):
 
     if response.status_code == 304:
       logging.info('Feed publisher returned 304 response (cache hit)')
+      feed_record.record_fetch(0, not_modified=True, publish=work.publish,
+                               now=self.now)
+      feed_record.put()
       work.delete()
       return
 
-    # The content-type header is extremely unreliable for determining the feed's
-    # content-type. Using a regex search for "<rss" could work, but an RE is
-    # just another thing to maintain. Instead, try to parse the content twice
-    # and use any hints from the content-type as best we can. This has
-    # a bias towards Atom content (let's cross our fingers!).
-    # TODO(bslatkin): Do something more efficient.
-    if 'rss' in (feed_record.content_type or ''):
-      order = (RSS, ATOM)
-    else:
-      order = (ATOM, RSS)
-
-    parse_failures = 0
-    for format in order:
-      # Parse the feed. If this fails we will give up immediately.
-      try:
-        header_footer, entities_to_save, entry_payloads = \
-            self.find_feed_updates(work.topic, format, response.content)
-        break
-      except (xml.sax.SAXException, feed_diff.Error):
-        logging.exception(
-            'Could not get entries for content of %d bytes in format "%s"',
-            len(response.content), format)
-        parse_failures += 1
+    # Many publishers ignore conditional requests and return the same body
+    # again; skip parsing and diffing entirely when nothing has changed.
+    content_hash = hashlib.sha1(response.content).hexdigest()
+    if content_hash == feed_record.content_hash:
+      logging.info('Feed content unchanged since last fetch')
+      feed_record.update(response.headers)
+      feed_record.record_fetch(0, not_modified=True, publish=work.publish,
+                               now=self.now)
+      feed_record.put()
+      work.delete()
+      return
 
-    if parse_failures == len(order):
+    # The content-type header is extremely unreliable for determining the feed's
+    # content-type, so look at the document's root element instead. This means
+    # each feed only needs to be parsed once.
+    format = feed_record.guess_format(response.content)
+    try:
+      header_footer, entities_to_save, entry_payloads, unchanged_list = \
+          self.find_feed_updates(work.topic, format, response.content)
+    except (xml.sax.SAXException, feed_diff.Error), e:
+      logging.error('Could not get entries for content of %d bytes in '
+                    'format "%s": %s', len(response.content), format, e)
       work.fetch_failed()
       return
 
-    if not entities_to_save:
+    if (entry_payloads and
+        feed_record.entry_hash_version != ENTRY_HASH_VERSION):
+      # Entries stored by an older version were hashed differently, so they
+      # all look changed. Store their new hashes, but only deliver the ones
+      # that were never stored before.
+      stored = set(e.entry_id for e in FeedEntryRecord.get_entries_for_topic(
+          work.topic, [e.entry_id for e in entities_to_save]))
+      if stored:
+        logging.info('Rewriting content hashes of %d entries', len(stored))
+      entry_payloads = [
+          payload for entry, payload in zip(entities_to_save, entry_payloads)
+          if entry.entry_id not in stored]
+    feed_record.entry_hash_version = ENTRY_HASH_VERSION
+
+    new_entries = len(entry_payloads)
+    if not entry_payloads:
       logging.info('No new entries found')
     else:
       logging.info('Saving %d new/updated entries', len(entities_to_save))
-      entities_to_save.append(EventToDeliver.create_event_for_topic(
+      entities_to_save.extend(EventToDeliver.create_event_for_topic(
           work.topic, format, header_footer, entry_payloads))
 
-    feed_record.update(response.headers, header_footer)
+    # Garbage collection keeps every entry stored at or after
+    # entries_seen_time, so it must stay at or before the update_time of each
+    # entry still in the feed. New and changed entries are stored now; the
+    # unchanged ones were in the feed as of the last parse, so were stored at
+    # or after the time already recorded.
+    if not unchanged_list:
+      feed_record.entries_seen_time = self.now()
+    elif feed_record.entries_seen_time is None:
+      # Parsed by an older version; read the unchanged entries once to find
+      # the oldest of them.
+      feed_record.entries_seen_time = min(
+          [self.now()] +
+          [e.update_time for e in FeedEntryRecord.get_entries_for_topic(
+              work.topic, unchanged_list)])
+
+    feed_record.update(response.headers, header_footer, format=format,
+                       content_hash=content_hash)
+    feed_record.record_fetch(new_entries, publish=work.publish, now=self.now)
     entities_to_save.append(feed_record)
 
     # Doing this put in a transaction ensures that we have written all
@@ -1417,10 +3325,119 @@ class PullFeedHandler(webapp.RequestHandler):
     # drop messages on the floor. If this transaction fails, the whole fetch
     # will be redone and find the same entries again (thus it is idempotent).
     db.run_in_transaction(lambda: db.put(entities_to_save))
+    if new_entries:
+      feed_record.cache_last_changed()
+    FeedEntryRecord.cache_content_hashes(
+        work.topic,
+        [e for e in entities_to_save if isinstance(e, FeedEntryRecord)])
     work.delete()
 
 ################################################################################
 
+def deliver_events(delivery_list, now=datetime.datetime.utcnow):
+  """Delivers event payloads to subscriber callbacks.
+
+  Requests are grouped by callback host so no host gets more than
+  MAX_DELIVERIES_PER_HOST of them at once, and hosts that keep failing are
+  skipped instead of using up time on every event (see CallbackHostHealth).
+  Deliveries are started as slots in the proxy's in-flight window free up,
+  and each response is handled as soon as it arrives, so one slow subscriber
+  does not hold up the others.
+
+  Args:
+    delivery_list: List of tuples (item, callback, headers, payload), where
+      'item' identifies the delivery to the caller and the rest is the POST
+      request to make.
+    now: Returns the current time as a UTC datetime.
+
+  Returns:
+    Tuple (failed_items, error_items, deadline_exceeded) where:
+      failed_items: Set of the items whose delivery failed or was never
+        attempted, because the host's circuit was open or the request
+        deadline was hit.
+      error_items: Set of the items whose callback returned an error or
+        could not be reached; a subset of failed_items.
+      deadline_exceeded: True if the request deadline was hit before all
+        deliveries were finished.
+  """
+  # Keep track of successful deliveries. Do this instead of tracking broken
+  # ones because the asynchronous API calls could be interrupted by a
+  # deadline error. If that happens we'll want to mark all outstanding
+  # deliveries as still pending.
+  failed_items = set(item for item, _, _, _ in delivery_list)
+  error_items = set()
+
+  pending = {}
+  for delivery in delivery_list:
+    host = CallbackHostHealth.get_host(delivery[1])
+    pending.setdefault(host, []).append(delivery)
+  host_health = CallbackHostHealth.get_all(pending.keys())
+  in_flight = dict((host, 0) for host in pending)
+
+  def start_next(host):
+    state = host_health[host].get_state(now())
+    if state == CallbackHostHealth.OPEN:
+      if pending[host]:
+        logging.warning('Circuit open for host %s; deferring %d deliveries',
+                        host, len(pending[host]))
+        del pending[host][:]
+      return
+    elif state == CallbackHostHealth.HALF_OPEN:
+      limit = 1
+    else:
+      limit = MAX_DELIVERIES_PER_HOST
+    while pending[host] and in_flight[host] < limit:
+      item, callback_url, headers, payload = pending[host].pop(0)
+      in_flight[host] += 1
+      urlfetch_async.fetch(callback_url,
+                           method='POST',
+                           headers=headers,
+                           payload=payload,
+                           deadline=EVENT_DELIVERY_DEADLINE,
+                           async_proxy=async_proxy,
+                           callback=create_callback(item, callback_url, host))
+
+  def callback(item, callback_url, host, result, exception):
+    in_flight[host] -= 1
+    health = host_health[host]
+    if exception:
+      logging.warning('Could not deliver to target url %s: '
+                      'Exception = %r', callback_url, exception)
+      error_items.add(item)
+      health.record_failure(now())
+    elif result.status_code not in (200, 204):
+      logging.warning('Could not deliver to target url %s: '
+                      'status_code = %s', callback_url, result.status_code)
+      error_items.add(item)
+      # Only server errors say anything about the health of the host.
+      if result.status_code >= 500:
+        health.record_failure(now())
+      else:
+        health.record_success()
+    else:
+      failed_items.remove(item)
+      health.record_success()
+    start_next(host)
+
+  def create_callback(item, callback_url, host):
+    return lambda *args: callback(item, callback_url, host, *args)
+
+  deadline_exceeded = False
+  try:
+    for host in pending:
+      start_next(host)
+    async_proxy.wait()
+  except runtime.DeadlineExceededError:
+    logging.error('Could not finish all callbacks due to deadline. '
+                  'Remaining are: %r',
+                  [callback_url for item, callback_url, _, _ in delivery_list
+                   if item in failed_items])
+    async_proxy.cancel_all()
+    deadline_exceeded = True
+  CallbackHostHealth.put_all(host_health.values())
+  return failed_items, error_items, deadline_exceeded
+
+
 class PushEventHandler(webapp.RequestHandler):
 
   def __init__(self, now=datetime.datetime.utcnow):
@@ -1430,77 +3447,534 @@ class PushEventHandler(webapp.RequestHandler):
 
   @work_queue_only
   def get(self):
-    work = EventToDeliver.get_work(now=self.now)
+    work = EventToDeliver.get_work(
+        now=self.now,
+        shard=get_worker_shard(self.request, EVENT_DELIVERY_SHARDS))
     if not work:
       logging.debug('No events to deliver.')
       return
 
+    payload = work.get_payload()
+    if payload is None:
+      logging.error('Payload missing for event; dropping it: topic = %s, '
+                    'payload_hash = %s', work.topic, work.payload_hash)
+      work.delete()
+      return
+    # Encode once and reuse the same bytes for every subscriber.
+    payload = payload.encode('utf-8')
+    work.convert_failed_callbacks(now=self.now)
+
     # Retrieve the first N + 1 subscribers; note if we have more to contact.
-    more_subscribers, subscription_list = work.get_next_subscribers()
+    stats = DeliveryStats.get_or_create(work.topic)
+    chunk_size = stats.get_chunk_size()
+    more_subscribers, subscription_list = work.get_next_subscribers(
+        chunk_size, now=self.now)
+    subscriber_count = SubscriberCountShard.get_count(work.topic)
+    new_events = []
+    if more_subscribers:
+      # Only topics that one worker would take many requests to get through
+      # are worth splitting; the rest keep walking a single cursor.
+      if subscriber_count > chunk_size * EVENT_FANOUT_RANGES:
+        new_events = work.split_fanout(EVENT_FANOUT_RANGES)
+      if new_events:
+        logging.info('Split delivery into %d ranges for topic = %s',
+                     len(new_events) + 1, work.topic)
+    else:
+      total_subscribers = work.get_total_subscribers(more_subscribers)
+      if total_subscribers is not None:
+        SubscriberCountShard.reconcile(work.topic, total_subscribers)
     logging.info('%d more subscribers to contact for: '
                  'topic = %s, delivery_mode = %s',
                  len(subscription_list), work.topic, work.delivery_mode)
 
-    # Keep track of successful callbacks. Do this instead of tracking broken
-    # callbacks because the asynchronous API calls could be interrupted by a
-    # deadline error. If that happens we'll want to mark all outstanding
-    # callback urls as still pending.
-    failed_callbacks = set(subscription_list)
-    def callback(sub, result, exception):
-      if exception or result.status_code not in (200, 204):
-        logging.warning('Could not deliver to target url %s: '
-                        'Exception = %r, status_code = %s',
-                        sub.callback, exception, result.status_code)
+    headers = {
+      'content-type': 'application/atom+xml',
+      'X-Hub-On-Behalf-Of': str(subscriber_count),
+    }
+
+    # Subscribers that asked for aggregated delivery get this event's entries
+    # added to their DeliveryBatch instead of a request of their own.
+    failed_callbacks = set()
+    aggregate_list = [s for s in subscription_list if s.aggregate]
+    if aggregate_list:
+      try:
+        entry_list = prepare_aggregate_entries(payload)
+      except (xml.sax.SAXException, feed_diff.Error), e:
+        logging.warning('Could not aggregate event for topic = %s; '
+                        'delivering it separately: %s', work.topic, e)
       else:
-        failed_callbacks.remove(sub)
+        for sub in aggregate_list:
+          try:
+            DeliveryBatch.add(sub.callback, entry_list, now=self.now)
+          except (db.Error, apiproxy_errors.RequestTooLargeError):
+            logging.exception('Could not add event to delivery batch for '
+                              'callback = %s', sub.callback)
+            failed_callbacks.add(sub)
+        subscription_list = [s for s in subscription_list if not s.aggregate]
+
+    start_time = self.now()
+    failed_items, error_items, deadline_exceeded = deliver_events(
+        [(sub, sub.callback, headers, payload) for sub in subscription_list],
+        now=self.now)
+    failed_callbacks.update(failed_items)
+
+    work.update(more_subscribers, failed_callbacks, new_events=new_events)
+
+    elapsed = self.now() - start_time
+    stats.record_delivery(
+        chunk_size, more_subscribers,
+        elapsed.days * 86400 + elapsed.seconds + elapsed.microseconds / 1e6,
+        deadline_exceeded=deadline_exceeded)
+    stats.put()
+
+    # Deliveries that were deferred or cut off say nothing about whether the
+    # subscriber is reachable, so only count those that were made. When the
+    # deadline was hit there is no time left to record them at all.
+    if not deadline_exceeded:
+      Subscription.record_deliveries(
+          [s for s in subscription_list if s not in failed_items],
+          [s for s in subscription_list if s in error_items],
+          now=self.now)
+
+
+class DeliveryRetryHandler(webapp.RequestHandler):
+  """Background worker for retrying failed event deliveries."""
 
-    def create_callback(sub):
-      return lambda *args: callback(sub, *args)
+  def __init__(self, now=datetime.datetime.utcnow):
+    """Initializer."""
+    webapp.RequestHandler.__init__(self)
+    self.now = now
 
-    for sub in subscription_list:
-      urlfetch_async.fetch(sub.callback,
-                           method='POST',
-                           headers={'content-type': 'application/atom+xml'},
-                           payload=work.payload.encode('utf-8'),
-                           async_proxy=async_proxy,
-                           callback=create_callback(sub))
+  @work_queue_only
+  def get(self):
+    shard = get_worker_shard(self.request, DELIVERY_RETRY_SHARDS)
+    end_time = self.now() + datetime.timedelta(seconds=WORKER_TIME_BUDGET)
+
+    # Keep claiming chunks of due retries until we run out of work or time.
+    while True:
+      failed_list = FailedCallback.get_work(
+          now=self.now, shard=shard, count=DELIVERY_RETRY_CHUNK_SIZE)
+      if not failed_list:
+        logging.debug('No failed deliveries to retry.')
+        return
+      if not self.retry_deliveries(failed_list):
+        logging.error('Could not retry all deliveries due to deadline.')
+        return
+      if self.now() >= end_time:
+        logging.info('Time budget exhausted; more retries may be due.')
+        return
 
-    try:
-      async_proxy.wait()
-    except runtime.DeadlineExceededError:
-      logging.error('Could not finish all callbacks due to deadline. '
-                    'Remaining are: %r', [s.callback for s in failed_callbacks])
+  def retry_deliveries(self, failed_list):
+    """Retries a chunk of failed deliveries and records the results.
+
+    Deliveries to subscribers that asked for aggregated delivery are queued
+    in their DeliveryBatch instead, if the event's entries can be aggregated.
+
+    Args:
+      failed_list: List of owned FailedCallback instances.
+
+    Returns:
+      False if the request deadline was hit, True otherwise.
+    """
+    event_keys = list(set(f.parent_key() for f in failed_list))
+    events = dict(zip(event_keys, db.get(event_keys)))
+    payloads = {}
+    for event_key, event in events.iteritems():
+      if event is None:
+        continue
+      payload = event.get_payload()
+      if payload is not None:
+        payloads[event_key] = payload.encode('utf-8')
+    subscriber_counts = SubscriberCountShard.get_counts(
+        e.topic for e in events.itervalues() if e is not None)
+
+    # Deliveries whose event, payload, or subscription have gone away since
+    # they failed are dropped along with the ones that succeed.
+    retry_list = [f for f in failed_list if f.parent_key() in payloads]
+    subscription_list = db.get(
+        [f.get_subscription_key(events[f.parent_key()].topic)
+         for f in retry_list])
+    delivery_list = []
+    subscriptions = {}
+    batch_failed = set()
+    aggregate_entries = {}
+    for failed, sub in zip(retry_list, subscription_list):
+      if (sub is None or sub.is_expired(self.now) or
+          sub.subscription_state != Subscription.STATE_VERIFIED):
+        continue
+      if sub.aggregate:
+        # Like PushEventHandler, queue the entries in the subscriber's
+        # DeliveryBatch instead of making a request of their own.
+        event_key = failed.parent_key()
+        if event_key not in aggregate_entries:
+          try:
+            aggregate_entries[event_key] = prepare_aggregate_entries(
+                payloads[event_key])
+          except (xml.sax.SAXException, feed_diff.Error), e:
+            logging.warning('Could not aggregate event for topic = %s; '
+                            'delivering it separately: %s',
+                            events[event_key].topic, e)
+            aggregate_entries[event_key] = None
+        if aggregate_entries[event_key] is not None:
+          try:
+            DeliveryBatch.add(sub.callback, aggregate_entries[event_key],
+                              now=self.now)
+          except (db.Error, apiproxy_errors.RequestTooLargeError):
+            logging.exception('Could not add event to delivery batch for '
+                              'callback = %s', sub.callback)
+            batch_failed.add(failed)
+          continue
+      topic = events[failed.parent_key()].topic
+      headers = {
+        'content-type': 'application/atom+xml',
+        'X-Hub-On-Behalf-Of': str(subscriber_counts[topic]),
+      }
+      delivery_list.append((failed, failed.callback, headers,
+                            payloads[failed.parent_key()]))
+      subscriptions[failed] = sub
+    logging.info('Retrying %d failed deliveries', len(delivery_list))
+    failed_items, error_items, deadline_exceeded = deliver_events(
+        delivery_list, now=self.now)
+    failed_items.update(batch_failed)
+
+    results = {}
+    for failed in failed_list:
+      delivered, still_failed = results.setdefault(
+          failed.parent_key(), ([], []))
+      if failed in failed_items:
+        still_failed.append(failed)
+      else:
+        delivered.append(failed)
+    for event_key, (delivered, still_failed) in results.iteritems():
+      EventToDeliver.record_retries(event_key, delivered, still_failed,
+                                    now=self.now)
+    release_leases(failed_list)
+
+    if deadline_exceeded:
+      return False
+    Subscription.record_deliveries(
+        [sub for f, sub in subscriptions.iteritems() if f not in failed_items],
+        [sub for f, sub in subscriptions.iteritems() if f in error_items],
+        now=self.now)
+    return True
+
+
+class DeliveryBatchHandler(webapp.RequestHandler):
+  """Background worker for delivering batches of aggregated entries."""
+
+  def __init__(self, now=datetime.datetime.utcnow):
+    """Initializer."""
+    webapp.RequestHandler.__init__(self)
+    self.now = now
 
-    work.update(more_subscribers, failed_callbacks)
+  @work_queue_only
+  def get(self):
+    batch = DeliveryBatch.get_work(
+        now=self.now,
+        shard=get_worker_shard(self.request, DELIVERY_BATCH_SHARDS))
+    if not batch:
+      logging.debug('No delivery batches to send.')
+      return
+
+    batch_entries, entry_list = batch.get_next_entries()
+    if not entry_list:
+      batch.update(batch_entries, True, now=self.now)
+      return
+    payload = batch.get_payload(entry_list, now=self.now)
+    logging.info('Delivering %d aggregated entries to callback = %s',
+                 len(entry_list), batch.callback)
+    headers = {'content-type': 'application/atom+xml'}
+    success = False
+    try:
+      response = urlfetch.fetch(batch.callback,
+                                method='POST',
+                                headers=headers,
+                                payload=payload.encode('utf-8'),
+                                follow_redirects=False)
+    except urlfetch_errors.Error:
+      logging.exception('Could not deliver batch to callback = %s',
+                        batch.callback)
+    else:
+      if response.status_code in (200, 204):
+        success = True
+      else:
+        logging.warning('Could not deliver batch to callback = %s: '
+                        'status_code = %s', batch.callback,
+                        response.status_code)
+    batch.update(batch_entries, success, now=self.now)
 
 ################################################################################
 
 class PollBootstrapHandler(webapp.RequestHandler):
-  """Boostrap handler automatically polls feeds."""
+  """Boostrap handler automatically polls feeds when they are due."""
+
+  def __init__(self, now=datetime.datetime.utcnow):
+    """Initializer."""
+    webapp.RequestHandler.__init__(self)
+    self.now = now
 
   @work_queue_only
   def get(self):
-    the_mark = PollingMarker.get()
-    if not the_mark.should_progress():
+    shard = get_worker_shard(self.request, POLL_BOOTSTRAP_SHARDS)
+    end_time = self.now() + datetime.timedelta(seconds=WORKER_TIME_BUDGET)
+
+    # Keep claiming feeds whose scheduled poll time has passed until there
+    # are none left or we run out of time. Each one is rescheduled for its
+    # next poll, so workers on other shards never see the same feeds.
+    known_feeds = []
+    try:
+      while True:
+        known_feeds = KnownFeed.get_work(now=self.now, shard=shard,
+                                         count=BOOSTRAP_FEED_CHUNK_SIZE)
+        if not known_feeds:
+          logging.debug('No feeds to poll.')
+          return
+        self.schedule_feeds(known_feeds)
+        if self.now() >= end_time:
+          logging.info('Time budget exhausted; more feeds may be due.')
+          return
+    except runtime.DeadlineExceededError:
+      logging.error('Could not schedule all feeds due to deadline.')
+      release_leases(known_feeds)
+
+  def schedule_feeds(self, known_feeds):
+    """Polls the due feeds among a set of KnownFeeds and reschedules them all.
+
+    Args:
+      known_feeds: List of owned KnownFeed instances.
+    """
+    now_time = self.now()
+    feed_records = FeedRecord.get_by_key_name(
+        [FeedRecord.create_key_name(k.topic) for k in known_feeds])
+    due_topics = []
+    for known_feed, record in zip(known_feeds, feed_records):
+      if record is None or record.is_poll_due(now=self.now):
+        due_topics.append(known_feed.topic)
+        interval = (record and record.poll_interval) or DEFAULT_POLL_INTERVAL
+        known_feed.next_poll_time = (
+            now_time + datetime.timedelta(seconds=interval))
+      else:
+        known_feed.next_poll_time = record.get_next_poll_time(now=self.now)
+    logging.info('Found %d scheduled feeds, %d due to poll',
+                 len(known_feeds), len(due_topics))
+
+    FeedToFetch.insert(due_topics)
+    db.put(known_feeds)
+    release_leases(known_feeds)
+
+
+class SubscriptionSweepHandler(webapp.RequestHandler):
+  """Background worker that deletes expired subscriptions."""
+
+  def __init__(self, now=datetime.datetime.utcnow):
+    """Initializer."""
+    webapp.RequestHandler.__init__(self)
+    self.now = now
+
+  @work_queue_only
+  def get(self):
+    end_time = self.now() + datetime.timedelta(seconds=WORKER_TIME_BUDGET)
+    removed_topics = set()
+    while True:
+      found, topics = Subscription.remove_expired(now=self.now)
+      removed_topics.update(topics)
+      if found < SUBSCRIPTION_SWEEP_CHUNK_SIZE:
+        break
+      if self.now() >= end_time:
+        logging.info('Time budget exhausted; more expired subscriptions '
+                     'may remain.')
+        break
+
+    # Topics that are left without any subscribers no longer need to be
+    # polled, so forget about them. A subscription verified between the
+    # check and the delete leaves its topic unpolled until it is subscribed
+    # to again, as with the same pruning in PullFeedHandler.
+    unknown_feeds = [KnownFeed.create_key(topic)
+                     for topic in removed_topics
+                     if not Subscription.has_subscribers(topic)]
+    if unknown_feeds:
+      db.delete(unknown_feeds)
+    logging.info('Swept expired subscriptions for %d topics; %d are no '
+                 'longer known feeds', len(removed_topics), len(unknown_feeds))
+
+
+class SubscriberCountReconcileHandler(webapp.RequestHandler):
+  """Background worker that corrects drift in topics' subscriber counts.
+
+  Walks through all KnownFeeds once every SUBSCRIBER_COUNT_RECONCILE_PERIOD,
+  counting the verified Subscriptions of each topic.
+  """
+
+  MARKER_KEY_NAME = 'Subscriber Count Mark'
+
+  def __init__(self, now=datetime.datetime.utcnow):
+    """Initializer."""
+    webapp.RequestHandler.__init__(self)
+    self.now = now
+
+  @work_queue_only
+  def get(self):
+    the_mark = PollingMarker.get(now=self.now,
+                                 key_name=self.MARKER_KEY_NAME)
+    if not the_mark.should_progress(period=SUBSCRIBER_COUNT_RECONCILE_PERIOD,
+                                    now=self.now):
       return
 
     query = KnownFeed.all()
     if the_mark.current_key is not None:
       query.filter('__key__ >', datastore_types.Key(the_mark.current_key))
-    known_feeds = query.fetch(BOOSTRAP_FEED_CHUNK_SIZE)
+    known_feeds = query.fetch(SUBSCRIBER_COUNT_RECONCILE_CHUNK_SIZE)
+
+    for known_feed in known_feeds:
+      count = (Subscription.all(keys_only=True)
+               .filter('topic_hash =', sha1_hash(known_feed.topic))
+               .filter('subscription_state =', Subscription.STATE_VERIFIED)
+               .count(SUBSCRIBER_COUNT_RECONCILE_MAX))
+      if count < SUBSCRIBER_COUNT_RECONCILE_MAX:
+        SubscriberCountShard.reconcile(known_feed.topic, count)
 
     if known_feeds:
       the_mark.current_key = str(known_feeds[-1].key())
-      logging.info('Found %s more feeds to poll, ended at %s',
+      logging.info('Reconciled subscriber counts for %d feeds, ended at %s',
                    len(known_feeds), known_feeds[-1].topic)
     else:
-      logging.info('Polling cycle complete; starting again at %s',
-                   the_mark.next_start)
+      logging.info('Subscriber count reconciliation complete; starting again '
+                   'at %s', the_mark.next_start)
       the_mark.current_key = None
+    db.put(the_mark)
+
+
+class EntryGarbageCollectHandler(webapp.RequestHandler):
+  """Background worker that deletes FeedEntryRecords no longer in use."""
 
-    FeedToFetch.insert([k.topic for k in known_feeds])
+  MARKER_KEY_NAME = 'Entry GC Mark'
+
+  def __init__(self, now=datetime.datetime.utcnow):
+    """Initializer."""
+    webapp.RequestHandler.__init__(self)
+    self.now = now
+
+  @work_queue_only
+  def get(self):
+    the_mark = PollingMarker.get(now=self.now,
+                                 key_name=self.MARKER_KEY_NAME)
+    if not the_mark.should_progress(period=ENTRY_GC_PERIOD, now=self.now):
+      return
+
+    query = FeedRecord.all()
+    if the_mark.current_key is not None:
+      query.filter('__key__ >', datastore_types.Key(the_mark.current_key))
+    feed_records = query.fetch(ENTRY_GC_FEED_CHUNK_SIZE)
+
+    max_age_cutoff = self.now() - ENTRY_RECORD_MAX_AGE
+    last_done = None
+    for feed_record in feed_records:
+      if feed_record.entries_seen_time is None:
+        # Not parsed since entries_seen_time was kept; entries that are still
+        # in the feed may not have been stored recently.
+        deleted = 0
+      else:
+        # Entries still in the feed were all stored at or after
+        # entries_seen_time, even if it is older than the max age.
+        deleted = self.collect_entries(
+            feed_record, min(max_age_cutoff, feed_record.entries_seen_time))
+      if deleted == ENTRY_GC_DELETE_CHUNK_SIZE:
+        # There may be more to delete; resume at this feed next time.
+        break
+      last_done = feed_record
+
+    if last_done is not None:
+      the_mark.current_key = str(last_done.key())
+      logging.info('Collected entries for %s feeds, ended at %s',
+                   feed_records.index(last_done) + 1, last_done.topic)
+    elif feed_records:
+      # Leave the mark as it was so the next request resumes at this feed,
+      # even if this request was the one that started a new cycle.
+      logging.info('More entries to collect for %s', feed_records[0].topic)
+      return
+    else:
+      logging.info('Entry garbage collection cycle complete; starting again '
+                   'at %s', the_mark.next_start)
+      the_mark.current_key = None
     db.put(the_mark)
 
+  def collect_entries(self, feed_record, cutoff):
+    """Deletes old FeedEntryRecords for a single feed.
+
+    Args:
+      feed_record: The FeedRecord whose entries should be collected.
+      cutoff: UTC datetime; entries not stored since then may be deleted
+        unless they are among the ENTRY_RECORD_MIN_KEEP most recently stored
+        entries.
+
+    Returns:
+      The number of FeedEntryRecords that were deleted.
+    """
+    recent_query = FeedEntryRecord.all(keys_only=True)
+    recent_query.ancestor(feed_record)
+    recent_query.filter('update_time >=', cutoff)
+    recent_query.order('-update_time')  # Uses the same index.
+    recent = recent_query.count(ENTRY_RECORD_MIN_KEEP)
+
+    query = FeedEntryRecord.all(keys_only=True)
+    query.ancestor(feed_record)
+    query.filter('update_time <', cutoff)
+    query.order('-update_time')
+    old_entries = query.fetch(ENTRY_GC_DELETE_CHUNK_SIZE,
+                              offset=ENTRY_RECORD_MIN_KEEP - recent)
+    if old_entries:
+      db.delete(old_entries)
+      logging.debug('Deleted %d old entries for topic = %s',
+                    len(old_entries), feed_record.topic)
+    return len(old_entries)
+
+
+class BackfillHandler(webapp.RequestHandler):
+  """Background worker that upgrades entities stored by older versions.
+
+  Each kind in MODELS is walked once in key order, and its model's backfill()
+  method fixes up any entities in each chunk that need it. Once a kind has
+  been walked completely it is not walked again.
+  """
+
+  MODELS = [Subscription, FeedToFetch, EventToDeliver, KnownFeed]
+
+  # The next_start of a PollingMarker for a kind that is done.
+  DONE = datetime.datetime.max
+
+  def __init__(self, now=datetime.datetime.utcnow):
+    """Initializer."""
+    webapp.RequestHandler.__init__(self)
+    self.now = now
+
+  @work_queue_only
+  def get(self):
+    end_time = self.now() + datetime.timedelta(seconds=WORKER_TIME_BUDGET)
+    for model_class in self.MODELS:
+      the_mark = PollingMarker.get(now=self.now,
+                                   key_name='Backfill ' + model_class.kind())
+      while the_mark.next_start != self.DONE:
+        query = model_class.all()
+        if the_mark.current_key is not None:
+          query.filter('__key__ >', datastore_types.Key(the_mark.current_key))
+        query.order('__key__')
+        entity_list = query.fetch(BACKFILL_CHUNK_SIZE)
+        upgraded = model_class.backfill(entity_list, now=self.now)
+        if upgraded:
+          logging.info('Upgraded %d %s entities', upgraded,
+                       model_class.kind())
+
+        if len(entity_list) < BACKFILL_CHUNK_SIZE:
+          logging.info('Backfill of %s complete', model_class.kind())
+          the_mark.current_key = None
+          the_mark.next_start = self.DONE
+        else:
+          the_mark.current_key = str(entity_list[-1].key())
+        db.put(the_mark)
+        if self.now() >= end_time:
+          logging.info('Time budget exhausted; backfill will resume later.')
+          return
+
 ################################################################################
 
 class HubHandler(webapp.RequestHandler):
@@ -1532,8 +4006,14 @@ def main():
     (r'/subscribe', SubscribeHandler),
     (r'/work/subscriptions', SubscriptionConfirmHandler),
     (r'/work/poll_bootstrap', PollBootstrapHandler),
+    (r'/work/sweep_subscriptions', SubscriptionSweepHandler),
+    (r'/work/reconcile_counts', SubscriberCountReconcileHandler),
     (r'/work/pull_feeds', PullFeedHandler),
     (r'/work/push_events', PushEventHandler),
+    (r'/work/retry_deliveries', DeliveryRetryHandler),
+    (r'/work/deliver_batches', DeliveryBatchHandler),
+    (r'/work/gc_entries', EntryGarbageCollectHandler),
+    (r'/work/backfill', BackfillHandler),
   ], debug=DEBUG)
   wsgiref.handlers.CGIHandler().run(application)
 
@@ -70,6 +70,32 @@ class UtilityFunctionTest(unittest.TestCase):
     self.assertFalse(main.is_valid_url('http://example.com:8080'))
     self.assertFalse(main.is_valid_url('http://example.com/blah#bad'))
 
+  def testGetWorkShard(self):
+    self.assertEquals(int('e01d59aa', 16) % 8,
+                      main.get_work_shard('my value', 8))
+    for count in (1, 3, 8):
+      shard = main.get_work_shard('http://example.com/feed', count)
+      self.assertTrue(0 <= shard < count)
+
+  def testSplitBatches(self):
+    self.assertEquals([], main.split_batches([]))
+    self.assertEquals([[1, 2], [3, 4], [5]],
+                      main.split_batches(xrange(1, 6), batch_size=2))
+    self.assertEquals([range(main.MAX_BATCH_SIZE), [main.MAX_BATCH_SIZE]],
+                      main.split_batches(xrange(main.MAX_BATCH_SIZE + 1)))
+
+  def testGetWorkerShard(self):
+    def shard(*params):
+      return main.get_worker_shard(
+          testutil.create_test_request('GET', *params), 8)
+    self.assertTrue(shard() is None)
+    self.assertTrue(shard(('num', '')) is None)
+    self.assertTrue(shard(('num', 'bad')) is None)
+    self.assertTrue(shard(('num', '0')) is None)
+    self.assertEquals(0, shard(('num', '1')))
+    self.assertEquals(7, shard(('num', '8')))
+    self.assertEquals(0, shard(('num', '9')))
+
 ################################################################################
 
 class TestWorkQueueHandler(webapp.RequestHandler):
@@ -151,7 +177,7 @@ class QueryAndOwnTest(unittest.TestCase):
     # Retrieve work successfully.
     work = main.query_and_own(TestWork, self.query, 60)
     work_key = str(work.key())
-    self.assertEquals('owned', memcache.get(work_key))
+    self.assertEquals(work.lease_token, memcache.get(work_key))
 
     # Verify that the work cannot be owned again without memcache expiry.
     other_query = 'WHERE index = %d' % work.index
@@ -160,7 +186,8 @@ class QueryAndOwnTest(unittest.TestCase):
     self.assertTrue(memcache.delete(work_key))
     other_work = main.query_and_own(TestWork, other_query, 60)
     self.assertEquals(other_work.key(), work.key())
-    self.assertEquals('owned', memcache.get(work_key))
+    self.assertEquals(other_work.lease_token, memcache.get(work_key))
+    self.assertNotEquals(work.lease_token, other_work.lease_token)
 
     # Verify that other work that's not already owned can be owned. We know
     # this test is valid because the lock_ratio means that we will try to lock
@@ -168,7 +195,8 @@ class QueryAndOwnTest(unittest.TestCase):
     more_work = main.query_and_own(TestWork, self.query, 60,
                                   lock_ratio=len(self.test_work))
     self.assertNotEquals(more_work.key(), work.key())
-    self.assertEquals('owned', memcache.get(str(more_work.key())))
+    self.assertEquals(more_work.lease_token,
+                      memcache.get(str(more_work.key())))
     for w in self.test_work:
       if w.key() != more_work.key() and w.key() != work.key():
         self.assertTrue(memcache.get(str(w.key())) is None)
@@ -179,8 +207,11 @@ class QueryAndOwnTest(unittest.TestCase):
     work = main.query_and_own(TestWork, self.query, 60, work_count=3)
     self.assertEquals(set(w.key() for w in work),
                       set(w.key() for w in self.test_work))
+    lease_token = work[0].lease_token
+    for w in work:
+      self.assertEquals(lease_token, w.lease_token)
     for w in self.test_work:
-      self.assertEquals('owned', memcache.get(str(w.key())))
+      self.assertEquals(lease_token, memcache.get(str(w.key())))
 
     # Re-acquiring a sub-set of the work_count.
     redo_work = work[1]
@@ -189,12 +220,105 @@ class QueryAndOwnTest(unittest.TestCase):
     more_work = main.query_and_own(TestWork, self.query, 60, work_count=3)
     self.assertEquals(1, len(more_work))
     self.assertEquals(redo_work.key(), more_work[0].key())
-    self.assertEquals('owned', memcache.get(redo_work_key))
+    self.assertEquals(more_work[0].lease_token, memcache.get(redo_work_key))
+
+  def testQueryAndOwn_inOrder(self):
+    """Tests owning work strictly in the order of the query."""
+    self.put_test_work()
+    work = main.query_and_own(TestWork, self.query, 60, work_count=2,
+                              in_order=True)
+    self.assertEquals([2, 1], [w.index for w in work])
+    work = main.query_and_own(TestWork, self.query, 60, in_order=True)
+    self.assertEquals(0, work.index)
+
+  def testQueryAndOwn_leaseToken(self):
+    """Tests supplying the lease token to use for owned work."""
+    self.put_test_work()
+    work = main.query_and_own(TestWork, self.query, 60, work_count=3,
+                              lease_token='my-token')
+    self.assertEquals(3, len(work))
+    for w in work:
+      self.assertEquals('my-token', w.lease_token)
+      self.assertEquals('my-token', memcache.get(str(w.key())))
+
+  def testReleaseLeases(self):
+    """Tests that only leases still owned by the worker are released."""
+    self.put_test_work()
+    work = main.query_and_own(TestWork, self.query, 60, work_count=3)
+    stolen_key = str(work[0].key())
+    memcache.set(stolen_key, 'some other worker')
+
+    main.release_leases(work)
+    self.assertEquals('some other worker', memcache.get(stolen_key))
+    for w in work[1:]:
+      self.assertTrue(memcache.get(str(w.key())) is None)
+
+    # Work that was never owned is left alone.
+    main.release_leases([TestWork.get(stolen_key)])
+    self.assertEquals('some other worker', memcache.get(stolen_key))
+
+################################################################################
+
+SubscriberCountShard = main.SubscriberCountShard
+
+
+class SubscriberCountShardTest(unittest.TestCase):
+  """Tests for the SubscriberCountShard model class."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.topic = 'http://example.com/my-topic'
+    self.topic2 = 'http://example.com/second-topic'
+
+  def testIncrement(self):
+    self.assertEquals(0, SubscriberCountShard.get_count(self.topic))
+    for i in xrange(5):
+      SubscriberCountShard.increment(self.topic)
+    SubscriberCountShard.increment(self.topic, -2)
+    self.assertEquals(3, SubscriberCountShard.get_count(self.topic))
+    self.assertEquals(0, SubscriberCountShard.get_count(self.topic2))
+    self.assertEquals(
+        3, sum(s.count for s in SubscriberCountShard.all()))
+
+  def testGetCounts(self):
+    """Tests getting counts for many topics across multiple batches."""
+    old_batch_size = main.MAX_BATCH_SIZE
+    main.MAX_BATCH_SIZE = 3
+    try:
+      for i in xrange(3):
+        SubscriberCountShard.increment(self.topic)
+      SubscriberCountShard.increment(self.topic2, 2)
+      self.assertEquals({self.topic: 3, self.topic2: 2},
+                        SubscriberCountShard.get_counts(
+                            [self.topic, self.topic2, self.topic]))
+    finally:
+      main.MAX_BATCH_SIZE = old_batch_size
+
+  def testNeverNegative(self):
+    SubscriberCountShard.increment(self.topic, -1)
+    self.assertEquals(0, SubscriberCountShard.get_count(self.topic))
+
+  def testCached(self):
+    SubscriberCountShard.increment(self.topic)
+    self.assertEquals(1, SubscriberCountShard.get_count(self.topic))
+    db.delete(SubscriberCountShard.all())
+    self.assertEquals(1, SubscriberCountShard.get_count(self.topic))
+    memcache.flush_all()
+    self.assertEquals(0, SubscriberCountShard.get_count(self.topic))
+
+  def testReconcile(self):
+    SubscriberCountShard.increment(self.topic, 5)
+    SubscriberCountShard.reconcile(self.topic, 2)
+    self.assertEquals(2, SubscriberCountShard.get_count(self.topic))
+    SubscriberCountShard.reconcile(self.topic, 7)
+    self.assertEquals(7, SubscriberCountShard.get_count(self.topic))
 
 ################################################################################
 
 KnownFeed = main.KnownFeed
 
+
 class KnownFeedTest(unittest.TestCase):
   """Tests for the KnownFeed model class."""
 
@@ -302,6 +426,86 @@ class SubscriptionTest(unittest.TestCase):
     self.assertEquals(Subscription.STATE_VERIFIED,
                       self.get_subscription().subscription_state)
 
+  def testInsert_renews(self):
+    """Tests that subscribing again extends the subscription's lease."""
+    start = datetime.datetime.utcnow()
+    later = start + datetime.timedelta(days=10)
+    self.assertTrue(Subscription.insert(self.callback, self.topic,
+                                        now=lambda: start))
+    self.assertEquals(start + main.EXPIRATION_DELTA,
+                      self.get_subscription().expiration_time)
+    self.assertFalse(Subscription.insert(self.callback, self.topic,
+                                         now=lambda: later))
+    self.assertEquals(later + main.EXPIRATION_DELTA,
+                      self.get_subscription().expiration_time)
+
+  def testRemoveExpired(self):
+    """Tests deleting subscriptions that have expired."""
+    start = datetime.datetime.utcnow()
+    Subscription.insert(self.callback, self.topic, now=lambda: start)
+    Subscription.request_insert(self.callback2, self.topic2, 'token',
+                                now=lambda: start)
+    Subscription.insert(self.callback3, self.topic,
+                        now=lambda: start + datetime.timedelta(days=10))
+
+    expired = start + main.EXPIRATION_DELTA
+    self.assertFalse(self.get_subscription().is_expired(lambda: start))
+    self.assertTrue(self.get_subscription().is_expired(lambda: expired))
+    self.assertEquals((0, set()),
+                      Subscription.remove_expired(now=lambda: start))
+    self.assertEquals((2, set([self.topic, self.topic2])),
+                      Subscription.remove_expired(now=lambda: expired))
+    self.assertTrue(self.get_subscription() is None)
+    self.assertEquals([self.callback3],
+                      [s.callback for s in Subscription.all()])
+
+  def testRemoveExpired_count(self):
+    """Tests that only a limited number of subscriptions are removed."""
+    start = datetime.datetime.utcnow()
+    for callback in (self.callback, self.callback2, self.callback3):
+      Subscription.insert(callback, self.topic, now=lambda: start)
+    expired = start + main.EXPIRATION_DELTA
+    self.assertEquals((2, set([self.topic])),
+                      Subscription.remove_expired(now=lambda: expired,
+                                                  count=2))
+    self.assertEquals(1, Subscription.all().count())
+
+  def testSubscriberCount(self):
+    """Tests that only verified subscriptions are counted."""
+    get_count = lambda: SubscriberCountShard.get_count(self.topic)
+    Subscription.request_insert(self.callback, self.topic, 'token')
+    self.assertEquals(0, get_count())
+    Subscription.insert(self.callback, self.topic)
+    self.assertEquals(1, get_count())
+    Subscription.insert(self.callback, self.topic)
+    self.assertEquals(1, get_count())
+    Subscription.insert(self.callback2, self.topic)
+    self.assertEquals(2, get_count())
+    Subscription.request_remove(self.callback, self.topic, 'token')
+    self.assertEquals(1, get_count())
+    Subscription.remove(self.callback, self.topic)
+    self.assertEquals(1, get_count())
+    Subscription.remove(self.callback2, self.topic)
+    self.assertEquals(0, get_count())
+
+  def testSubscriberCount_removeExpired(self):
+    """Tests that sweeping expired subscriptions updates the count."""
+    start = datetime.datetime.utcnow()
+    Subscription.insert(self.callback, self.topic, now=lambda: start)
+    Subscription.insert(self.callback2, self.topic,
+                        now=lambda: start + datetime.timedelta(days=1))
+    self.assertEquals(2, SubscriberCountShard.get_count(self.topic))
+    Subscription.remove_expired(now=lambda: start + main.EXPIRATION_DELTA)
+    self.assertEquals(1, SubscriberCountShard.get_count(self.topic))
+
+  def testHasSubscribers_uncounted(self):
+    """Tests subscriptions that were verified before they were counted."""
+    self.assertTrue(Subscription.insert(self.callback, self.topic))
+    db.delete(SubscriberCountShard.all())
+    memcache.flush_all()
+    self.assertEquals(0, SubscriberCountShard.get_count(self.topic))
+    self.assertTrue(Subscription.has_subscribers(self.topic))
+
   def testRemove(self):
     self.assertFalse(Subscription.remove(self.callback, self.topic))
     self.assertTrue(Subscription.request_insert(
@@ -386,6 +590,25 @@ class SubscriptionTest(unittest.TestCase):
     self.assertEquals(all_keys[1:], key_list(all_callbacks[1]))
     self.assertEquals(all_keys[2:], key_list(all_callbacks[2]))
 
+  def testGetSubscribers_withRange(self):
+    """Tests retrieving subscribers within a range of callback hashes."""
+    self.assertTrue(Subscription.insert(self.callback, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.assertTrue(Subscription.insert(self.callback3, self.topic))
+    all_subs = Subscription.get_subscribers(self.topic, 10)
+    all_hashes = [s.callback_hash for s in all_subs]
+
+    def hash_list(**kwargs):
+      sub_list = Subscription.get_subscribers(self.topic, 10, **kwargs)
+      return [s.callback_hash for s in sub_list]
+
+    self.assertEquals(all_hashes[1:], hash_list(range_start=all_hashes[1]))
+    self.assertEquals(all_hashes[:1], hash_list(range_end=all_hashes[1]))
+    self.assertEquals(all_hashes[1:2], hash_list(range_start=all_hashes[1],
+                                                 range_end=all_hashes[2]))
+    self.assertEquals(all_hashes[2:], hash_list(
+        starting_at_callback=all_subs[2].callback, range_start=all_hashes[1]))
+
   def testGetSubscribers_multipleTopics(self):
     """Tests that separate topics do not overlap in subscriber queries."""
     self.assertEquals([], Subscription.get_subscribers(self.topic2, 10))
@@ -418,6 +641,117 @@ class SubscriptionTest(unittest.TestCase):
     work3 = Subscription.get_confirm_work()
     self.assertTrue(work3 is None)
 
+  def testGetConfirmWork_sharded(self):
+    """Verifies that confirmation work is only retrieved from its shard."""
+    self.assertTrue(Subscription.request_insert(self.callback, self.topic,
+                                                'token'))
+    shard = Subscription.get_work_shard(self.callback, self.topic)
+    other_shard = (shard + 1) % main.SUBSCRIPTION_CONFIRM_SHARDS
+    self.assertEquals(shard, self.get_subscription().work_shard)
+    self.assertTrue(Subscription.get_confirm_work(shard=other_shard) is None)
+    work = Subscription.get_confirm_work(shard=shard)
+    self.assertEquals(self.get_subscription().key(), work.key())
+
+  def testRecordDeliveries_suspend(self):
+    """Tests suspending a subscription after repeated delivery failures."""
+    start = datetime.datetime.utcnow()
+    self.assertTrue(Subscription.insert(self.callback, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.assertEquals(2, SubscriberCountShard.get_count(self.topic))
+    later = lambda: start + datetime.timedelta(days=2)
+
+    for i in xrange(2):
+      self.assertEquals([], Subscription.record_deliveries(
+          [], [self.get_subscription()], now=later, max_failures=3))
+    self.assertEquals(2, self.get_subscription().delivery_failures)
+
+    suspended = Subscription.record_deliveries(
+        [], [self.get_subscription()], now=later, max_failures=3)
+    self.assertEquals([self.callback], [s.callback for s in suspended])
+    self.assertEquals(Subscription.STATE_SUSPENDED,
+                      self.get_subscription().subscription_state)
+    self.assertEquals([self.callback2], [
+        s.callback for s in Subscription.get_subscribers(self.topic, 10)])
+    self.assertEquals(1, SubscriberCountShard.get_count(self.topic))
+
+    # Suspended subscriptions are not updated any more.
+    self.assertEquals([], Subscription.record_deliveries(
+        [self.get_subscription()], [], now=later))
+    self.assertEquals(Subscription.STATE_SUSPENDED,
+                      self.get_subscription().subscription_state)
+
+  def testRecordDeliveries_recentSuccess(self):
+    """Tests that recently reachable subscriptions are not suspended."""
+    start = datetime.datetime.utcnow()
+    self.assertTrue(Subscription.insert(self.callback, self.topic))
+    Subscription.record_deliveries(
+        [self.get_subscription()], [], now=lambda: start)
+    self.assertEquals(start, self.get_subscription().last_delivery_success)
+
+    now = lambda: start + datetime.timedelta(hours=1)
+    for i in xrange(5):
+      self.assertEquals([], Subscription.record_deliveries(
+          [], [self.get_subscription()], now=now, max_failures=3,
+          suspend_period=datetime.timedelta(hours=2)))
+    sub = self.get_subscription()
+    self.assertEquals(5, sub.delivery_failures)
+    self.assertEquals(Subscription.STATE_VERIFIED, sub.subscription_state)
+
+    # A success resets the failures.
+    Subscription.record_deliveries([sub], [], now=now)
+    sub = self.get_subscription()
+    self.assertEquals(0, sub.delivery_failures)
+    self.assertEquals(now(), sub.last_delivery_success)
+
+  def testRecordDeliveries_successUpdatePeriod(self):
+    """Tests that successes are only written once in a while."""
+    start = datetime.datetime.utcnow()
+    self.assertTrue(Subscription.insert(self.callback, self.topic))
+    Subscription.record_deliveries(
+        [self.get_subscription()], [], now=lambda: start)
+    Subscription.record_deliveries(
+        [self.get_subscription()], [],
+        now=lambda: start + datetime.timedelta(minutes=1))
+    self.assertEquals(start, self.get_subscription().last_delivery_success)
+
+    later = start + main.SUBSCRIPTION_SUCCESS_UPDATE_PERIOD
+    Subscription.record_deliveries(
+        [self.get_subscription()], [], now=lambda: later)
+    self.assertEquals(later, self.get_subscription().last_delivery_success)
+
+  def suspend_subscription(self):
+    """Inserts the test subscription and suspends it."""
+    self.assertTrue(Subscription.insert(self.callback, self.topic))
+    later = datetime.datetime.utcnow() + datetime.timedelta(days=2)
+    self.assertEquals(1, len(Subscription.record_deliveries(
+        [], [self.get_subscription()], now=lambda: later, max_failures=1)))
+    self.assertEquals(0, SubscriberCountShard.get_count(self.topic))
+
+  def testInsert_suspended(self):
+    """Tests that verifying a suspended subscription resumes it."""
+    self.suspend_subscription()
+    self.assertFalse(Subscription.insert(self.callback, self.topic))
+    sub = self.get_subscription()
+    self.assertEquals(Subscription.STATE_VERIFIED, sub.subscription_state)
+    self.assertEquals(0, sub.delivery_failures)
+    self.assertEquals(1, SubscriberCountShard.get_count(self.topic))
+
+  def testRequestInsert_suspended(self):
+    """Tests that asking to subscribe again re-verifies a suspended one."""
+    self.suspend_subscription()
+    self.assertFalse(Subscription.request_insert(
+        self.callback, self.topic, 'new token'))
+    sub = self.get_subscription()
+    self.assertEquals(Subscription.STATE_NOT_VERIFIED, sub.subscription_state)
+    self.assertEquals('new token', sub.verify_token)
+    self.assertEquals(sub.key(), Subscription.get_confirm_work().key())
+
+  def testRemove_suspended(self):
+    """Tests that removing a suspended subscription keeps the count right."""
+    self.suspend_subscription()
+    self.assertTrue(Subscription.remove(self.callback, self.topic))
+    self.assertEquals(0, SubscriberCountShard.get_count(self.topic))
+
   def testConfirmFailed(self):
     """Tests retry delay periods when a subscription confirmation fails."""
     start = datetime.datetime.utcnow()
@@ -510,10 +844,90 @@ class FeedToFetchTest(unittest.TestCase):
     memcache.delete(str(feed.key()))
     self.assertTrue(FeedToFetch.get_work() is None)
 
+  def testGetWork_sharded(self):
+    """Tests that work is only retrieved from the requested shard."""
+    FeedToFetch.insert([self.topic])
+    shard = main.get_work_shard(self.topic, main.FEED_PULL_SHARDS)
+    other_shard = (shard + 1) % main.FEED_PULL_SHARDS
+    self.assertEquals(shard, FeedToFetch.get_by_topic(self.topic).work_shard)
+    self.assertTrue(FeedToFetch.get_work(shard=other_shard) is None)
+    self.assertEquals(self.topic, FeedToFetch.get_work(shard=shard).topic)
+
+  def testGetPriority(self):
+    """Tests how the priority of fetching a feed is determined."""
+    now = datetime.datetime.utcnow()
+    get_priority = FeedToFetch.get_priority
+    self.assertEquals(0, get_priority(False, 0, None, now))
+    self.assertEquals(main.FEED_PULL_PUBLISH_PRIORITY,
+                      get_priority(True, 0, None, now))
+    self.assertEquals(main.FEED_PULL_SUBSCRIBER_PRIORITY,
+                      get_priority(False, 9, None, now))
+    self.assertEquals(3 * main.FEED_PULL_SUBSCRIBER_PRIORITY,
+                      get_priority(False, 999, None, now))
+    self.assertEquals(main.FEED_PULL_CHANGE_PRIORITY,
+                      get_priority(False, 0, now, now))
+    half_window = main.FEED_PULL_CHANGE_WINDOW / 2
+    self.assertEquals(main.FEED_PULL_CHANGE_PRIORITY / 2,
+                      get_priority(False, 0, now - half_window, now))
+    self.assertEquals(0, get_priority(
+        False, 0, now - main.FEED_PULL_CHANGE_WINDOW, now))
+
+  def testInsert_priority(self):
+    """Tests that feeds with a higher priority are fetched first."""
+    start = datetime.datetime.utcnow()
+    now = lambda: start
+    record = FeedRecord.get_or_create(self.topic3)
+    record.last_changed = start
+    record.put()
+    record.cache_last_changed()
+    for i in xrange(9):
+      Subscription.insert('http://example.com/callback%d' % i, self.topic2)
+
+    FeedToFetch.insert([self.topic, self.topic2, self.topic3], now=now)
+    feed = FeedToFetch.get_by_topic(self.topic2)
+    self.assertEquals(main.FEED_PULL_SUBSCRIBER_PRIORITY, feed.priority)
+    self.assertEquals(start - datetime.timedelta(seconds=feed.priority),
+                      feed.eta)
+    self.assertEquals([self.topic3, self.topic2, self.topic],
+                      [w.topic for w in FeedToFetch.get_work(count=3)])
+
+  def testInsert_publish(self):
+    """Tests that published feeds are fetched before polled feeds."""
+    FeedToFetch.insert([self.topic, self.topic2])
+    FeedToFetch.insert([self.topic3], publish=True)
+    self.assertEquals(self.topic3, FeedToFetch.get_work().topic)
+
+  def testInsert_batches(self):
+    """Tests inserting more feeds than fit in a single Datastore call."""
+    old_batch_size = main.MAX_BATCH_SIZE
+    main.MAX_BATCH_SIZE = 2
+    try:
+      all_topics = ['http://example.com/feed%d' % i for i in xrange(5)]
+      FeedToFetch.insert(all_topics)
+    finally:
+      main.MAX_BATCH_SIZE = old_batch_size
+    self.assertEquals(set(all_topics),
+                      set(w.topic for w in FeedToFetch.get_work(count=10)))
+
+  def testGetWork_count(self):
+    """Tests retrieving multiple feeds to fetch at once."""
+    all_topics = [self.topic, self.topic2, self.topic3]
+    self.assertEquals([], FeedToFetch.get_work(count=1))
+    self.assertEquals([], FeedToFetch.get_work(count=5))
+    FeedToFetch.insert(all_topics)
+    work = FeedToFetch.get_work(count=1)
+    self.assertEquals(1, len(work))
+    more_work = FeedToFetch.get_work(count=5)
+    self.assertEquals(2, len(more_work))
+    self.assertEquals(set(all_topics),
+                      set(w.topic for w in work + more_work))
+    self.assertEquals([], FeedToFetch.get_work(count=5))
+
 ################################################################################
 
 FeedEntryRecord = main.FeedEntryRecord
 EventToDeliver = main.EventToDeliver
+FailedCallback = main.FailedCallback
 
 
 class EventToDeliverTest(unittest.TestCase):
@@ -545,9 +959,9 @@ class EventToDeliverTest(unittest.TestCase):
           of their callback hashes.
         sub_keys: Key instances corresponding to the entries in 'sub_list'.
     """
-    event = EventToDeliver.create_event_for_topic(
+    event, event_payload = EventToDeliver.create_event_for_topic(
         self.topic, main.ATOM, self.header_footer, self.test_payloads)
-    event.put()
+    db.put([event, event_payload])
     work_key = str(event.key())
 
     Subscription.insert(self.callback, self.topic)
@@ -560,9 +974,17 @@ class EventToDeliverTest(unittest.TestCase):
 
     return (event, work_key, sub_list, sub_keys)
 
+  def get_failed(self):
+    """Returns the stored FailedCallbacks in callback hash order."""
+    return list(FailedCallback.all().order('callback_hash'))
+
+  def get_failed_keys(self):
+    """Returns the Subscription keys of the failed callbacks."""
+    return [f.get_subscription_key(self.topic) for f in self.get_failed()]
+
   def testCreateEventForTopic(self):
     """Tests that the payload of an event is properly formed."""
-    event = EventToDeliver.create_event_for_topic(
+    event, event_payload = EventToDeliver.create_event_for_topic(
         self.topic, main.ATOM, self.header_footer, self.test_payloads)
     expected_data = \
 u"""<?xml version="1.0" encoding="utf-8"?>
@@ -573,7 +995,9 @@ u"""<?xml version="1.0" encoding="utf-8"?>
 <entry>article2</entry>
 <entry>article3</entry>
 </feed>"""
-    self.assertEquals(expected_data, event.payload)
+    self.assertEquals(expected_data, event_payload.payload)
+    self.assertEquals(sha1_hash(expected_data), event.payload_hash)
+    self.assertEquals(event.parent_key(), event_payload.parent_key())
 
   def testCreateEventForTopic_Rss(self):
     """Tests that the RSS payload is properly formed."""
@@ -584,7 +1008,7 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     ]
     self.header_footer = (
         '<rss>\n<channel>\n<stuff>blah</stuff>\n<xmldata/></channel>\n</rss>')
-    event = EventToDeliver.create_event_for_topic(
+    event, event_payload = EventToDeliver.create_event_for_topic(
         self.topic, main.RSS, self.header_footer, self.test_payloads)
     expected_data = \
 u"""<?xml version="1.0" encoding="utf-8"?>
@@ -597,13 +1021,49 @@ u"""<?xml version="1.0" encoding="utf-8"?>
 <item>article3</item>
 </channel>
 </rss>"""
-    self.assertEquals(expected_data, event.payload)
+    self.assertEquals(expected_data, event_payload.payload)
+    self.assertEquals(sha1_hash(expected_data), event.payload_hash)
+    self.assertEquals(event.parent_key(), event_payload.parent_key())
 
   def testCreateEvent_badHeaderFooter(self):
     """Tests when the header/footer data in an event is invalid."""
     self.assertRaises(AssertionError, EventToDeliver.create_event_for_topic,
         self.topic, main.ATOM, '<feed>has no end tag', self.test_payloads)
 
+  def testGetPayload(self):
+    """Tests retrieving an event's payload from its shared EventPayload."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    event = EventToDeliver.get(work_key)
+    self.assertTrue(event.payload is None)
+    self.assertTrue('<entry>article2</entry>' in event.get_payload())
+
+    db.delete(main.EventPayload.create_key(self.topic, event.payload_hash))
+    self.assertTrue(event.get_payload() is None)
+
+  def testGetPayload_inline(self):
+    """Tests events that store their payload directly."""
+    event = EventToDeliver(topic=self.topic, topic_hash=sha1_hash(self.topic),
+                           payload=u'my payload',
+                           last_modified=datetime.datetime.utcnow())
+    self.assertEquals(u'my payload', event.get_payload())
+
+  def testUpdate_deletesPayload(self):
+    """Tests that a payload is deleted once no events refer to it."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    payload_key = main.EventPayload.create_key(self.topic, event.payload_hash)
+    event2 = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads)[0]
+    event2.put()
+
+    more, subs = event.get_next_subscribers()
+    event.update(more, [])
+    self.assertTrue(EventToDeliver.get(work_key) is None)
+    self.assertTrue(db.get(payload_key) is not None)
+
+    more, subs = event2.get_next_subscribers()
+    event2.update(more, [])
+    self.assertTrue(db.get(payload_key) is None)
+
   def testNormal_noFailures(self):
     """Tests that event delivery with no failures will delete the event."""
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
@@ -629,7 +1089,8 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     event.update(more, [sub_list[0]])
     event = EventToDeliver.get(event.key())
     self.assertEquals(EventToDeliver.NORMAL, event.delivery_mode)
-    self.assertEquals([sub_list[0].key()], event.failed_callbacks)
+    self.assertEquals([sub_list[0].key()], self.get_failed_keys())
+    self.assertEquals(1, event.failed_count)
     self.assertEquals(self.callback2, event.last_callback)
     self.assertTrue(memcache.get(work_key) is None)
 
@@ -642,7 +1103,8 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     self.assertEquals('', event.last_callback)
 
     self.assertEquals([s.key() for s in sub_list],
-                      event.failed_callbacks)
+                      self.get_failed_keys())
+    self.assertEquals(4, event.failed_count)
     self.assertTrue(memcache.get(work_key) is None)
 
   def testUpdate_actuallyNoMoreCallbacks(self):
@@ -671,150 +1133,552 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     self.assertTrue(event is not None)
     self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
 
-  def testGetNextSubscribers_retriesFinallySuccessful(self):
-    """Tests retries until all subscribers are successful."""
+  def testConvertFailedCallbacks(self):
+    """Tests moving failed callbacks stored by older versions."""
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    event.failed_callbacks = sub_keys[:3]
+    event.put()
+    Subscription.remove(sub_list[2].callback, self.topic)
 
-    # Simulate that callback 2 is successful and the rest fail.
-    self.assertTrue(memcache.set(work_key, 'owned'))
-    more, subs = event.get_next_subscribers(chunk_size=2)
-    event.update(more, sub_list[:1])
-    event = EventToDeliver.get(event.key())
-    self.assertTrue(more)
-    self.assertEquals(self.callback3, event.last_callback)
-    self.assertEquals(EventToDeliver.NORMAL, event.delivery_mode)
+    now = datetime.datetime.utcnow()
+    event = EventToDeliver.get(work_key)
+    self.assertTrue(event.convert_failed_callbacks(now=lambda: now))
+    self.assertEquals([], event.failed_callbacks)
+    self.assertEquals(2, event.failed_count)
 
-    self.assertTrue(memcache.set(work_key, 'owned'))
-    more, subs = event.get_next_subscribers(chunk_size=2)
-    event.update(more, sub_list[2:])
-    event = EventToDeliver.get(event.key())
-    self.assertEquals('', event.last_callback)
-    self.assertFalse(more)
-    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
+    event = EventToDeliver.get(work_key)
+    self.assertEquals([], event.failed_callbacks)
+    self.assertEquals(2, event.failed_count)
+    self.assertEquals(sub_keys[:2], self.get_failed_keys())
+    self.assertEquals([now, now], [f.eta for f in self.get_failed()])
+    self.assertFalse(event.convert_failed_callbacks())
+
+  def testGetNextSubscribers_skipsExpired(self):
+    """Tests that expired subscriptions are not delivered to."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    sub_list[1].expiration_time = datetime.datetime.utcnow()
+    sub_list[1].put()
 
-    # Now getting the next subscribers will returned the failed ones.
-    self.assertTrue(memcache.set(work_key, 'owned'))
     more, subs = event.get_next_subscribers(chunk_size=2)
-    expected = sub_keys[:1] + sub_keys[2:3]
-    self.assertEquals(expected, [s.key() for s in subs])
-    event.update(more, subs)
-    event = EventToDeliver.get(event.key())
     self.assertTrue(more)
-    self.assertEquals(self.callback, event.last_callback)
-    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
-
-    # This will get the last of the failed subscribers but *not* include the
-    # sentinel value of event.last_callback, since that marks the end of this
-    # attempt.
-    self.assertTrue(memcache.set(work_key, 'owned'))
+    self.assertEquals([sub_keys[0]], [s.key() for s in subs])
     more, subs = event.get_next_subscribers(chunk_size=2)
-    expected = sub_keys[3:]
-    self.assertEquals(expected, [s.key() for s in subs])
-    event.update(more, subs)
-    event = EventToDeliver.get(event.key())
     self.assertFalse(more)
-    self.assertEquals('', event.last_callback)
-    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
-    self.assertEquals(sub_keys[:1] + sub_keys[2:], event.failed_callbacks)
+    self.assertEquals(sub_keys[2:], [s.key() for s in subs])
 
-    # Now simulate all retries being successful one chunk at a time.
-    self.assertTrue(memcache.set(work_key, 'owned'))
-    more, subs = event.get_next_subscribers(chunk_size=2)
-    expected = sub_keys[:1] + sub_keys[2:3]
-    self.assertEquals(expected, [s.key() for s in subs])
-    event.update(more, [])
-    event = EventToDeliver.get(event.key())
-    self.assertTrue(more)
-    self.assertEquals(self.callback, event.last_callback)
-    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
-    self.assertEquals(sub_keys[3:], event.failed_callbacks)
+  def testGetTotalSubscribers(self):
+    """Tests counting subscribers while paging through them."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    more, subs = event.get_next_subscribers(chunk_size=3)
+    self.assertTrue(event.get_total_subscribers(more) is None)
+    more, subs = event.get_next_subscribers(chunk_size=3)
+    self.assertEquals(4, event.get_total_subscribers(more))
 
-    self.assertTrue(memcache.set(work_key, 'owned'))
-    more, subs = event.get_next_subscribers(chunk_size=2)
-    expected = sub_keys[3:]
-    self.assertEquals(expected, [s.key() for s in subs])
-    event.update(more, [])
+  def testGetTotalSubscribers_split(self):
+    """Tests that events split into ranges do not know the total."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    more, subs = event.get_next_subscribers(chunk_size=1)
+    self.assertTrue(event.split_fanout(2))
+    more, subs = event.get_next_subscribers(chunk_size=10)
     self.assertFalse(more)
-    self.assertTrue(EventToDeliver.get(work_key) is None)
-
-  def testGetNextSubscribers_failedFewerThanChunkSize(self):
-    """Tests when there are fewer failed callbacks than the chunk size.
+    self.assertTrue(event.get_total_subscribers(more) is None)
 
-    Ensures that we step through retry attempts when there is only a single
-    chunk to go through on each retry iteration.
-    """
+  def testRecordRetries_finallySuccessful(self):
+    """Tests retries until all failed callbacks are delivered."""
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    payload_key = main.EventPayload.create_key(self.topic, event.payload_hash)
 
     # Simulate that callback 2 is successful and the rest fail.
-    self.assertTrue(memcache.set(work_key, 'owned'))
-    more, subs = event.get_next_subscribers(chunk_size=2)
-    event.update(more, sub_list[:1])
+    more, subs = event.get_next_subscribers(chunk_size=4)
+    event.update(more, sub_list[:1] + sub_list[2:])
     event = EventToDeliver.get(event.key())
-    self.assertTrue(more)
-    self.assertEquals(self.callback3, event.last_callback)
-    self.assertEquals(EventToDeliver.NORMAL, event.delivery_mode)
+    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
+    self.assertEquals(3, event.failed_count)
 
-    self.assertTrue(memcache.set(work_key, 'owned'))
-    more, subs = event.get_next_subscribers(chunk_size=2)
-    event.update(more, sub_list[2:])
+    # One more failure and one success.
+    failed = self.get_failed()
+    self.assertFalse(EventToDeliver.record_retries(
+        event.key(), failed[:1], failed[1:2]))
     event = EventToDeliver.get(event.key())
-    self.assertEquals('', event.last_callback)
-    self.assertFalse(more)
-    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
-    self.assertEquals(1, event.retry_attempts)
+    self.assertEquals(2, event.failed_count)
+    self.assertEquals(sub_keys[2:], self.get_failed_keys())
+    self.assertEquals(1, self.get_failed()[0].retry_attempts)
 
-    # Now attempt a retry with a chunk size equal to the number of callbacks.
-    self.assertTrue(memcache.set(work_key, 'owned'))
-    more, subs = event.get_next_subscribers(chunk_size=3)
+    # The rest are successful, which finishes the event.
+    failed = self.get_failed()
+    self.assertTrue(EventToDeliver.record_retries(event.key(), failed, []))
+    self.assertTrue(EventToDeliver.get(work_key) is None)
+    self.assertEquals(0, FailedCallback.all().count())
+    self.assertTrue(db.get(payload_key) is None)
+
+  def testRecordRetries_normalDeliveryNotDone(self):
+    """Tests retries that finish before normal delivery of the event does."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    more, subs = event.get_next_subscribers(chunk_size=2)
     event.update(more, subs)
     event = EventToDeliver.get(event.key())
-    self.assertFalse(more)
-    self.assertEquals(2, event.retry_attempts)
+    self.assertEquals(EventToDeliver.NORMAL, event.delivery_mode)
+    self.assertEquals(2, event.failed_count)
+
+    failed = self.get_failed()
+    self.assertFalse(EventToDeliver.record_retries(event.key(), failed, []))
+    event = EventToDeliver.get(event.key())
+    self.assertEquals(0, event.failed_count)
+    self.assertEquals(self.callback3, event.last_callback)
 
-  def testGetNextSubscribers_giveUp(self):
-    """Tests retry delay amounts until we finally give up on event delivery.
+    # Normal delivery picks up from where it was and then completes.
+    more, subs = event.get_next_subscribers(chunk_size=2)
+    self.assertEquals(sub_keys[2:], [s.key() for s in subs])
+    event.update(more, [])
+    self.assertTrue(EventToDeliver.get(work_key) is None)
 
-    Verifies retry delay logic works properly.
-    """
+  def testRecordRetries_giveUp(self):
+    """Tests retry delay amounts until we finally give up on a callback."""
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
 
     start = datetime.datetime.utcnow()
     def now():
       return start
 
-    self.assertTrue(EventToDeliver.get_work(now=now) is not None)
-    memcache.delete(str(event.key()))
+    more, subs = event.get_next_subscribers(chunk_size=4)
+    event.update(more, subs[:1], retry_period=5, now=now)
+    failed = self.get_failed()[0]
+    self.assertEquals(start + datetime.timedelta(seconds=5), failed.eta)
+    self.assertEquals(0, failed.retry_attempts)
 
     for i, delay in enumerate((5, 10, 20, 40, 80, 160, 320, 640)):
-      self.assertTrue(memcache.set(work_key, 'owned'))
-      more, subs = event.get_next_subscribers(chunk_size=4)
-      event.update(more, subs, retry_period=5, now=now)
-      event = EventToDeliver.get(event.key())
-      self.assertEquals(i+1, event.retry_attempts)
-      self.assertEquals(event.last_modified,
-                        start + datetime.timedelta(seconds=delay))
-      self.assertFalse(event.totally_failed)
-      # Getting work will yield no events here, since the ETA is
-      # far into the future.
-      self.assertTrue(EventToDeliver.get_work(now=now) is None)
+      EventToDeliver.record_retries(event.key(), [], [failed],
+                                    retry_period=5, now=now)
+      failed = self.get_failed()[0]
+      self.assertEquals(i+1, failed.retry_attempts)
+      self.assertEquals(start + datetime.timedelta(seconds=delay), failed.eta)
+      self.assertFalse(failed.totally_failed)
+      # Getting work will yield nothing here, since the ETA is in the future.
+      self.assertEquals([], FailedCallback.get_work(now=now))
+
+    EventToDeliver.record_retries(event.key(), [], [failed])
+    failed = self.get_failed()[0]
+    self.assertTrue(failed.totally_failed)
+
+    # The event sticks around for debugging.
+    event = EventToDeliver.get(event.key())
+    self.assertEquals(1, event.failed_count)
+    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
 
-    self.assertTrue(memcache.set(work_key, 'owned'))
+  def testFailedCallbackGetWork(self):
+    """Tests retrieving failed callbacks that are due for a retry."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    start = datetime.datetime.utcnow()
     more, subs = event.get_next_subscribers(chunk_size=4)
-    event.update(more, subs)
-    event = EventToDeliver.get(event.key())
-    self.assertTrue(event.totally_failed)
+    event.update(more, subs, retry_period=5, now=lambda: start)
+
+    later = lambda: start + datetime.timedelta(seconds=5)
+    self.assertEquals([], FailedCallback.get_work(now=lambda: start))
+    work = FailedCallback.get_work(now=later, count=3)
+    self.assertEquals(3, len(work))
+    self.assertEquals(1, len(FailedCallback.get_work(now=later, count=3)))
+    self.assertEquals([], FailedCallback.get_work(now=later, count=3))
+
+  def testFailedCallbackGetWork_sharded(self):
+    """Tests retrieving failed callbacks from a single shard."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    start = datetime.datetime.utcnow()
+    more, subs = event.get_next_subscribers(chunk_size=4)
+    event.update(more, subs[:1], retry_period=5, now=lambda: start)
+
+    later = lambda: start + datetime.timedelta(seconds=5)
+    callback = subs[0].callback
+    shard = main.get_work_shard(callback, main.DELIVERY_RETRY_SHARDS)
+    other_shard = (shard + 1) % main.DELIVERY_RETRY_SHARDS
+    self.assertEquals([], FailedCallback.get_work(now=later,
+                                                  shard=other_shard))
+    work = FailedCallback.get_work(now=later, shard=shard)
+    self.assertEquals([callback], [f.callback for f in work])
 
   def testGetWork(self):
-    event1 = EventToDeliver.create_event_for_topic(
-        self.topic, main.ATOM, self.header_footer, self.test_payloads).put()
-    event2 = EventToDeliver.create_event_for_topic(
-        self.topic, main.ATOM, self.header_footer, self.test_payloads).put()
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
     work1 = EventToDeliver.get_work()
     work2 = EventToDeliver.get_work()
     self.assertNotEquals(work1.key(), work2.key())
     work3 = EventToDeliver.get_work()
     self.assertTrue(work3 is None)
 
+  def testGetWork_retryMode(self):
+    """Tests that events only holding failed callbacks are not returned."""
+    event, event_payload = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads)
+    event.delivery_mode = EventToDeliver.RETRY
+    db.put([event, event_payload])
+    self.assertTrue(EventToDeliver.get_work() is None)
+
+  def testGetWork_sharded(self):
+    event, event_payload = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads)
+    db.put([event, event_payload])
+    shard = main.get_work_shard(self.topic, main.EVENT_DELIVERY_SHARDS)
+    other_shard = (shard + 1) % main.EVENT_DELIVERY_SHARDS
+    self.assertEquals(shard, event.work_shard)
+    self.assertTrue(EventToDeliver.get_work(shard=other_shard) is None)
+    self.assertEquals(event.key(), EventToDeliver.get_work(shard=shard).key())
+
+  def testSplitFanout(self):
+    """Tests splitting an event's remaining subscribers into ranges."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    more_subscribers, next_subs = event.get_next_subscribers(chunk_size=1)
+    self.assertTrue(more_subscribers)
+    self.assertEquals(sub_keys[:1], [s.key() for s in next_subs])
+
+    new_events = event.split_fanout(4)
+    self.assertTrue(new_events)
+    ranges = [(e.range_start, e.range_end) for e in [event] + new_events]
+    self.assertEquals('', ranges[0][0])
+    self.assertEquals('', ranges[-1][1])
+    for (unused_start, end), (start, unused_end) in zip(ranges, ranges[1:]):
+      self.assertEquals(end, start)
+    for e in new_events:
+      self.assertEquals(event.parent_key(), e.parent_key())
+      self.assertEquals(event.payload_hash, e.payload_hash)
+      self.assertEquals(EventToDeliver.NORMAL, e.delivery_mode)
+
+    event.update(more_subscribers, [], new_events=new_events)
+    self.assertEquals(len(new_events) + 1, EventToDeliver.all().count())
+    self.assertTrue(memcache.get(work_key) is None)
+
+    # Each remaining subscriber is covered by exactly one of the ranges.
+    found_keys = []
+    for e in EventToDeliver.all():
+      unused_more, next_subs = e.get_next_subscribers(chunk_size=10)
+      found_keys.extend(s.key() for s in next_subs)
+    self.assertEquals(sorted(sub_keys[1:]), sorted(found_keys))
+
+    # Events that have already been split are not split again.
+    self.assertEquals([], event.split_fanout(4))
+
+  def testSplitFanout_noSplit(self):
+    """Tests when events should not be split."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    self.assertEquals([], event.split_fanout(4))
+    event.get_next_subscribers(chunk_size=1)
+    self.assertEquals([], event.split_fanout(1))
+    event.delivery_mode = EventToDeliver.RETRY
+    self.assertEquals([], event.split_fanout(4))
+
+################################################################################
+
+DeliveryStats = main.DeliveryStats
+
+class DeliveryStatsTest(unittest.TestCase):
+  """Tests for the DeliveryStats model class."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.topic = 'http://example.com/my-topic'
+    self.max_chunk_size = main.MAX_EVENT_SUBSCRIBER_CHUNK_SIZE
+    main.MAX_EVENT_SUBSCRIBER_CHUNK_SIZE = 40
+    self.target = main.EVENT_DELIVERY_TARGET_SECONDS
+
+  def tearDown(self):
+    """Resets any external modules modified for testing."""
+    main.MAX_EVENT_SUBSCRIBER_CHUNK_SIZE = self.max_chunk_size
+
+  def testGetOrCreate(self):
+    stats = DeliveryStats.get_or_create(self.topic)
+    self.assertEquals(main.EVENT_SUBSCRIBER_CHUNK_SIZE, stats.chunk_size)
+    self.assertFalse(stats.is_saved())
+    stats.chunk_size = 25
+    stats.put()
+    self.assertEquals(25, DeliveryStats.get_or_create(self.topic).chunk_size)
+
+  def testGetChunkSize(self):
+    stats = DeliveryStats.get_or_create(self.topic)
+    stats.chunk_size = 100
+    self.assertEquals(40, stats.get_chunk_size())
+    stats.chunk_size = 0
+    self.assertEquals(1, stats.get_chunk_size())
+
+  def testGrow(self):
+    stats = DeliveryStats.get_or_create(self.topic)
+    stats.record_delivery(10, True, 0.1)
+    self.assertEquals(20, stats.chunk_size)
+    stats.record_delivery(20, True, 0.1)
+    self.assertEquals(40, stats.chunk_size)
+    stats.record_delivery(40, True, 0.1)
+    self.assertEquals(40, stats.chunk_size)
+    self.assertEquals(0.1, stats.last_elapsed)
+
+  def testPartialChunk(self):
+    """Tests that chunks with no more subscribers do not grow the size."""
+    stats = DeliveryStats.get_or_create(self.topic)
+    stats.record_delivery(10, False, 0.1)
+    self.assertEquals(10, stats.chunk_size)
+
+  def testSteady(self):
+    stats = DeliveryStats.get_or_create(self.topic)
+    stats.record_delivery(10, True, self.target * 0.75)
+    self.assertEquals(10, stats.chunk_size)
+
+  def testShrinkSlow(self):
+    stats = DeliveryStats.get_or_create(self.topic)
+    stats.record_delivery(10, True, self.target + 1)
+    self.assertEquals(5, stats.chunk_size)
+    self.assertEquals(0, stats.deadline_errors)
+
+  def testShrinkDeadline(self):
+    stats = DeliveryStats.get_or_create(self.topic)
+    stats.record_delivery(10, True, 0.1, deadline_exceeded=True)
+    self.assertEquals(5, stats.chunk_size)
+    self.assertEquals(1, stats.deadline_errors)
+    stats.record_delivery(1, True, 0.1, deadline_exceeded=True)
+    self.assertEquals(1, stats.chunk_size)
+    self.assertEquals(2, stats.deadline_errors)
+
+################################################################################
+
+CallbackHostHealth = main.CallbackHostHealth
+
+class CallbackHostHealthTest(unittest.TestCase):
+  """Tests for the CallbackHostHealth class."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.now = datetime.datetime.utcnow()
+    self.host = 'example.com'
+    self.threshold = main.HOST_FAILURE_THRESHOLD
+    main.HOST_FAILURE_THRESHOLD = 2
+
+  def tearDown(self):
+    """Resets any external modules modified for testing."""
+    main.HOST_FAILURE_THRESHOLD = self.threshold
+
+  def testGetHost(self):
+    self.assertEquals(
+        'example.com', CallbackHostHealth.get_host('http://Example.COM/foo'))
+    self.assertEquals(
+        'example.com:8080',
+        CallbackHostHealth.get_host('https://example.com:8080/foo?bar'))
+
+  def testCircuit(self):
+    health = CallbackHostHealth(self.host)
+    self.assertEquals(CallbackHostHealth.CLOSED, health.get_state(self.now))
+    health.record_failure(self.now)
+    self.assertEquals(CallbackHostHealth.CLOSED, health.get_state(self.now))
+    health.record_failure(self.now)
+    self.assertEquals(CallbackHostHealth.OPEN, health.get_state(self.now))
+
+    later = self.now + datetime.timedelta(
+        seconds=main.HOST_CIRCUIT_OPEN_SECONDS)
+    self.assertEquals(CallbackHostHealth.HALF_OPEN, health.get_state(later))
+    health.record_failure(later)
+    self.assertEquals(CallbackHostHealth.OPEN, health.get_state(later))
+
+    even_later = later + datetime.timedelta(
+        seconds=main.HOST_CIRCUIT_OPEN_SECONDS)
+    self.assertEquals(CallbackHostHealth.HALF_OPEN,
+                      health.get_state(even_later))
+    health.record_success()
+    self.assertEquals(CallbackHostHealth.CLOSED,
+                      health.get_state(even_later))
+    self.assertEquals(0, health.failures)
+
+  def testGetAndPutAll(self):
+    other_host = 'other.example.com'
+    health_dict = CallbackHostHealth.get_all([self.host, other_host])
+    self.assertEquals(set([self.host, other_host]), set(health_dict))
+    self.assertEquals(0, health_dict[self.host].failures)
+    health_dict[self.host].record_failure(self.now)
+    health_dict[self.host].record_failure(self.now)
+    CallbackHostHealth.put_all(health_dict.values())
+
+    health_dict = CallbackHostHealth.get_all([self.host, other_host])
+    self.assertEquals(CallbackHostHealth.OPEN,
+                      health_dict[self.host].get_state(self.now))
+    self.assertEquals(CallbackHostHealth.CLOSED,
+                      health_dict[other_host].get_state(self.now))
+
+  def testPutAll_concurrentFailures(self):
+    """Tests that failures recorded by separate workers are all counted."""
+    first = CallbackHostHealth.get_all([self.host])[self.host]
+    second = CallbackHostHealth.get_all([self.host])[self.host]
+    first.record_failure(self.now)
+    second.record_failure(self.now)
+    self.assertEquals(CallbackHostHealth.CLOSED, first.get_state(self.now))
+    CallbackHostHealth.put_all([first])
+    CallbackHostHealth.put_all([second])
+
+    health = CallbackHostHealth.get_all([self.host])[self.host]
+    self.assertEquals(2, health.failures)
+    self.assertEquals(CallbackHostHealth.OPEN, health.get_state(self.now))
+
+    # A success from any worker closes the circuit again.
+    health.record_success()
+    health.record_failure(self.now)
+    CallbackHostHealth.put_all([health])
+    health = CallbackHostHealth.get_all([self.host])[self.host]
+    self.assertEquals(1, health.failures)
+    self.assertEquals(CallbackHostHealth.CLOSED, health.get_state(self.now))
+
+################################################################################
+
+class PrepareAggregateEntriesTest(unittest.TestCase):
+  """Tests for the prepare_aggregate_entries function."""
+
+  def testAddsSource(self):
+    payload = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<feed xmlns="http://www.w3.org/2005/Atom" '
+        'xmlns:thr="http://purl.org/syndication/thread/1.0">\n'
+        '<title>My feed</title><id>tag:feed</id>\n'
+        '<entry><id>tag:first</id><thr:total>1</thr:total></entry>\n'
+        '</feed>')
+    self.assertEquals(
+        ['<entry xmlns="http://www.w3.org/2005/Atom" '
+         'xmlns:thr="http://purl.org/syndication/thread/1.0">'
+         '<source><title>My feed</title><id>tag:feed</id></source>'
+         '<id>tag:first</id><thr:total>1</thr:total></entry>'],
+        main.prepare_aggregate_entries(payload))
+
+  def testKeepsExisting(self):
+    """Tests that existing sources and namespace declarations are kept."""
+    payload = (
+        '<feed xmlns="http://www.w3.org/2005/Atom">'
+        '<id>tag:feed</id>'
+        '<entry xmlns="http://www.w3.org/2005/Atom"><id>tag:first</id>'
+        '<source><id>tag:original</id></source></entry>'
+        '</feed>')
+    self.assertEquals(
+        ['<entry xmlns="http://www.w3.org/2005/Atom"><id>tag:first</id>'
+         '<source><id>tag:original</id></source></entry>'],
+        main.prepare_aggregate_entries(payload))
+
+  def testNotAtom(self):
+    self.assertRaises(
+        feed_diff.Error, main.prepare_aggregate_entries,
+        '<rss><channel><item><guid>1</guid></item></channel></rss>')
+
+################################################################################
+
+DeliveryBatch = main.DeliveryBatch
+
+class DeliveryBatchTest(unittest.TestCase):
+  """Tests for the DeliveryBatch model class."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.now = datetime.datetime.utcnow()
+    self.callback = 'http://example.com/my-callback'
+    self.max_entries = main.DELIVERY_BATCH_MAX_ENTRIES
+    main.DELIVERY_BATCH_MAX_ENTRIES = 3
+    self.window = datetime.timedelta(seconds=main.DELIVERY_BATCH_WINDOW)
+
+  def tearDown(self):
+    """Resets any external modules modified for testing."""
+    main.DELIVERY_BATCH_MAX_ENTRIES = self.max_entries
+
+  def get_batch(self):
+    """Returns the stored DeliveryBatch for the test callback."""
+    return DeliveryBatch.get_by_key_name(
+        main.get_hash_key_name(self.callback))
+
+  def get_entries(self):
+    """Returns all entries waiting for the test callback, oldest first."""
+    entry_list = []
+    for batch_entry in main.DeliveryBatchEntry.get_for_callback(
+        self.callback, 100):
+      entry_list.extend(batch_entry.entries)
+    return entry_list
+
+  def add(self, entry_list, seconds=0):
+    """Adds entries to the test callback's batch at the given time."""
+    DeliveryBatch.add(
+        self.callback, entry_list,
+        now=lambda: self.now + datetime.timedelta(seconds=seconds))
+
+  def testAdd(self):
+    self.add(['<entry>1</entry>'])
+    self.add(['<entry>2</entry>'], seconds=10)
+    batch = self.get_batch()
+    self.assertEquals(['<entry>1</entry>', '<entry>2</entry>'],
+                      self.get_entries())
+    self.assertEquals(self.now + self.window, batch.eta)
+    self.assertTrue(DeliveryBatch.get_work(now=lambda: self.now) is None)
+    work = DeliveryBatch.get_work(now=lambda: self.now + self.window)
+    self.assertEquals(batch.key(), work.key())
+
+  def testAdd_separateEntities(self):
+    """Tests that each event's entries are stored in their own entity."""
+    self.add(['<entry>1</entry>', '<entry>2</entry>'])
+    self.add(['<entry>3</entry>'], seconds=1)
+    self.assertEquals(2, main.DeliveryBatchEntry.all().count())
+    self.assertEquals(1, DeliveryBatch.all().count())
+
+    # Adding the same entries again does not store them twice.
+    self.add(['<entry>3</entry>'], seconds=2)
+    self.assertEquals(2, main.DeliveryBatchEntry.all().count())
+
+  def testGetPayload(self):
+    self.add(['<entry>1</entry>', '<entry>2</entry>'])
+    self.add(['<entry>3</entry>'], seconds=1)
+    self.add(['<entry>4</entry>'], seconds=2)
+    batch = self.get_batch()
+    batch_entries, entry_list = batch.get_next_entries()
+    self.assertEquals(2, len(batch_entries))
+    self.assertEquals(3, len(entry_list))
+    payload = batch.get_payload(entry_list, now=lambda: self.now)
+    self.assertTrue(payload.startswith('<?xml'))
+    self.assertTrue('<id>%s</id>' % self.callback in payload)
+    self.assertTrue('<entry>3</entry>\n</feed>' in payload)
+    self.assertFalse('<entry>4</entry>' in payload)
+
+  def testGetNextEntries_largeEvent(self):
+    """Tests that events with too many entries are delivered on their own."""
+    self.add(['<entry>%d</entry>' % i for i in xrange(4)])
+    self.add(['<entry>4</entry>'], seconds=1)
+    batch_entries, entry_list = self.get_batch().get_next_entries()
+    self.assertEquals(1, len(batch_entries))
+    self.assertEquals(4, len(entry_list))
+
+  def testUpdate_success(self):
+    self.add(['<entry>1</entry>'])
+    batch = self.get_batch()
+    self.add(['<entry>2</entry>'], seconds=10)
+    batch_entries, entry_list = batch.get_next_entries()
+    batch.update(batch_entries[:1], True, now=lambda: self.now)
+    batch = self.get_batch()
+    self.assertEquals(['<entry>2</entry>'], self.get_entries())
+    self.assertEquals(
+        self.now + datetime.timedelta(seconds=10) + self.window, batch.eta)
+
+    batch_entries, entry_list = batch.get_next_entries()
+    batch.update(batch_entries, True, now=lambda: self.now)
+    self.assertTrue(self.get_batch() is None)
+    self.assertEquals([], self.get_entries())
+
+  def testUpdate_failure(self):
+    self.add(['<entry>1</entry>'])
+    batch = self.get_batch()
+    batch_entries, entry_list = batch.get_next_entries()
+    batch.update(batch_entries, False, now=lambda: self.now, retry_period=30)
+    batch = self.get_batch()
+    self.assertEquals(['<entry>1</entry>'], self.get_entries())
+    self.assertEquals(1, batch.retry_attempts)
+    self.assertEquals(self.now + datetime.timedelta(seconds=30), batch.eta)
+
+    batch.update(batch_entries, False, now=lambda: self.now, retry_period=30)
+    batch = self.get_batch()
+    self.assertEquals(2, batch.retry_attempts)
+    self.assertEquals(self.now + datetime.timedelta(seconds=60), batch.eta)
+
+    # Gives up on the entries once there have been too many failures.
+    batch.update(batch_entries, False, now=lambda: self.now, max_failures=2)
+    self.assertTrue(self.get_batch() is None)
+    self.assertEquals([], self.get_entries())
+
 ################################################################################
 
 class PublishHandlerTest(testutil.HandlerTestBase):
@@ -972,8 +1836,9 @@ class FindFeedUpdatesTest(unittest.TestCase):
 
   def run_test(self):
     """Runs a test."""
-    header_footer, entry_list, entry_payloads = main.find_feed_updates(
-        self.topic, main.ATOM, self.content, filter_feed=self.my_filter)
+    header_footer, entry_list, entry_payloads, self.unchanged_list = \
+        main.find_feed_updates(self.topic, main.ATOM, self.content,
+                               filter_feed=self.my_filter)
     self.assertEquals(self.header_footer, header_footer)
     return entry_list, entry_payloads
 
@@ -988,6 +1853,7 @@ class FindFeedUpdatesTest(unittest.TestCase):
     entry_id_set = set(f.entry_id for f in entry_list)
     self.assertEquals(set(self.entries_map.keys()), entry_id_set)
     self.assertEquals(self.entries_map.values(), entry_payloads)
+    self.assertEquals([], self.unchanged_list)
 
   def testSomeExistingEntries(self):
     """Tests when some entries are already known."""
@@ -1000,6 +1866,7 @@ class FindFeedUpdatesTest(unittest.TestCase):
     entry_id_set = set(f.entry_id for f in entry_list)
     self.assertEquals(set(['id3']), entry_id_set)
     self.assertEquals(['content3'], entry_payloads)
+    self.assertEquals(set(['id1', 'id2']), set(self.unchanged_list))
 
   def testPulledEntryNewer(self):
     """Tests when an entry is already known but has been updated recently."""
@@ -1025,11 +1892,106 @@ class FindFeedUpdatesTest(unittest.TestCase):
     entry_id_set = set(f.entry_id for f in entry_list)
     self.assertEquals(set(self.entries_map.keys()), entry_id_set)
 
+  def testCachedHashes(self):
+    """Tests that known content hashes are read from memcache."""
+    entries = [
+        FeedEntryRecord.create_entry_for_topic(
+            self.topic, 'id1', sha1_hash('content1')),
+        FeedEntryRecord.create_entry_for_topic(
+            self.topic, 'id2', sha1_hash('content2')),
+    ]
+    db.put(entries)
+    self.run_test()
+    cache_key = FeedEntryRecord.get_cache_key(self.topic)
+    self.assertEquals({sha1_hash('id1'): sha1_hash('content1'),
+                       sha1_hash('id2'): sha1_hash('content2')},
+                      memcache.get(cache_key))
+
+    # With the records gone from the Datastore, the cache is still used.
+    db.delete(entries)
+    entry_list, entry_payloads = self.run_test()
+    self.assertEquals(['id3'], [e.entry_id for e in entry_list])
+
+    # Entries no longer in the feed are dropped from the cache.
+    del self.entries_map['id2']
+    self.run_test()
+    self.assertEquals({sha1_hash('id1'): sha1_hash('content1')},
+                      memcache.get(cache_key))
+
+  def testCacheContentHashes(self):
+    """Tests writing newly stored entries through to the cache."""
+    FeedEntryRecord.cache_content_hashes(self.topic, [
+        FeedEntryRecord.create_entry_for_topic(
+            self.topic, 'id1', sha1_hash('content1')),
+        FeedEntryRecord.create_entry_for_topic(
+            self.topic, 'id3', sha1_hash('content3')),
+    ])
+    entry_list, entry_payloads = self.run_test()
+    self.assertEquals(['id2'], [e.entry_id for e in entry_list])
+
 ################################################################################
 
 FeedRecord = main.FeedRecord
 
 
+class FeedRecordTest(unittest.TestCase):
+  """Tests for the FeedRecord polling statistics."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.topic = 'http://example.com/my-topic'
+    self.start = datetime.datetime.utcnow()
+    self.now = lambda: self.start
+
+  def testRecordFetch(self):
+    record = FeedRecord.get_or_create(self.topic)
+    record.record_fetch(5, now=self.now)
+    self.assertEquals(1, record.fetch_count)
+    self.assertEquals(0, record.not_modified_count)
+    self.assertEquals(5 * main.FETCH_STATS_WEIGHT, record.entries_per_fetch)
+    self.assertEquals(self.start, record.last_changed)
+    self.assertEquals(main.DEFAULT_POLL_INTERVAL / 2, record.poll_interval)
+    self.assertTrue(record.last_publish is None)
+
+    record.record_fetch(0, not_modified=True, publish=True,
+                        now=lambda: self.start + datetime.timedelta(hours=1))
+    self.assertEquals(2, record.fetch_count)
+    self.assertEquals(1, record.not_modified_count)
+    self.assertEquals(self.start, record.last_changed)
+    self.assertEquals(main.DEFAULT_POLL_INTERVAL, record.poll_interval)
+    self.assertEquals(self.start + datetime.timedelta(hours=1),
+                      record.last_publish)
+
+  def testPollIntervalBounds(self):
+    record = FeedRecord.get_or_create(self.topic)
+    for i in xrange(20):
+      record.record_fetch(1, now=self.now)
+    self.assertEquals(main.MIN_POLL_INTERVAL, record.poll_interval)
+    for i in xrange(20):
+      record.record_fetch(0, now=self.now)
+    self.assertEquals(main.MAX_POLL_INTERVAL, record.poll_interval)
+
+  def testIsPollDue(self):
+    record = FeedRecord.get_or_create(self.topic)
+    self.assertTrue(record.is_poll_due(now=self.now))
+    record.record_fetch(0, now=self.now)
+    record.put()
+    interval = datetime.timedelta(seconds=record.poll_interval)
+    self.assertFalse(record.is_poll_due(
+        now=lambda: record.last_updated + interval / 2))
+    self.assertTrue(record.is_poll_due(
+        now=lambda: record.last_updated + interval))
+
+  def testIsPollDue_published(self):
+    """Tests that feeds with recent publish events are not polled."""
+    record = FeedRecord.get_or_create(self.topic)
+    record.last_publish = self.start
+    delay = datetime.timedelta(seconds=main.PUBLISHED_FEED_POLL_DELAY)
+    self.assertFalse(record.is_poll_due(now=lambda: self.start + delay / 2))
+    self.assertTrue(record.is_poll_due(now=lambda: self.start + delay))
+
+
 class PullFeedHandlerTest(testutil.HandlerTestBase):
 
   def setUp(self):
@@ -1054,29 +2016,114 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
       'Content-Type': 'application/atom+xml',
     }
     self.expected_exceptions = []
+    self.parsed_formats = []
 
-    def my_find_updates(ignored_topic, ignored_format, content):
+    self.unchanged_list = []
+
+    def my_find_updates(ignored_topic, format, content):
       self.assertEquals(self.expected_response, content)
+      self.parsed_formats.append(format)
       if self.expected_exceptions:
         raise self.expected_exceptions.pop(0)
-      return self.header_footer, self.entry_list, self.entry_payloads
+      return (self.header_footer, self.entry_list, self.entry_payloads,
+              self.unchanged_list)
 
+    self.now = [datetime.datetime.utcnow()]
     def create_handler():
-      return main.PullFeedHandler(find_feed_updates=my_find_updates)
+      return main.PullFeedHandler(find_feed_updates=my_find_updates,
+                                  now=lambda: self.now[0])
     self.handler_class = create_handler
 
     testutil.HandlerTestBase.setUp(self)
+    self.batch_size = main.FEED_PULL_BATCH_SIZE
     self.callback = 'http://example.com/my-subscriber'
     self.assertTrue(Subscription.insert(self.callback, self.topic))
 
   def tearDown(self):
     """Tears down the test harness."""
+    main.FEED_PULL_BATCH_SIZE = self.batch_size
     urlfetch_test_stub.instance.verify_and_reset()
 
   def testNoWork(self):
     self.handle('get')
 
-  def testNewEntries_Atom(self):
+  def testMultipleFeeds(self):
+    """Tests that a single worker drains multiple batches of feeds."""
+    main.FEED_PULL_BATCH_SIZE = 2
+    topics = [self.topic, self.topic + '/two', self.topic + '/three']
+    for topic in topics[1:]:
+      self.assertTrue(Subscription.insert(self.callback, topic))
+    FeedToFetch.insert(topics)
+    for topic in topics:
+      urlfetch_test_stub.instance.expect(
+          'get', topic, 200, self.expected_response,
+          response_headers=self.headers)
+    self.handle('get')
+    for topic in topics:
+      self.assertTrue(FeedToFetch.get_by_topic(topic) is None)
+
+  def testConcurrentFetch(self):
+    """Tests that all feeds in a batch are fetched before any are parsed."""
+    topics = [self.topic, self.topic + '/two', self.topic + '/three']
+    for topic in topics[1:]:
+      self.assertTrue(Subscription.insert(self.callback, topic))
+    FeedToFetch.insert(topics)
+    for topic in topics:
+      urlfetch_test_stub.instance.expect(
+          'get', topic, 200, self.expected_response,
+          response_headers=self.headers)
+
+    outstanding = []
+    def find_updates(topic, format, content):
+      outstanding.append(main.async_proxy.rpcs_outstanding())
+      return self.header_footer, [], [], []
+    self.handler_class = lambda: main.PullFeedHandler(
+        find_feed_updates=find_updates, now=lambda: self.now[0])
+
+    self.handle('get')
+    self.assertEquals([2, 1, 0], outstanding)
+    for topic in topics:
+      self.assertTrue(FeedToFetch.get_by_topic(topic) is None)
+      self.assertTrue(FeedRecord.get_by_key_name(
+          FeedRecord.create_key_name(topic)) is not None)
+
+  def testTimeBudget(self):
+    """Tests that no more work is claimed after the time budget runs out."""
+    main.FEED_PULL_BATCH_SIZE = 1
+    topic2 = self.topic + '/two'
+    self.assertTrue(Subscription.insert(self.callback, topic2))
+    FeedToFetch.insert([self.topic, topic2])
+
+    def find_updates(topic, format, content):
+      self.now[0] += datetime.timedelta(seconds=main.WORKER_TIME_BUDGET)
+      return self.header_footer, [], [], []
+    self.handler_class = lambda: main.PullFeedHandler(
+        find_feed_updates=find_updates, now=lambda: self.now[0])
+
+    # Either feed may be claimed first, but only one should be fetched.
+    for topic in (self.topic, topic2):
+      urlfetch_test_stub.instance.expect(
+          'get', topic, 200, self.expected_response,
+          response_headers=self.headers)
+    self.handle('get')
+    remaining = [t for t in (self.topic, topic2)
+                 if FeedToFetch.get_by_topic(t) is not None]
+    self.assertEquals(1, len(remaining))
+    urlfetch_test_stub.instance.clear()
+
+  def testDeadlineError(self):
+    """Tests that unfinished feeds are released when the deadline hits."""
+    self.expected_exceptions.append(runtime.DeadlineExceededError())
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get')
+    work = FeedToFetch.get_by_topic(self.topic)
+    self.assertEquals(0, work.fetching_failures)
+    self.assertTrue(memcache.get(str(work.key())) is None)
+
+  def testNewEntries_Atom(self):
     """Tests when new entries are found."""
     FeedToFetch.insert([self.topic])
     urlfetch_test_stub.instance.expect(
@@ -1092,7 +2139,7 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
 
     work = EventToDeliver.get_work()
     self.assertEquals(self.topic, work.topic)
-    self.assertTrue('content1\ncontent2\ncontent3' in work.payload)
+    self.assertTrue('content1\ncontent2\ncontent3' in work.get_payload())
     work.delete()
 
     record = FeedRecord.get_or_create(self.topic)
@@ -1100,13 +2147,15 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     self.assertEquals(self.etag, record.etag)
     self.assertEquals(self.last_modified, record.last_modified)
     self.assertEquals('application/atom+xml', record.content_type)
-
-  def testRssFailBack(self):
-    """Tests when parsing as Atom fails and it uses RSS instead."""
-    self.expected_exceptions.append(feed_diff.Error('whoops'))
-    self.header_footer = '<rss><channel>this is my test</channel></rss>'
-    self.headers['Content-Type'] = 'application/xml'
-
+    self.assertEquals(self.now[0], record.last_changed)
+    self.assertEquals({self.topic: self.now[0]},
+                      FeedRecord.get_cached_last_changed([self.topic]))
+    self.assertEquals(1, record.fetch_count)
+    self.assertEquals(main.DEFAULT_POLL_INTERVAL / 2, record.poll_interval)
+
+  def testEntryHashUpgrade(self):
+    """Tests rewriting entry hashes stored by an older version."""
+    FeedEntryRecord.create_entry_for_topic(self.topic, '1', 'old hash').put()
     FeedToFetch.insert([self.topic])
     urlfetch_test_stub.instance.expect(
         'get', self.topic, 200, self.expected_response,
@@ -1116,19 +2165,87 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     feed_entries = FeedEntryRecord.get_entries_for_topic(
         self.topic, self.all_ids)
     self.assertEquals(self.all_ids, [e.entry_id for e in feed_entries])
+    self.assertEquals('content1', feed_entries[0].entry_content_hash)
 
+    # The entry that was already stored is not delivered again.
     work = EventToDeliver.get_work()
-    self.assertEquals(self.topic, work.topic)
-    self.assertTrue('content1\ncontent2\ncontent3' in work.payload)
+    self.assertTrue('content2\ncontent3' in work.get_payload())
+    self.assertFalse('content1' in work.get_payload())
     work.delete()
 
     record = FeedRecord.get_or_create(self.topic)
-    self.assertEquals('application/xml', record.content_type)
+    self.assertEquals(main.ENTRY_HASH_VERSION, record.entry_hash_version)
 
-  def testAtomFailBack(self):
-    """Tests when parsing as RSS fails and it uses Atom instead."""
-    self.expected_exceptions.append(feed_diff.Error('whoops'))
-    self.headers.clear()
+  def testEntryHashUpgradeNoNewEntries(self):
+    """Tests that only rewriting entry hashes does not create an event."""
+    for entry_id in self.all_ids:
+      FeedEntryRecord.create_entry_for_topic(
+          self.topic, entry_id, 'old hash').put()
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get')
+
+    feed_entries = FeedEntryRecord.get_entries_for_topic(
+        self.topic, self.all_ids)
+    self.assertEquals(['content1', 'content2', 'content3'],
+                      [e.entry_content_hash for e in feed_entries])
+    self.assertTrue(EventToDeliver.get_work() is None)
+    record = FeedRecord.get_or_create(self.topic)
+    self.assertEquals(main.ENTRY_HASH_VERSION, record.entry_hash_version)
+    self.assertEquals(None, record.last_changed)
+
+  def testEntriesSeenTime(self):
+    """Tests tracking when the entries still in the feed were stored."""
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get')
+    start = self.now[0]
+    self.assertEquals(
+        start, FeedRecord.get_or_create(self.topic).entries_seen_time)
+
+    # Unchanged entries were stored at or after the last parse, so the time
+    # stays the same, and the unchanged entries are not rewritten.
+    update_time = FeedEntryRecord.get_entries_for_topic(
+        self.topic, ['1'])[0].update_time
+    self.now[0] += datetime.timedelta(days=1)
+    self.expected_response = 'different content'
+    self.entry_list = self.entry_list[1:]
+    self.entry_payloads = self.entry_payloads[1:]
+    self.unchanged_list = ['1']
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get')
+    self.assertEquals(
+        start, FeedRecord.get_or_create(self.topic).entries_seen_time)
+    self.assertEquals(update_time, FeedEntryRecord.get_entries_for_topic(
+        self.topic, ['1'])[0].update_time)
+
+  def testEntriesSeenTimeLegacy(self):
+    """Tests finding the entries seen time of feeds parsed before it existed."""
+    entry = FeedEntryRecord.create_entry_for_topic(self.topic, '1', 'content1')
+    entry.put()
+    self.entry_list = []
+    self.entry_payloads = []
+    self.unchanged_list = ['1']
+    self.now[0] += datetime.timedelta(days=1)
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get')
+    self.assertEquals(
+        entry.update_time,
+        FeedRecord.get_or_create(self.topic).entries_seen_time)
+
+  def testRssContentType(self):
+    """Tests when the format is guessed from an RSS content-type."""
+    self.header_footer = '<rss><channel>this is my test</channel></rss>'
     self.headers['Content-Type'] = 'application/rss+xml'
     info = FeedRecord.get_or_create(self.topic)
     info.update(self.headers)
@@ -1139,6 +2256,7 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
         'get', self.topic, 200, self.expected_response,
         response_headers=self.headers)
     self.handle('get')
+    self.assertEquals([main.RSS], self.parsed_formats)
 
     feed_entries = FeedEntryRecord.get_entries_for_topic(
         self.topic, self.all_ids)
@@ -1146,21 +2264,53 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
 
     work = EventToDeliver.get_work()
     self.assertEquals(self.topic, work.topic)
-    self.assertTrue('content1\ncontent2\ncontent3' in work.payload)
+    self.assertTrue('content1\ncontent2\ncontent3' in work.get_payload())
     work.delete()
 
     record = FeedRecord.get_or_create(self.topic)
     self.assertEquals('application/rss+xml', record.content_type)
+    self.assertEquals(main.RSS, record.format)
+
+  def testRememberedFormat(self):
+    """Tests that the format last parsed is used over the content-type."""
+    self.header_footer = '<rss><channel>this is my test</channel></rss>'
+    info = FeedRecord.get_or_create(self.topic)
+    info.update(self.headers, format=main.RSS)
+    info.put()
+
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get')
+    self.assertEquals([main.RSS], self.parsed_formats)
+    self.assertEquals(main.RSS, FeedRecord.get_or_create(self.topic).format)
+
+  def testDetectedFormat(self):
+    """Tests that the format detected from the document is used."""
+    self.expected_response = '<rss version="2.0"><channel/></rss>'
+    self.header_footer = '<rss><channel>this is my test</channel></rss>'
+    info = FeedRecord.get_or_create(self.topic)
+    info.update(self.headers, format=main.ATOM)
+    info.put()
+
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get')
+    self.assertEquals([main.RSS], self.parsed_formats)
+    self.assertEquals(main.RSS, FeedRecord.get_or_create(self.topic).format)
 
   def testParseFailure(self):
-    """Tests when the feed cannot be parsed as Atom or RSS."""
-    self.expected_exceptions.append(feed_diff.Error('whoops'))
+    """Tests when the feed cannot be parsed."""
     self.expected_exceptions.append(feed_diff.Error('whoops'))
     FeedToFetch.insert([self.topic])
     urlfetch_test_stub.instance.expect(
         'get', self.topic, 200, self.expected_response,
         response_headers=self.headers)
     self.handle('get')
+    self.assertEquals([main.ATOM], self.parsed_formats)
 
     self.assertTrue(EventToDeliver.get_work() is None)
     feed = FeedToFetch.get_by_key_name(main.get_hash_key_name(self.topic))
@@ -1183,6 +2333,20 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
         request_headers=request_headers,
         response_headers=self.headers)
     self.handle('get')
+    record = FeedRecord.get_or_create(self.topic)
+    self.assertEquals(1, record.fetch_count)
+    self.assertEquals(1, record.not_modified_count)
+    self.assertEquals(2 * main.DEFAULT_POLL_INTERVAL, record.poll_interval)
+
+  def testPublished(self):
+    """Tests that fetches due to publish events are recorded."""
+    FeedToFetch.insert([self.topic], publish=True)
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get')
+    record = FeedRecord.get_or_create(self.topic)
+    self.assertEquals(self.now[0], record.last_publish)
 
   def testNoNewEntries(self):
     """Tests when there are no new entries."""
@@ -1202,6 +2366,31 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     self.assertEquals(self.last_modified, record.last_modified)
     self.assertEquals('application/atom+xml', record.content_type)
 
+  def testUnchangedContent(self):
+    """Tests that a feed body identical to the last one is not parsed again."""
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get')
+    urlfetch_test_stub.instance.verify_and_reset()
+    self.assertEquals(1, len(self.parsed_formats))
+    record = FeedRecord.get_or_create(self.topic)
+    self.assertEquals(sha1_hash(self.expected_response), record.content_hash)
+    EventToDeliver.get_work().delete()
+
+    self.headers['ETag'] = 'something new'
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get')
+    self.assertEquals(1, len(self.parsed_formats))
+    self.assertTrue(EventToDeliver.get_work() is None)
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic) is None)
+    self.assertEquals('something new',
+                      FeedRecord.get_or_create(self.topic).etag)
+
   def testPullError(self):
     """Tests when URLFetch raises an exception."""
     FeedToFetch.insert([self.topic])
@@ -1245,6 +2434,20 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     # And any KnownFeeds were deleted.
     self.assertTrue(db.get(KnownFeed.create_key(self.topic)) is None)
 
+  def testOtherShard(self):
+    """Tests that workers do not pull feeds from other shards."""
+    FeedToFetch.insert([self.topic])
+    shard = main.get_work_shard(self.topic, main.FEED_PULL_SHARDS)
+    other_num = (shard + 1) % main.FEED_PULL_SHARDS + 1
+    self.handle('get', ('num', str(other_num)))
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic) is not None)
+
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.handle('get', ('num', str(shard + 1)))
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic) is None)
+
 
 class PullFeedHandlerTestWithParsing(testutil.HandlerTestBase):
 
@@ -1275,6 +2478,30 @@ class PullFeedHandlerTestWithParsing(testutil.HandlerTestBase):
     feed = FeedToFetch.get_by_key_name(main.get_hash_key_name(topic))
     self.assertEquals(1, feed.fetching_failures)
 
+  def testPullGoodRdf(self):
+    """Tests pulling an RDF feed served with a misleading content-type."""
+    data = ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+            '<channel><title>stuff</title></channel>'
+            '<item rdf:about="http://example.com/1"><title>wooh</title></item>'
+            '</rdf:RDF>')
+    topic = 'http://example.com/my-topic'
+    callback = 'http://example.com/my-subscriber'
+    self.assertTrue(Subscription.insert(callback, topic))
+    FeedToFetch.insert([topic])
+    urlfetch_test_stub.instance.expect(
+        'get', topic, 200, data,
+        response_headers={'Content-Type': 'application/atom+xml'})
+    self.handle('get')
+    feed = FeedToFetch.get_by_key_name(main.get_hash_key_name(topic))
+    self.assertTrue(feed is None)
+    self.assertEquals(main.RDF, FeedRecord.get_or_create(topic).format)
+
+    work = EventToDeliver.get_work()
+    self.assertTrue(work.get_payload().endswith(
+        '<item rdf:about="http://example.com/1"><title>wooh</title></item>\n'
+        '</rdf:RDF>'))
+
   def testPullGoodContent(self):
     """Tests when the XML can parse just fine."""
     data = ('<?xml version="1.0" encoding="utf-8"?>\n<feed><my header="data"/>'
@@ -1301,6 +2528,11 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
     testutil.HandlerTestBase.setUp(self)
 
     self.chunk_size = main.EVENT_SUBSCRIBER_CHUNK_SIZE
+    self.max_chunk_size = main.MAX_EVENT_SUBSCRIBER_CHUNK_SIZE
+    self.fanout_ranges = main.EVENT_FANOUT_RANGES
+    main.EVENT_FANOUT_RANGES = 1
+    self.max_per_host = main.MAX_DELIVERIES_PER_HOST
+    self.host_failure_threshold = main.HOST_FAILURE_THRESHOLD
     self.topic = 'http://example.com/hamster-topic'
     # Order of these URL fetches is determined by the ordering of the hashes
     # of the callback URLs, so we need random extra strings here to get
@@ -1329,25 +2561,44 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
   def tearDown(self):
     """Resets any external modules modified for testing."""
     main.EVENT_SUBSCRIBER_CHUNK_SIZE = self.chunk_size
+    main.MAX_EVENT_SUBSCRIBER_CHUNK_SIZE = self.max_chunk_size
+    main.EVENT_FANOUT_RANGES = self.fanout_ranges
+    main.MAX_DELIVERIES_PER_HOST = self.max_per_host
+    main.HOST_FAILURE_THRESHOLD = self.host_failure_threshold
+    main.async_proxy.max_in_flight = main.MAX_ASYNC_CALLS_IN_FLIGHT
     urlfetch_test_stub.instance.verify_and_reset()
 
+  def set_chunk_size(self, chunk_size):
+    """Pins the delivery chunk size so it does not adapt between requests."""
+    main.EVENT_SUBSCRIBER_CHUNK_SIZE = chunk_size
+    main.MAX_EVENT_SUBSCRIBER_CHUNK_SIZE = chunk_size
+
   def testNoWork(self):
     self.handle('get')
 
+  def testMissingPayload(self):
+    """Tests that events whose payload has gone missing are dropped."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    event, event_payload = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads)
+    event.put()
+    self.handle('get')
+    self.assertTrue(EventToDeliver.get_work() is None)
+
   def testNoExtraSubscribers(self):
     """Tests when a single chunk of delivery is enough."""
     self.assertTrue(Subscription.insert(self.callback1, self.topic))
     self.assertTrue(Subscription.insert(self.callback2, self.topic))
     self.assertTrue(Subscription.insert(self.callback3, self.topic))
-    main.EVENT_SUBSCRIBER_CHUNK_SIZE = 3
+    self.set_chunk_size(3)
     urlfetch_test_stub.instance.expect(
         'post', self.callback1, 204, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
         'post', self.callback2, 200, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
         'post', self.callback3, 204, '', request_payload=self.expected_payload)
-    EventToDeliver.create_event_for_topic(
-        self.topic, main.ATOM, self.header_footer, self.test_payloads).put()
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
     self.handle('get')
     self.assertTrue(EventToDeliver.get_work() is None)
 
@@ -1356,9 +2607,9 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
     self.assertTrue(Subscription.insert(self.callback1, self.topic))
     self.assertTrue(Subscription.insert(self.callback2, self.topic))
     self.assertTrue(Subscription.insert(self.callback3, self.topic))
-    main.EVENT_SUBSCRIBER_CHUNK_SIZE = 1
-    EventToDeliver.create_event_for_topic(
-        self.topic, main.ATOM, self.header_footer, self.test_payloads).put()
+    self.set_chunk_size(1)
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
 
     urlfetch_test_stub.instance.expect(
         'post', self.callback1, 204, '', request_payload=self.expected_payload)
@@ -1376,14 +2627,33 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
     urlfetch_test_stub.instance.verify_and_reset()
     self.assertTrue(EventToDeliver.get_work() is None)
 
+  def testSubscriberCount(self):
+    """Tests reconciling the subscriber count and sending it with events."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    SubscriberCountShard.increment(self.topic, 3)
+    self.set_chunk_size(2)
+    for callback in (self.callback1, self.callback2):
+      urlfetch_test_stub.instance.expect(
+          'post', callback, 204, '', request_payload=self.expected_payload,
+          request_headers={'X-Hub-On-Behalf-Of': '2'})
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+    self.handle('get')
+    self.assertEquals(2, SubscriberCountShard.get_count(self.topic))
+
+  def get_failed_callbacks(self):
+    """Returns the callback URLs of the failed deliveries in hash order."""
+    return [f.callback for f in FailedCallback.all().order('callback_hash')]
+
   def testBrokenCallbacks(self):
     """Tests that when callbacks return errors and are saved for later."""
     self.assertTrue(Subscription.insert(self.callback1, self.topic))
     self.assertTrue(Subscription.insert(self.callback2, self.topic))
     self.assertTrue(Subscription.insert(self.callback3, self.topic))
-    main.EVENT_SUBSCRIBER_CHUNK_SIZE = 2
-    EventToDeliver.create_event_for_topic(
-        self.topic, main.ATOM, self.header_footer, self.test_payloads).put()
+    self.set_chunk_size(2)
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
 
     urlfetch_test_stub.instance.expect(
         'post', self.callback1, 302, '', request_payload=self.expected_payload)
@@ -1397,95 +2667,584 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
     self.handle('get')
     urlfetch_test_stub.instance.verify_and_reset()
 
-    # Force work retrieval to see the status of the event.
-    work = EventToDeliver.get_work(
-        now=lambda: datetime.datetime.now() + datetime.timedelta(hours=1))
-    sub_list = Subscription.get(work.failed_callbacks)
-    callback_list = [sub.callback for sub in sub_list]
-
     self.assertEquals([self.callback1, self.callback2, self.callback3],
-                      callback_list)
+                      self.get_failed_callbacks())
+    event = EventToDeliver.all().get()
+    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
+    self.assertEquals(3, event.failed_count)
 
   def testDeadlineError(self):
     """Tests that callbacks in flight at deadline will be marked as failed."""
+    old_record_deliveries = Subscription.record_deliveries
     try:
       def deadline():
         raise runtime.DeadlineExceededError()
       main.async_proxy.wait = deadline
+      def record_deliveries(*args, **kwargs):
+        self.fail('Deliveries should not be recorded after the deadline')
+      Subscription.record_deliveries = staticmethod(record_deliveries)
 
       self.assertTrue(Subscription.insert(self.callback1, self.topic))
       self.assertTrue(Subscription.insert(self.callback2, self.topic))
       self.assertTrue(Subscription.insert(self.callback3, self.topic))
-      main.EVENT_SUBSCRIBER_CHUNK_SIZE = 2
-      EventToDeliver.create_event_for_topic(
-          self.topic, main.ATOM, self.header_footer, self.test_payloads).put()
+      self.set_chunk_size(2)
+      db.put(EventToDeliver.create_event_for_topic(
+          self.topic, main.ATOM, self.header_footer, self.test_payloads))
       self.handle('get')
 
       # All events should be marked as failed even though no urlfetches
       # were made.
-      work = EventToDeliver.get_work()
-      sub_list = Subscription.get(work.failed_callbacks)
-      callback_list = [sub.callback for sub in sub_list]
-      self.assertEquals([self.callback1, self.callback2], callback_list)
+      self.assertEquals([self.callback1, self.callback2],
+                        self.get_failed_callbacks())
 
     finally:
-      main.async_proxy = async_apiproxy.AsyncAPIProxy()
+      Subscription.record_deliveries = old_record_deliveries
+      main.async_proxy = async_apiproxy.AsyncAPIProxy(
+          max_in_flight=main.MAX_ASYNC_CALLS_IN_FLIGHT)
 
-  def testRetryLogic(self):
-    """Tests that failed urls will be retried after subsequent failures.
+  def testInFlightWindow(self):
+    """Tests delivery when the chunk is larger than the in-flight window."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.assertTrue(Subscription.insert(self.callback3, self.topic))
+    self.set_chunk_size(3)
+    main.async_proxy.max_in_flight = 1
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload=self.expected_payload)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback2, 500, '', request_payload=self.expected_payload)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback3, 204, '', request_payload=self.expected_payload)
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+    self.handle('get')
 
-    This is an end-to-end test for push delivery failures and retries. We'll
-    simulate multiple times through the failure list.
-    """
+    self.assertEquals([self.callback2], self.get_failed_callbacks())
+
+  def testMaxDeliveriesPerHost(self):
+    """Tests limiting how many deliveries to one host run at once."""
     self.assertTrue(Subscription.insert(self.callback1, self.topic))
     self.assertTrue(Subscription.insert(self.callback2, self.topic))
     self.assertTrue(Subscription.insert(self.callback3, self.topic))
-    self.assertTrue(Subscription.insert(self.callback4, self.topic))
-    main.EVENT_SUBSCRIBER_CHUNK_SIZE = 3
-    event = EventToDeliver.create_event_for_topic(
-        self.topic, main.ATOM, self.header_footer, self.test_payloads)
-    event.put()
-    event_key = event.key()
+    self.set_chunk_size(3)
+    main.MAX_DELIVERIES_PER_HOST = 1
+    for callback in (self.callback1, self.callback2, self.callback3):
+      urlfetch_test_stub.instance.expect(
+          'post', callback, 204, '', request_payload=self.expected_payload)
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+
+    outstanding = []
+    old_fetch = main.urlfetch_async.fetch
+    def fetch(*args, **kwargs):
+      outstanding.append(main.async_proxy.rpcs_outstanding())
+      return old_fetch(*args, **kwargs)
+    main.urlfetch_async.fetch = fetch
+    try:
+      self.handle('get')
+    finally:
+      main.urlfetch_async.fetch = old_fetch
+    self.assertEquals([0, 0, 0], outstanding)
+    self.assertTrue(EventToDeliver.get_work() is None)
+
+  def testCircuitOpen(self):
+    """Tests that deliveries to a host with an open circuit are deferred."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.set_chunk_size(2)
+    health = CallbackHostHealth(
+        'example.com', failures=main.HOST_FAILURE_THRESHOLD,
+        open_until=self.now[0] + datetime.timedelta(seconds=10))
+    CallbackHostHealth.put_all([health])
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+    self.handle('get')
+    self.assertEquals([self.callback1, self.callback2],
+                      self.get_failed_callbacks())
+    # Deferred deliveries do not count against the subscribers.
+    for sub in Subscription.all():
+      self.assertEquals(0, sub.delivery_failures)
+
+  def testCircuitOpens(self):
+    """Tests that failing deliveries open a host's circuit."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.assertTrue(Subscription.insert(self.callback3, self.topic))
+    self.set_chunk_size(3)
+    main.MAX_DELIVERIES_PER_HOST = 1
+    main.HOST_FAILURE_THRESHOLD = 1
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 500, '', request_payload=self.expected_payload)
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+    self.handle('get')
+    self.assertEquals([self.callback1, self.callback2, self.callback3],
+                      self.get_failed_callbacks())
+    health = CallbackHostHealth.get_all(['example.com'])['example.com']
+    self.assertEquals(CallbackHostHealth.OPEN, health.get_state(self.now[0]))
+
+  def testCircuitHalfOpen(self):
+    """Tests that a successful trial delivery closes a host's circuit."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.set_chunk_size(2)
+    health = CallbackHostHealth(
+        'example.com', failures=main.HOST_FAILURE_THRESHOLD,
+        open_until=self.now[0] - datetime.timedelta(seconds=10))
+    CallbackHostHealth.put_all([health])
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload=self.expected_payload)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback2, 204, '', request_payload=self.expected_payload)
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+    self.handle('get')
+    self.assertTrue(EventToDeliver.get_work() is None)
+    health = CallbackHostHealth.get_all(['example.com'])['example.com']
+    self.assertEquals(CallbackHostHealth.CLOSED,
+                      health.get_state(self.now[0]))
 
+  def testDeliveryStats(self):
+    """Tests that delivery results are recorded on the subscriptions."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.set_chunk_size(2)
     urlfetch_test_stub.instance.expect(
         'post', self.callback1, 404, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
         'post', self.callback2, 204, '', request_payload=self.expected_payload)
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+    self.handle('get')
+
+    sub1, sub2 = [Subscription.get_by_key_name(
+                      Subscription.create_key_name(callback, self.topic))
+                  for callback in (self.callback1, self.callback2)]
+    self.assertEquals(1, sub1.delivery_failures)
+    self.assertTrue(sub1.last_delivery_success is None)
+    self.assertEquals(0, sub2.delivery_failures)
+    self.assertEquals(self.now[0], sub2.last_delivery_success)
+
+  def testAggregate(self):
+    """Tests that aggregating subscribers get their entries batched."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic,
+                                        aggregate=True))
+    self.set_chunk_size(2)
+    header_footer = ('<feed xmlns="http://www.w3.org/2005/Atom">'
+                     '<id>tag:feed</id></feed>')
+    entry_payloads = ['<entry><id>tag:first</id></entry>']
+    expected_payload = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<feed xmlns="http://www.w3.org/2005/Atom"><id>tag:feed</id>\n'
+        '<entry><id>tag:first</id></entry>\n'
+        '</feed>')
     urlfetch_test_stub.instance.expect(
-        'post', self.callback3, 302, '', request_payload=self.expected_payload)
+        'post', self.callback1, 204, '', request_payload=expected_payload)
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, header_footer, entry_payloads))
+    self.handle('get')
+    self.assertTrue(EventToDeliver.get_work() is None)
+
+    batch = DeliveryBatch.get_by_key_name(
+        main.get_hash_key_name(self.callback2))
+    self.assertEquals(
+        ['<entry xmlns="http://www.w3.org/2005/Atom">'
+         '<source><id>tag:feed</id></source><id>tag:first</id></entry>'],
+        batch.get_next_entries()[1])
+
+  def testAggregate_tooLarge(self):
+    """Tests when the delivery batch is too large to be stored."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic,
+                                        aggregate=True))
+    header_footer = ('<feed xmlns="http://www.w3.org/2005/Atom">'
+                     '<id>tag:feed</id></feed>')
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, header_footer,
+        ['<entry><id>tag:first</id></entry>']))
+
+    old_add = DeliveryBatch.add
+    def new_add(*args, **kwargs):
+      raise apiproxy_errors.RequestTooLargeError()
+    DeliveryBatch.add = staticmethod(new_add)
+    try:
+      self.handle('get')
+    finally:
+      DeliveryBatch.add = old_add
+
+    work = EventToDeliver.all().get()
+    self.assertEquals(EventToDeliver.RETRY, work.delivery_mode)
+    self.assertEquals(0, DeliveryBatch.all().count())
+
+  def testAggregate_cannotParse(self):
+    """Tests events that cannot be aggregated are delivered separately."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic,
+                                        aggregate=True))
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload=self.expected_payload)
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+    self.handle('get')
+    self.assertTrue(EventToDeliver.get_work() is None)
+    self.assertEquals(0, DeliveryBatch.all().count())
+
+  def testAdaptiveChunkSize(self):
+    """Tests that the chunk size grows after a fast, full chunk."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.assertTrue(Subscription.insert(self.callback3, self.topic))
+    main.EVENT_SUBSCRIBER_CHUNK_SIZE = 1
+    main.MAX_EVENT_SUBSCRIBER_CHUNK_SIZE = 2
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload=self.expected_payload)
     self.handle('get')
     urlfetch_test_stub.instance.verify_and_reset()
+    self.assertEquals(2, DeliveryStats.get_or_create(self.topic).chunk_size)
 
     urlfetch_test_stub.instance.expect(
-        'post', self.callback4, 500, '', request_payload=self.expected_payload)
+        'post', self.callback2, 204, '', request_payload=self.expected_payload)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback3, 204, '', request_payload=self.expected_payload)
     self.handle('get')
     urlfetch_test_stub.instance.verify_and_reset()
+    self.assertTrue(EventToDeliver.get_work() is None)
+
+  def testFanoutRanges(self):
+    """Tests that a large delivery is split into independent ranges."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.assertTrue(Subscription.insert(self.callback3, self.topic))
+    self.assertTrue(Subscription.insert(self.callback4, self.topic))
+    self.set_chunk_size(1)
+    main.EVENT_FANOUT_RANGES = 2
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
 
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload=self.expected_payload)
+    self.handle('get')
+    urlfetch_test_stub.instance.verify_and_reset()
+    self.assertEquals(2, EventToDeliver.all().count())
+
+    for callback in (self.callback2, self.callback3, self.callback4):
+      urlfetch_test_stub.instance.expect(
+          'post', callback, 204, '', request_payload=self.expected_payload)
+    for i in xrange(6):
+      self.handle('get')
+    urlfetch_test_stub.instance.verify_and_reset()
+    self.assertTrue(EventToDeliver.get_work() is None)
+
+  def testFanoutRanges_lowFanout(self):
+    """Tests that deliveries to a few chunks of subscribers are not split."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.set_chunk_size(1)
+    main.EVENT_FANOUT_RANGES = 2
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload=self.expected_payload)
+    self.handle('get')
+    urlfetch_test_stub.instance.verify_and_reset()
+    self.assertEquals(1, EventToDeliver.all().count())
+
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback2, 204, '', request_payload=self.expected_payload)
+    self.handle('get')
+    urlfetch_test_stub.instance.verify_and_reset()
+    self.assertTrue(EventToDeliver.get_work() is None)
+
+  def testFailedDeliveriesNotRedelivered(self):
+    """Tests that events holding failed deliveries are left to the retrier."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic))
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    self.set_chunk_size(2)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 500, '', request_payload=self.expected_payload)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback2, 204, '', request_payload=self.expected_payload)
+    db.put(EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads))
+    self.handle('get')
+    urlfetch_test_stub.instance.verify_and_reset()
+
+    self.now[0] += datetime.timedelta(hours=1)
+    self.handle('get')
+    self.assertEquals([self.callback1], self.get_failed_callbacks())
+
+################################################################################
+
+class DeliveryRetryHandlerTest(testutil.HandlerTestBase):
+
+  def setUp(self):
+    """Sets up the test harness."""
+    self.now = [datetime.datetime.utcnow()]
+    def create_handler():
+      return main.DeliveryRetryHandler(now=lambda: self.now[0])
+    self.handler_class = create_handler
+    testutil.HandlerTestBase.setUp(self)
+    self.chunk_size = main.DELIVERY_RETRY_CHUNK_SIZE
+
+    self.topic = 'http://example.com/hamster-topic'
+    self.callback1 = 'http://example.com/hamster-callback1'
+    self.callback2 = 'http://example.com/hamster-callback2'
+    self.callback3 = 'http://example.com/hamster-callback3-12345'
+    self.header_footer = '<feed>\n<stuff>blah</stuff>\n<xmldata/></feed>'
+    self.test_payloads = [
+        '<entry>article1</entry>',
+        '<entry>article2</entry>',
+    ]
+    self.expected_payload = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<feed>\n'
+        '<stuff>blah</stuff>\n'
+        '<xmldata/>\n'
+        '<entry>article1</entry>\n'
+        '<entry>article2</entry>\n'
+        '</feed>'
+    )
+
+  def tearDown(self):
+    """Resets any external modules modified for testing."""
+    main.DELIVERY_RETRY_CHUNK_SIZE = self.chunk_size
+    urlfetch_test_stub.instance.verify_and_reset()
+
+  def create_failed_event(self, callbacks=None):
+    """Creates an event that could not be delivered to any subscribers.
+
+    Args:
+      callbacks: Callback URLs to subscribe, or None to use all of them.
+
+    Returns:
+      The EventToDeliver that was inserted, with its normal delivery done.
+    """
+    if callbacks is None:
+      callbacks = [self.callback1, self.callback2, self.callback3]
+    for callback in callbacks:
+      self.assertTrue(Subscription.insert(callback, self.topic))
+    event, event_payload = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, self.test_payloads)
+    db.put([event, event_payload])
+    more, subs = event.get_next_subscribers(chunk_size=len(callbacks))
+    self.assertFalse(more)
+    event.update(more, subs, now=lambda: self.now[0])
+    return event
+
+  def get_failed_callbacks(self):
+    """Returns the callback URLs of the failed deliveries in hash order."""
+    return [f.callback for f in FailedCallback.all().order('callback_hash')]
+
+  def testNoWork(self):
+    self.handle('get')
+
+  def testRetryLogic(self):
+    """Tests that failed deliveries are retried until they succeed.
+
+    This is an end-to-end test for retrying push delivery failures, with
+    each failed callback backing off on its own schedule.
+    """
+    event = self.create_failed_event()
+    payload_key = main.EventPayload.create_key(self.topic, event.payload_hash)
+
+    # Nothing is due yet.
+    self.handle('get')
+
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_RETRY_PERIOD)
     urlfetch_test_stub.instance.expect(
         'post', self.callback1, 404, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
-        'post', self.callback3, 302, '', request_payload=self.expected_payload)
+        'post', self.callback2, 302, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
-        'post', self.callback4, 500, '', request_payload=self.expected_payload)
+        'post', self.callback3, 500, '', request_payload=self.expected_payload)
     self.handle('get')
     urlfetch_test_stub.instance.verify_and_reset()
 
-    self.now[0] += datetime.timedelta(seconds=120)
+    # The second retry backs off for twice as long.
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_RETRY_PERIOD)
+    self.handle('get')
+
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_RETRY_PERIOD)
     urlfetch_test_stub.instance.expect(
         'post', self.callback1, 204, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
-        'post', self.callback3, 302, '', request_payload=self.expected_payload)
+        'post', self.callback2, 302, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
-        'post', self.callback4, 200, '', request_payload=self.expected_payload)
+        'post', self.callback3, 200, '', request_payload=self.expected_payload)
     self.handle('get')
     urlfetch_test_stub.instance.verify_and_reset()
+    self.assertEquals([self.callback2], self.get_failed_callbacks())
+    self.assertEquals(1, db.get(event.key()).failed_count)
 
-    self.now[0] += datetime.timedelta(seconds=120)
+    self.now[0] += datetime.timedelta(seconds=4 * main.DELIVERY_RETRY_PERIOD)
     urlfetch_test_stub.instance.expect(
-        'post', self.callback3, 204, '', request_payload=self.expected_payload)
+        'post', self.callback2, 204, '', request_payload=self.expected_payload)
+    self.handle('get')
+    self.assertTrue(db.get(event.key()) is None)
+    self.assertTrue(db.get(payload_key) is None)
+
+  def testAggregate(self):
+    """Tests that retries to aggregating subscribers go in their batch."""
+    self.assertTrue(Subscription.insert(self.callback1, self.topic,
+                                        aggregate=True))
+    event, event_payload = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM,
+        '<feed xmlns="http://www.w3.org/2005/Atom"><id>tag:feed</id></feed>',
+        ['<entry><id>tag:first</id></entry>'])
+    db.put([event, event_payload])
+    more, subs = event.get_next_subscribers(chunk_size=1)
+    event.update(more, subs, now=lambda: self.now[0])
+
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_RETRY_PERIOD)
+    self.handle('get')
+    self.assertEquals([], self.get_failed_callbacks())
+    self.assertTrue(db.get(event.key()) is None)
+    batch = DeliveryBatch.get_by_key_name(
+        main.get_hash_key_name(self.callback1))
+    self.assertEquals(
+        ['<entry xmlns="http://www.w3.org/2005/Atom">'
+         '<source><id>tag:feed</id></source><id>tag:first</id></entry>'],
+        batch.get_next_entries()[1])
+
+  def testMultipleChunks(self):
+    """Tests that a single worker retries multiple chunks of deliveries."""
+    main.DELIVERY_RETRY_CHUNK_SIZE = 1
+    event = self.create_failed_event()
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_RETRY_PERIOD)
+    for callback in (self.callback1, self.callback2, self.callback3):
+      urlfetch_test_stub.instance.expect(
+          'post', callback, 204, '', request_payload=self.expected_payload)
     self.handle('get')
+    self.assertEquals([], self.get_failed_callbacks())
+    self.assertTrue(db.get(event.key()) is None)
+
+  def testTimeBudget(self):
+    """Tests that no more retries are claimed after the time budget runs out."""
+    main.DELIVERY_RETRY_CHUNK_SIZE = 1
+    self.create_failed_event([self.callback1, self.callback2])
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_RETRY_PERIOD)
+    def now():
+      self.now[0] += datetime.timedelta(seconds=main.WORKER_TIME_BUDGET)
+      return self.now[0]
+    self.handler_class = lambda: main.DeliveryRetryHandler(now=now)
+
+    # Either delivery may be claimed first, but only one should be made.
+    for callback in (self.callback1, self.callback2):
+      urlfetch_test_stub.instance.expect(
+          'post', callback, 204, '', request_payload=self.expected_payload)
+    self.handle('get')
+    self.assertEquals(1, len(self.get_failed_callbacks()))
+    urlfetch_test_stub.instance.clear()
+
+  def testRemovedSubscription(self):
+    """Tests that deliveries to removed subscriptions are dropped."""
+    event = self.create_failed_event()
+    Subscription.remove(self.callback1, self.topic)
+    Subscription.remove(self.callback3, self.topic)
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_RETRY_PERIOD)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback2, 500, '', request_payload=self.expected_payload)
+    self.handle('get')
+    self.assertEquals([self.callback2], self.get_failed_callbacks())
+    self.assertEquals(1, db.get(event.key()).failed_count)
+
+  def testSuspendedSubscription(self):
+    """Tests that deliveries to suspended subscriptions are dropped."""
+    event = self.create_failed_event([self.callback1])
+    self.now[0] += datetime.timedelta(days=2)
+    sub = Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback1, self.topic))
+    Subscription.record_deliveries([], [sub], now=lambda: self.now[0],
+                                   max_failures=1)
+    self.handle('get')
+    self.assertEquals([], self.get_failed_callbacks())
+    self.assertTrue(db.get(event.key()) is None)
+
+  def testDeliveryStats(self):
+    """Tests that retried deliveries are recorded on the subscriptions."""
+    self.create_failed_event([self.callback1])
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_RETRY_PERIOD)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 500, '', request_payload=self.expected_payload)
+    self.handle('get')
+    sub = Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback1, self.topic))
+    self.assertEquals(1, sub.delivery_failures)
+
+  def testMissingPayload(self):
+    """Tests that deliveries are dropped when the payload has gone missing."""
+    event = self.create_failed_event()
+    db.delete(main.EventPayload.create_key(self.topic, event.payload_hash))
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_RETRY_PERIOD)
+    self.handle('get')
+    self.assertEquals([], self.get_failed_callbacks())
+    self.assertTrue(db.get(event.key()) is None)
+
+  def testSharded(self):
+    """Tests that workers only retry deliveries in their own shard."""
+    self.create_failed_event([self.callback1])
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_RETRY_PERIOD)
+    shard = main.get_work_shard(self.callback1, main.DELIVERY_RETRY_SHARDS)
+    other_num = (shard + 1) % main.DELIVERY_RETRY_SHARDS + 1
+    self.handle('get', ('num', str(other_num)))
+    self.assertEquals([self.callback1], self.get_failed_callbacks())
+
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload=self.expected_payload)
+    self.handle('get', ('num', str(shard + 1)))
+    self.assertEquals([], self.get_failed_callbacks())
+
+################################################################################
+
+class DeliveryBatchHandlerTest(testutil.HandlerTestBase):
+
+  def setUp(self):
+    """Sets up the test harness."""
+    self.now = [datetime.datetime.utcnow()]
+    def create_handler():
+      return main.DeliveryBatchHandler(now=lambda: self.now[0])
+    self.handler_class = create_handler
+    testutil.HandlerTestBase.setUp(self)
+    self.callback = 'http://example.com/my-callback'
+    DeliveryBatch.add(self.callback, ['<entry>1</entry>', '<entry>2</entry>'],
+                      now=lambda: self.now[0])
+    self.now[0] += datetime.timedelta(seconds=main.DELIVERY_BATCH_WINDOW)
+    self.expected_payload = DeliveryBatch.get_by_key_name(
+        main.get_hash_key_name(self.callback)).get_payload(
+            ['<entry>1</entry>', '<entry>2</entry>'], now=lambda: self.now[0])
+
+  def tearDown(self):
+    """Resets any external modules modified for testing."""
     urlfetch_test_stub.instance.verify_and_reset()
-    self.assertTrue(db.get(event_key) is None)
+
+  def testNoWork(self):
+    self.now[0] -= datetime.timedelta(seconds=1)
+    self.handle('get')
+
+  def testDeliver(self):
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback, 204, '', request_payload=self.expected_payload)
+    self.handle('get')
+    self.assertEquals(0, DeliveryBatch.all().count())
+    self.assertEquals(0, main.DeliveryBatchEntry.all().count())
+
+  def testNoEntries(self):
+    """Tests that batches whose entries have gone away are deleted."""
+    db.delete(main.DeliveryBatchEntry.all().fetch(10))
+    self.handle('get')
+    self.assertEquals(0, DeliveryBatch.all().count())
+
+  def testFailure(self):
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback, 500, '', request_payload=self.expected_payload)
+    self.handle('get')
+    batch = DeliveryBatch.all().get()
+    self.assertEquals(2, len(batch.get_next_entries()[1]))
+    self.assertEquals(1, batch.retry_attempts)
+    self.assertTrue(batch.eta > self.now[0])
 
 ################################################################################
 
@@ -1581,6 +3340,17 @@ class SubscribeHandlerTest(testutil.HandlerTestBase):
     self.assertEquals(400, self.response_code())
     self.assertTrue('hub.verify_token' in self.response_body())
 
+    # Bad aggregate
+    self.handle('post',
+        ('hub.mode', 'subscribe'),
+        ('hub.callback', self.callback),
+        ('hub.topic', self.topic),
+        ('hub.verify', 'async'),
+        ('hub.verify_token', self.verify_token),
+        ('hub.aggregate', 'maybe'))
+    self.assertEquals(400, self.response_code())
+    self.assertTrue('hub.aggregate' in self.response_body())
+
   def testUnsubscribeMissingSubscription(self):
     """Tests that deleting a non-existent subscription does nothing."""
     self.handle('post',
@@ -1620,6 +3390,33 @@ class SubscribeHandlerTest(testutil.HandlerTestBase):
     self.assertEquals(204, self.response_code())
     self.assertTrue(Subscription.get_by_key_name(sub_key) is None)
 
+  def testAggregate(self):
+    """Tests subscribing with aggregated delivery."""
+    sub_key = Subscription.create_key_name(self.callback, self.topic)
+    self.handle('post',
+        ('hub.callback', self.callback),
+        ('hub.topic', self.topic),
+        ('hub.mode', 'subscribe'),
+        ('hub.verify', 'async'),
+        ('hub.verify_token', self.verify_token),
+        ('hub.aggregate', 'true'))
+    self.assertEquals(202, self.response_code())
+    self.assertTrue(Subscription.get_by_key_name(sub_key).aggregate)
+
+    urlfetch_test_stub.instance.expect('get',
+        self.verify_callback_querystring_template + 'subscribe', 204, '')
+    self.handle('post',
+        ('hub.callback', self.callback),
+        ('hub.topic', self.topic),
+        ('hub.mode', 'subscribe'),
+        ('hub.verify', 'sync'),
+        ('hub.verify_token', self.verify_token),
+        ('hub.aggregate', 'true'))
+    self.assertEquals(204, self.response_code())
+    sub = Subscription.get_by_key_name(sub_key)
+    self.assertEquals(Subscription.STATE_VERIFIED, sub.subscription_state)
+    self.assertTrue(sub.aggregate)
+
   def testAsynchronous(self):
     """Tests sync and async subscriptions cause the correct state transitions.
 
@@ -1941,60 +3738,447 @@ PollingMarker = main.PollingMarker
 
 class PollBootstrapHandlerTest(testutil.HandlerTestBase):
 
-  handler_class = main.PollBootstrapHandler
-
   def setUp(self):
     """Sets up the test harness."""
+    self.start = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+    self.now = [self.start]
+    def create_handler():
+      return main.PollBootstrapHandler(now=lambda: self.now[0])
+    self.handler_class = create_handler
     testutil.HandlerTestBase.setUp(self)
     self.original_chunk_size = main.BOOSTRAP_FEED_CHUNK_SIZE
     main.BOOSTRAP_FEED_CHUNK_SIZE = 2
+    self.topic = 'http://example.com/feed1'
+    self.topic2 = 'http://example.com/feed2'
+    self.topic3 = 'http://example.com/feed3-124'
 
   def tearDown(self):
     """Tears down the test harness."""
     testutil.HandlerTestBase.tearDown(self)
     main.BOOSTRAP_FEED_CHUNK_SIZE = self.original_chunk_size
 
+  def get_known_feed(self, topic):
+    """Returns the KnownFeed for a topic."""
+    return KnownFeed.get(KnownFeed.create_key(topic))
+
+  def testNoWork(self):
+    self.handle('get')
+
   def testFullFlow(self):
-    """Tests a full flow through multiple chunks."""
-    topic = 'http://example.com/feed1'
-    topic2 = 'http://example.com/feed2'
-    topic3 = 'http://example.com/feed3-124'  # alphabetical on the hash of this
-    db.put([KnownFeed.create(topic), KnownFeed.create(topic2),
-            KnownFeed.create(topic3)])
-    self.assertTrue(FeedToFetch.get_by_topic(topic) is None)
-    self.assertTrue(FeedToFetch.get_by_topic(topic2) is None)
-    self.assertTrue(FeedToFetch.get_by_topic(topic3) is None)
+    """Tests polling due feeds in multiple chunks and rescheduling them."""
+    all_topics = (self.topic, self.topic2, self.topic3)
+    db.put([KnownFeed.create(t) for t in all_topics])
+    for topic in all_topics:
+      self.assertTrue(FeedToFetch.get_by_topic(topic) is None)
+
+    self.handle('get')
+    next_poll = self.start + datetime.timedelta(
+        seconds=main.DEFAULT_POLL_INTERVAL)
+    for topic in all_topics:
+      self.assertTrue(FeedToFetch.get_by_topic(topic) is not None)
+      self.assertEquals(next_poll, self.get_known_feed(topic).next_poll_time)
+
+    # Nothing else is due until the next poll time.
+    db.delete([FeedToFetch.get_by_topic(t) for t in all_topics])
+    self.handle('get')
+    for topic in all_topics:
+      self.assertTrue(FeedToFetch.get_by_topic(topic) is None)
+
+    self.now[0] = next_poll
+    self.handle('get')
+    for topic in all_topics:
+      self.assertTrue(FeedToFetch.get_by_topic(topic) is not None)
+
+  def testSharded(self):
+    """Tests that workers only poll feeds in their own shard."""
+    db.put(KnownFeed.create(self.topic))
+    shard = main.get_work_shard(self.topic, main.POLL_BOOTSTRAP_SHARDS)
+    other_shard = (shard + 1) % main.POLL_BOOTSTRAP_SHARDS
+    self.handle('get', ('num', str(other_shard + 1)))
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic) is None)
+    self.handle('get', ('num', str(shard + 1)))
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic) is not None)
+
+  def testSkipsFeedsNotDue(self):
+    """Tests that feeds that are not due are rescheduled but not polled."""
+    db.put([KnownFeed.create(self.topic), KnownFeed.create(self.topic2)])
+    record = FeedRecord.get_or_create(self.topic)
+    record.record_fetch(0)
+    record.put()
+    record = FeedRecord.get(record.key())
+
+    self.handle('get')
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic) is None)
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic2) is not None)
+    self.assertEquals(record.get_next_poll_time(),
+                      self.get_known_feed(self.topic).next_poll_time)
+
+  def testPollInterval(self):
+    """Tests that feeds are rescheduled using their own poll interval."""
+    db.put(KnownFeed.create(self.topic))
+    record = FeedRecord.get_or_create(self.topic)
+    record.record_fetch(0)
+    record.put()
+    record = FeedRecord.get(record.key())
+    self.now[0] = record.get_next_poll_time()
+
+    self.handle('get')
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic) is not None)
+    self.assertEquals(
+        self.now[0] + datetime.timedelta(seconds=record.poll_interval),
+        self.get_known_feed(self.topic).next_poll_time)
+
+
+class SubscriptionSweepHandlerTest(testutil.HandlerTestBase):
+
+  def setUp(self):
+    """Sets up the test harness."""
+    self.start = datetime.datetime.utcnow()
+    self.now = [self.start + main.EXPIRATION_DELTA]
+    def create_handler():
+      return main.SubscriptionSweepHandler(now=lambda: self.now[0])
+    self.handler_class = create_handler
+    testutil.HandlerTestBase.setUp(self)
+    self.chunk_size = main.SUBSCRIPTION_SWEEP_CHUNK_SIZE
+    self.callback = 'http://example.com/my-callback'
+    self.callback2 = 'http://example.com/second-callback'
+    self.callback3 = 'http://example.com/third-callback'
+    self.topic = 'http://example.com/my-topic'
+    self.topic2 = 'http://example.com/second-topic'
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    testutil.HandlerTestBase.tearDown(self)
+    main.SUBSCRIPTION_SWEEP_CHUNK_SIZE = self.chunk_size
+
+  def subscribe(self, callback, topic, when):
+    """Subscribes a callback to a topic at the given time."""
+    Subscription.insert(callback, topic, now=lambda: when)
+    db.put(KnownFeed.create(topic))
+
+  def testNoWork(self):
+    self.handle('get')
+
+  def testSweep(self):
+    """Tests that expired subscriptions and their known feeds are removed."""
+    self.subscribe(self.callback, self.topic, self.start)
+    self.subscribe(self.callback2, self.topic,
+                   self.start + datetime.timedelta(days=1))
+    self.subscribe(self.callback3, self.topic2, self.start)
+    self.handle('get')
+
+    self.assertEquals([self.callback2],
+                      [s.callback for s in Subscription.all()])
+    self.assertEquals([self.topic], KnownFeed.check_exists(
+        [self.topic, self.topic2]))
 
+  def testMultipleChunks(self):
+    """Tests sweeping more subscriptions than fit in a single chunk."""
+    main.SUBSCRIPTION_SWEEP_CHUNK_SIZE = 2
+    for callback in (self.callback, self.callback2, self.callback3):
+      self.subscribe(callback, self.topic, self.start)
     self.handle('get')
-    self.assertTrue(FeedToFetch.get_by_topic(topic) is not None)
-    self.assertTrue(FeedToFetch.get_by_topic(topic2) is not None)
-    self.assertTrue(FeedToFetch.get_by_topic(topic3) is None)
+    self.assertEquals(0, Subscription.all().count())
+    self.assertEquals([], KnownFeed.check_exists([self.topic]))
+
+
+class SubscriberCountReconcileHandlerTest(testutil.HandlerTestBase):
+
+  def setUp(self):
+    """Sets up the test harness."""
+    self.now = [datetime.datetime.utcnow()]
+    def create_handler():
+      return main.SubscriberCountReconcileHandler(now=lambda: self.now[0])
+    self.handler_class = create_handler
+    testutil.HandlerTestBase.setUp(self)
+    self.chunk_size = main.SUBSCRIBER_COUNT_RECONCILE_CHUNK_SIZE
+    self.callback = 'http://example.com/my-callback'
+    self.callback2 = 'http://example.com/second-callback'
+    self.topic = 'http://example.com/my-topic'
+    self.topic2 = 'http://example.com/second-topic'
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    testutil.HandlerTestBase.tearDown(self)
+    main.SUBSCRIBER_COUNT_RECONCILE_CHUNK_SIZE = self.chunk_size
+
+  def get_mark(self):
+    """Returns the PollingMarker used for reconciling subscriber counts."""
+    return PollingMarker.get(
+        key_name=main.SubscriberCountReconcileHandler.MARKER_KEY_NAME)
+
+  def testReconcile(self):
+    """Tests correcting counts that have drifted, one chunk at a time."""
+    main.SUBSCRIBER_COUNT_RECONCILE_CHUNK_SIZE = 1
+    for topic in (self.topic, self.topic2):
+      self.assertTrue(Subscription.insert(self.callback, topic))
+      self.assertTrue(Subscription.insert(self.callback2, topic))
+      KnownFeed.create(topic).put()
+      SubscriberCountShard.increment(topic, 3)
+    self.assertEquals(5, SubscriberCountShard.get_count(self.topic))
 
     self.handle('get')
-    self.assertTrue(FeedToFetch.get_by_topic(topic) is not None)
-    self.assertTrue(FeedToFetch.get_by_topic(topic2) is not None)
-    self.assertTrue(FeedToFetch.get_by_topic(topic3) is not None)
-    self.assertTrue(PollingMarker.get().current_key is not None)
+    self.assertEquals(7, SubscriberCountShard.get_count(self.topic) +
+                         SubscriberCountShard.get_count(self.topic2))
+    self.assertTrue(self.get_mark().current_key is not None)
+
+    self.handle('get')
+    self.assertEquals(2, SubscriberCountShard.get_count(self.topic))
+    self.assertEquals(2, SubscriberCountShard.get_count(self.topic2))
 
     self.handle('get')  # This completes the cycle.
-    the_mark = PollingMarker.get()
-    self.assertTrue(the_mark.current_key is None)
+    self.assertTrue(self.get_mark().current_key is None)
+
+    # Nothing happens until the next cycle is due.
+    SubscriberCountShard.increment(self.topic, 3)
+    self.handle('get')
+    self.assertEquals(5, SubscriberCountShard.get_count(self.topic))
+    self.now[0] += datetime.timedelta(
+        seconds=main.SUBSCRIBER_COUNT_RECONCILE_PERIOD + 1)
+    self.handle('get')
+    self.handle('get')
+    self.assertEquals(2, SubscriberCountShard.get_count(self.topic))
+
+
+class EntryGarbageCollectHandlerTest(testutil.HandlerTestBase):
 
-    self.handle('get')  # This will do nothing.
-    the_mark = PollingMarker.get()
-    self.assertTrue(the_mark.current_key is None)
+  def setUp(self):
+    """Sets up the test harness."""
+    self.now = [datetime.datetime.utcnow() + datetime.timedelta(days=60)]
+    def create_handler():
+      return main.EntryGarbageCollectHandler(now=lambda: self.now[0])
+    self.handler_class = create_handler
+    testutil.HandlerTestBase.setUp(self)
+    self.min_keep = main.ENTRY_RECORD_MIN_KEEP
+    self.feed_chunk_size = main.ENTRY_GC_FEED_CHUNK_SIZE
+    self.delete_chunk_size = main.ENTRY_GC_DELETE_CHUNK_SIZE
+    main.ENTRY_RECORD_MIN_KEEP = 2
+    self.topic = 'http://example.com/my-topic'
+    self.topic2 = 'http://example.com/my-topic2'
 
-    # Resetting the next start time to before the present time will
-    # cause the iteration to start again.
-    the_mark.next_start = \
-        datetime.datetime.utcnow() - datetime.timedelta(seconds=60)
-    db.put(the_mark)
+  def tearDown(self):
+    """Tears down the test harness."""
+    testutil.HandlerTestBase.tearDown(self)
+    main.ENTRY_RECORD_MIN_KEEP = self.min_keep
+    main.ENTRY_GC_FEED_CHUNK_SIZE = self.feed_chunk_size
+    main.ENTRY_GC_DELETE_CHUNK_SIZE = self.delete_chunk_size
+
+  def create_entries(self, topic, count):
+    """Creates a FeedRecord and the given number of entries, oldest first."""
+    feed_record = FeedRecord.get_or_create(topic)
+    feed_record.entries_seen_time = self.now[0]
+    feed_record.put()
+    entry_ids = ['id%d' % i for i in xrange(count)]
+    for entry_id in entry_ids:
+      FeedEntryRecord.create_entry_for_topic(
+          topic, entry_id, sha1_hash(entry_id)).put()
+    return entry_ids
+
+  def get_mark(self):
+    """Returns the PollingMarker used for entry garbage collection."""
+    return PollingMarker.get(
+        key_name=main.EntryGarbageCollectHandler.MARKER_KEY_NAME)
+
+  def remaining(self, topic, entry_ids):
+    """Returns the entry_ids that still have a FeedEntryRecord."""
+    found = FeedEntryRecord.get_entries_for_topic(topic, entry_ids)
+    return sorted(e.entry_id for e in found)
+
+  def testCollect(self):
+    """Tests that only the most recent entries are kept."""
+    entry_ids = self.create_entries(self.topic, 4)
+    self.handle('get')
+    self.assertEquals(['id2', 'id3'], self.remaining(self.topic, entry_ids))
+    self.assertTrue(self.get_mark().current_key is not None)
+
+    self.handle('get')  # This completes the cycle.
+    self.assertTrue(self.get_mark().current_key is None)
+
+  def testRecentlySeen(self):
+    """Tests that entries seen within the max age are never collected."""
+    self.now[0] = datetime.datetime.utcnow()
+    entry_ids = self.create_entries(self.topic, 4)
+    self.handle('get')
+    self.assertEquals(entry_ids, self.remaining(self.topic, entry_ids))
+
+  def testUnchangedFeed(self):
+    """Tests that entries seen when the feed was last parsed are kept."""
+    entry_ids = self.create_entries(self.topic, 4)
+    feed_record = FeedRecord.get_or_create(self.topic)
+    feed_record.entries_seen_time = datetime.datetime.utcnow()
+    feed_record.put()
+    self.handle('get')
+    self.assertEquals(entry_ids, self.remaining(self.topic, entry_ids))
+
+  def testNeverSeen(self):
+    """Tests that feeds without a last-seen time are skipped."""
+    entry_ids = self.create_entries(self.topic, 4)
+    feed_record = FeedRecord.get_or_create(self.topic)
+    feed_record.entries_seen_time = None
+    feed_record.put()
+    self.handle('get')
+    self.assertEquals(entry_ids, self.remaining(self.topic, entry_ids))
+
+  def testResumeTopic(self):
+    """Tests that a topic with many old entries is collected in chunks."""
+    main.ENTRY_GC_DELETE_CHUNK_SIZE = 1
+    entry_ids = self.create_entries(self.topic, 4)
+    self.handle('get')
+    self.assertEquals(['id1', 'id2', 'id3'],
+                      self.remaining(self.topic, entry_ids))
+    self.assertTrue(self.get_mark().current_key is None)
+
+    self.handle('get')
+    self.assertEquals(['id2', 'id3'], self.remaining(self.topic, entry_ids))
+    self.assertTrue(self.get_mark().current_key is None)
+
+    self.handle('get')
+    self.assertEquals(['id2', 'id3'], self.remaining(self.topic, entry_ids))
+    self.assertTrue(self.get_mark().current_key is not None)
+
+  def testMultipleFeeds(self):
+    """Tests walking through feeds across multiple requests."""
+    main.ENTRY_GC_FEED_CHUNK_SIZE = 1
+    entry_ids = self.create_entries(self.topic, 3)
+    entry_ids2 = self.create_entries(self.topic2, 3)
+
+    self.handle('get')
+    self.assertEquals(5, len(self.remaining(self.topic, entry_ids)) +
+                         len(self.remaining(self.topic2, entry_ids2)))
+    self.handle('get')
+    self.assertEquals(['id1', 'id2'], self.remaining(self.topic, entry_ids))
+    self.assertEquals(['id1', 'id2'], self.remaining(self.topic2, entry_ids2))
+
+    self.handle('get')  # This completes the cycle.
+    self.assertTrue(self.get_mark().current_key is None)
+
+################################################################################
+
+class BackfillHandlerTest(testutil.HandlerTestBase):
+
+  def setUp(self):
+    """Sets up the test harness."""
+    self.now = [datetime.datetime.utcnow()]
+    def create_handler():
+      return main.BackfillHandler(now=lambda: self.now[0])
+    self.handler_class = create_handler
+    testutil.HandlerTestBase.setUp(self)
+    self.chunk_size = main.BACKFILL_CHUNK_SIZE
+    self.topic = 'http://example.com/my-topic'
+    self.callback = 'http://example.com/my-callback'
+    self.callback2 = 'http://example.com/second-callback'
+    self.header_footer = '<feed>\n<stuff>blah</stuff>\n<xmldata/></feed>'
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    testutil.HandlerTestBase.tearDown(self)
+    main.BACKFILL_CHUNK_SIZE = self.chunk_size
+
+  def create_event(self):
+    """Creates an event in retry mode, as stored by older versions."""
+    event, event_payload = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, self.header_footer, ['<entry>1</entry>'])
+    event.delivery_mode = EventToDeliver.RETRY
+    db.put([event, event_payload])
+    return event
+
+  def get_mark(self, model_class):
+    """Returns the PollingMarker used for backfilling a kind."""
+    return PollingMarker.get(key_name='Backfill ' + model_class.kind())
+
+  def testNoWork(self):
+    self.handle('get')
+    for model_class in main.BackfillHandler.MODELS:
+      self.assertEquals(main.BackfillHandler.DONE,
+                        self.get_mark(model_class).next_start)
+
+  def testLegacyEventList(self):
+    """Tests converting the failed callback list of events in retry mode."""
+    self.assertTrue(Subscription.insert(self.callback, self.topic))
+    event = self.create_event()
+    event.failed_callbacks = [Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback, self.topic)).key()]
+    event.put()
+
+    self.handle('get')
+    event = db.get(event.key())
+    self.assertEquals([], event.failed_callbacks)
+    self.assertEquals(1, event.failed_count)
+    self.assertEquals([self.callback],
+                      [f.callback for f in FailedCallback.all()])
+
+  def testLegacyKnownFeeds(self):
+    """Tests scheduling known feeds stored without a polling schedule."""
+    KnownFeed(key_name=main.get_hash_key_name(self.topic),
+              topic=self.topic).put()
+    shard = main.get_work_shard(self.topic, main.POLL_BOOTSTRAP_SHARDS)
+    self.assertEquals([], KnownFeed.get_work(now=lambda: self.now[0],
+                                             shard=shard))
+
+    self.handle('get')
+    known_feed = KnownFeed.all().get()
+    self.assertEquals(self.now[0], known_feed.next_poll_time)
+    self.assertEquals(shard, known_feed.work_shard)
+    self.assertEquals([self.topic], [
+        k.topic for k in KnownFeed.get_work(now=lambda: self.now[0],
+                                            shard=shard)])
+
+  def testLegacyWorkShards(self):
+    """Tests sharding queued work items stored before queues were sharded."""
+    FeedToFetch(key_name=main.get_hash_key_name(self.topic),
+                topic=self.topic, eta=self.now[0]).put()
+    event = self.create_event()
+    event.delivery_mode = EventToDeliver.NORMAL
+    event.work_shard = None
+    event.put()
+    self.assertTrue(Subscription.request_insert(self.callback, self.topic,
+                                                'token'))
+    sub = Subscription.all().get()
+    sub.work_shard = None
+    sub.put()
+    self.assertTrue(Subscription.insert(self.callback2, self.topic))
+    verified = Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback2, self.topic))
+    verified.work_shard = None
+    verified.put()
+
+    self.handle('get')
+    self.assertEquals(main.get_work_shard(self.topic, main.FEED_PULL_SHARDS),
+                      FeedToFetch.all().get().work_shard)
+    self.assertEquals(
+        main.get_work_shard(self.topic, main.EVENT_DELIVERY_SHARDS),
+        db.get(event.key()).work_shard)
+    self.assertEquals(Subscription.get_work_shard(self.callback, self.topic),
+                      db.get(sub.key()).work_shard)
+    # Verified subscriptions are not in any work queue.
+    self.assertEquals(None, db.get(verified.key()).work_shard)
+
+  def testResume(self):
+    """Tests walking a kind in chunks until it is done."""
+    main.BACKFILL_CHUNK_SIZE = 1
+    for topic in (self.topic, self.topic + '/two'):
+      KnownFeed(key_name=main.get_hash_key_name(topic), topic=topic).put()
+
+    # Each chunk uses up the whole time budget.
+    def now():
+      self.now[0] += datetime.timedelta(seconds=main.WORKER_TIME_BUDGET)
+      return self.now[0]
+    self.handler_class = lambda: main.BackfillHandler(now=now)
+    self.handle('get')
+    self.assertNotEquals(main.BackfillHandler.DONE,
+                         self.get_mark(KnownFeed).next_start)
+    while self.get_mark(KnownFeed).next_start != main.BackfillHandler.DONE:
+      self.handle('get')
+    self.assertEquals(0, len([k for k in KnownFeed.all()
+                              if k.work_shard is None]))
 
-    db.delete([FeedToFetch.get_by_topic(t) for t in (topic, topic2, topic3)])
+    # Once done, nothing is walked again.
+    late_topic = 'http://example.com/late'
+    KnownFeed(key_name=main.get_hash_key_name(late_topic),
+              topic=late_topic).put()
     self.handle('get')
-    self.assertTrue(FeedToFetch.get_by_topic(topic) is not None)
-    self.assertTrue(FeedToFetch.get_by_topic(topic2) is not None)
-    self.assertTrue(FeedToFetch.get_by_topic(topic3) is None)
+    self.assertEquals(1, len([k for k in KnownFeed.all()
+                              if k.work_shard is None]))
 
 ################################################################################
 
@@ -22,7 +22,8 @@ from google.appengine.runtime import apiproxy_errors
 
 
 def fetch(url, payload=None, method=urlfetch.GET, headers={},
-          allow_truncated=False, callback=None, async_proxy=None):
+          allow_truncated=False, follow_redirects=True, deadline=None,
+          callback=None, async_proxy=None):
   """Fetches the given HTTP URL, blocking until the result is returned.
 
   Other optional parameters are:
@@ -32,6 +33,13 @@ def fetch(url, payload=None, method=urlfetch.GET, headers={},
     allow_truncated: if true, truncate large responses and return them without
       error. otherwise, ResponseTooLargeError will be thrown when a response is
       truncated.
+    follow_redirects: if true (the default), redirects are transparently
+      followed and the final destination's response is returned. otherwise,
+      the redirect response itself is returned.
+    deadline: maximum number of seconds to wait for the response, or None to
+      use the service's default. It is enforced by the urlfetch service; when
+      an async_proxy is used, the proxy also abandons the call once it sees
+      the deadline has passed, and the callback receives an exception.
     callback: Callable that takes (_URLFetchResult, URLFetchException).
       Exactly one of the two arguments is None. Required if async_proxy is
       not None.
@@ -59,7 +67,7 @@ def fetch(url, payload=None, method=urlfetch.GET, headers={},
     method = method.upper()
   method = urlfetch._URL_STRING_MAP.get(method, method)
   if method not in urlfetch._VALID_METHODS:
-    raise InvalidMethodError('Invalid method %s.' % str(method))
+    raise urlfetch.InvalidMethodError('Invalid method %s.' % str(method))
   if method == urlfetch.GET:
     request.set_method(urlfetch_service_pb.URLFetchRequest.GET)
   elif method == urlfetch.POST:
@@ -79,13 +87,17 @@ def fetch(url, payload=None, method=urlfetch.GET, headers={},
     header_proto.set_key(key)
     header_proto.set_value(value)
 
+  request.set_followredirects(follow_redirects)
+  if deadline is not None:
+    request.set_deadline(deadline)
+
   if async_proxy:
     def completion_callback(response, urlfetch_exception):
       result, user_exception = HandleResult(response, urlfetch_exception,
                                             allow_truncated)
       callback(result, user_exception)
     async_proxy.start_call('urlfetch', 'Fetch', request, response,
-                           completion_callback)
+                           completion_callback, deadline=deadline)
     return
 
   user_exception = None
@@ -94,7 +106,8 @@ def fetch(url, payload=None, method=urlfetch.GET, headers={},
   except apiproxy_errors.ApplicationError, e:
     user_exception = e
     
-  result, user_exception = HandleResult(response, e, allow_truncated)
+  result, user_exception = HandleResult(response, user_exception,
+                                        allow_truncated)
   if user_exception:
     raise user_exception
   else:
@@ -107,16 +120,21 @@ def HandleResult(response, urlfetch_exception, allow_truncated):
   user_exception = None
 
   if urlfetch_exception:
-    if (urlfetch_exception.application_error ==
+    application_error = getattr(urlfetch_exception, 'application_error', None)
+    if (application_error ==
         urlfetch_service_pb.URLFetchServiceError.INVALID_URL):
-      user_exception = urlfetch.InvalidURLError(str(e))
-    elif (urlfetch_exception.application_error ==
+      user_exception = urlfetch.InvalidURLError(str(urlfetch_exception))
+    elif (application_error ==
         urlfetch_service_pb.URLFetchServiceError.UNSPECIFIED_ERROR):
-      user_exception = urlfetch.DownloadError(str(e))
-    elif (urlfetch_exception.application_error ==
+      user_exception = urlfetch.DownloadError(str(urlfetch_exception))
+    elif (application_error ==
         urlfetch_service_pb.URLFetchServiceError.FETCH_ERROR):
-      user_exception = urlfetch.DownloadError(str(e))
-    elif (urlfetch_exception.application_error ==
+      user_exception = urlfetch.DownloadError(str(urlfetch_exception))
+    elif (application_error ==
+        urlfetch_service_pb.URLFetchServiceError.DEADLINE_EXCEEDED):
+      user_exception = urlfetch.DownloadError(
+          'Deadline exceeded: %s' % urlfetch_exception)
+    elif (application_error ==
         urlfetch_service_pb.URLFetchServiceError.RESPONSE_TOO_LARGE):
       user_exception = urlfetch.ResponseTooLargeError(None)
     else: